@@ -0,0 +1,372 @@
+"""
+Офлайн-бенчмарк бота.
+
+Синтетичні апдейти подаються прямо в Dispatcher.feed_update зі справжнім роутером і middleware з main.py.
+Telegram Bot API і OpenAI замінені локальними фейковими серверами з налаштовуваною затримкою,
+база — локальний Postgres (лише окрема тестова база: скрипт застосовує міграції і пише в неї дані).
+
+Приклад:
+    python bench.py --database-url postgresql://postgres@localhost/corpcybertest_bench --users 50
+
+Для кожного сценарію виводиться кількість апдейтів за секунду, p50/p95/p99 по хендлерах і приріст пам'яті процесу.
+"""
+import argparse
+import asyncio
+import gc
+import json
+import os
+import random
+import re
+import resource
+import time
+from aiohttp import web
+from aiogram import Bot
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
+from aiogram.types import Update
+from openai import AsyncOpenAI
+import main as app
+
+FAKE_TOKEN = "123456:bench"
+WORDS = (
+    "пароль фішинг шифрування мережа доступ резервна копія вкладення оновлення журнал інцидент "
+    "токен сертифікат брандмауер антивірус політика облікового запису сесія пристрій"
+).split()
+# -----------------------------------------------------------------------------
+# Фейковий Telegram Bot API
+# -----------------------------------------------------------------------------
+class FakeTelegram:
+    """Відповідає на виклики Bot API правдоподібними об'єктами; матеріали віддаються як текстові файли"""
+    def __init__(self, latency: float):
+        self.latency = latency
+        self.files: dict[str, bytes] = {}
+        self.calls: dict[str, int] = {}
+        self._message_id = 0
+
+    def message(self, chat_id, **extra) -> dict:
+        self._message_id += 1
+        return {
+            "message_id": self._message_id,
+            "date": int(time.time()),
+            "chat": {"id": int(chat_id), "type": "private"},
+            **extra,
+        }
+
+    def document(self) -> dict:
+        return {"file_id": f"sent-{self._message_id}", "file_unique_id": f"u-sent-{self._message_id}", "file_name": "test.txt"}
+
+    async def handle_method(self, request: web.Request) -> web.Response:
+        method = request.match_info["method"].lower()
+        self.calls[method] = self.calls.get(method, 0) + 1
+        form = await request.post()
+        await asyncio.sleep(self.latency)
+        chat_id = form.get("chat_id", 0)
+        if method in ("sendmessage", "editmessagetext", "editmessagereplymarkup"):
+            result = self.message(chat_id, text=form.get("text", ""))
+        elif method == "senddocument":
+            result = self.message(chat_id, document=self.document())
+        elif method == "sendmediagroup":
+            result = [self.message(chat_id, document=self.document()) for _ in json.loads(form["media"])]
+        elif method == "getfile":
+            file_id = form["file_id"]
+            result = {
+                "file_id": file_id,
+                "file_unique_id": f"u-{file_id}",
+                "file_size": len(self.files.get(file_id, b"")),
+                "file_path": f"documents/{file_id}.txt",
+            }
+        elif method == "getme":
+            result = {"id": 123456, "is_bot": True, "first_name": "Bench", "username": "bench_bot"}
+        else:
+            result = True
+        return web.json_response({"ok": True, "result": result})
+
+    async def handle_file(self, request: web.Request) -> web.Response:
+        await asyncio.sleep(self.latency)
+        file_id = request.match_info["path"].rsplit("/", 1)[-1].removesuffix(".txt")
+        return web.Response(body=self.files.get(file_id, b""))
+
+    def app(self) -> web.Application:
+        application = web.Application()
+        application.router.add_post("/bot{token}/{method}", self.handle_method)
+        application.router.add_get("/file/bot{token}/{path:.+}", self.handle_file)
+        return application
+# -----------------------------------------------------------------------------
+# Фейковий OpenAI
+# -----------------------------------------------------------------------------
+class FakeOpenAI:
+    """Повертає потрібну кількість питань у форматі з промпта; підтримує потокові відповіді"""
+    def __init__(self, first_token_latency: float, chunk_latency: float):
+        self.first_token_latency = first_token_latency
+        self.chunk_latency = chunk_latency
+        self.requests = 0
+
+    @staticmethod
+    def make_questions(count: int) -> list[str]:
+        blocks = []
+        for number in range(1, count + 1):
+            topic = " ".join(random.sample(WORDS, 4))
+            options = [" ".join(random.sample(WORDS, 3)) for _ in range(4)]
+            blocks.append(
+                f"{number}. Що правильно щодо теми «{topic}»?\n"
+                + "".join(f"{letter}) {option}\n" for letter, option in zip("ABCD", options))
+                + f"Правильна відповідь: {random.choice('ABCD')}\n"
+            )
+        return blocks
+
+    async def handle(self, request: web.Request) -> web.StreamResponse:
+        self.requests += 1
+        body = await request.json()
+        match = re.search(r"створи (\d+) тестових", body["messages"][-1]["content"])
+        blocks = self.make_questions(int(match.group(1)) if match else 10)
+        usage = {"prompt_tokens": len(body["messages"][-1]["content"]) // 3, "completion_tokens": sum(map(len, blocks)) // 3}
+        usage["total_tokens"] = usage["prompt_tokens"] + usage["completion_tokens"]
+        await asyncio.sleep(self.first_token_latency)
+        base = {"id": "chatcmpl-bench", "created": int(time.time()), "model": body["model"]}
+        if not body.get("stream"):
+            await asyncio.sleep(self.chunk_latency * len(blocks))
+            return web.json_response({
+                **base,
+                "object": "chat.completion",
+                "choices": [{"index": 0, "finish_reason": "stop", "message": {"role": "assistant", "content": "\n".join(blocks)}}],
+                "usage": usage,
+            })
+        response = web.StreamResponse(headers={"Content-Type": "text/event-stream"})
+        await response.prepare(request)
+
+        async def send(payload):
+            await response.write(f"data: {json.dumps(payload, ensure_ascii=False)}\n\n".encode())
+
+        for block in blocks:
+            await asyncio.sleep(self.chunk_latency)
+            await send({**base, "object": "chat.completion.chunk", "choices": [{"index": 0, "delta": {"content": block + "\n"}, "finish_reason": None}]})
+        await send({**base, "object": "chat.completion.chunk", "choices": [], "usage": usage})
+        await response.write(b"data: [DONE]\n\n")
+        return response
+
+    def app(self) -> web.Application:
+        application = web.Application()
+        application.router.add_post("/v1/chat/completions", self.handle)
+        return application
+async def serve(application: web.Application) -> tuple[web.AppRunner, str]:
+    runner = web.AppRunner(application)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    port = site._server.sockets[0].getsockname()[1]
+    return runner, f"http://127.0.0.1:{port}"
+# -----------------------------------------------------------------------------
+# Вимірювання
+# -----------------------------------------------------------------------------
+def rss_bytes() -> int:
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except OSError:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+def percentile(samples: list[float], q: float) -> float:
+    ordered = sorted(samples)
+    position = (len(ordered) - 1) * q
+    low = int(position)
+    high = min(low + 1, len(ordered) - 1)
+    return ordered[low] + (ordered[high] - ordered[low]) * (position - low)
+class Recorder:
+    def __init__(self):
+        self.samples: dict[str, list[float]] = {}
+        self.updates = 0
+        self.errors = 0
+
+    def add(self, handler: str, seconds: float):
+        self.samples.setdefault(handler, []).append(seconds)
+        self.updates += 1
+class Harness:
+    """Подає синтетичні апдейти від імені багатьох користувачів і вимірює час обробки кожного"""
+    def __init__(self, bot: Bot, dp, pool, run_id: str):
+        self.bot = bot
+        self.dp = dp
+        self.pool = pool
+        self.run_id = run_id
+        self.chat_base = random.randint(10**12, 2 * 10**12)
+        self._update_id = 0
+        self.recorder = Recorder()
+
+    def chat_id(self, user: int) -> int:
+        return self.chat_base + user
+
+    def org_name(self, user: int) -> str:
+        return f"bench-{self.run_id}-{user}"
+
+    async def send(self, user: int, text: str):
+        self._update_id += 1
+        chat_id = self.chat_id(user)
+        update = Update.model_validate(
+            {
+                "update_id": self._update_id,
+                "message": {
+                    "message_id": self._update_id,
+                    "date": int(time.time()),
+                    "chat": {"id": chat_id, "type": "private"},
+                    "from": {"id": chat_id, "is_bot": False, "first_name": f"Bench {user}"},
+                    "text": text,
+                },
+            },
+            context={"bot": self.bot},
+        )
+        trace = {"handler": "unhandled"}
+        started = time.perf_counter()
+        try:
+            await self.dp.feed_update(self.bot, update, metrics_trace=trace)
+        except Exception as e:
+            self.recorder.errors += 1
+            print(f"Помилка обробки апдейту ({trace['handler']}): {e}")
+        self.recorder.add(trace["handler"], time.perf_counter() - started)
+
+    async def login(self, user: int):
+        await self.send(user, "/start")
+        await self.send(user, BUTTONS["admin"])
+        await self.send(user, self.org_name(user))
+        await self.send(user, "bench-password")
+
+    async def run_users(self, users: int, flow):
+        await asyncio.gather(*(flow(user) for user in range(users)))
+BUTTONS = {
+    "admin": app.kb_roles().keyboard[0][0].text,
+    "materials": app.kb_main_menu().keyboard[0][0].text,
+    "tests": app.kb_main_menu().keyboard[1][0].text,
+    "view_materials": app.kb_materials_menu().keyboard[0][1].text,
+    "materials_home": app.kb_materials_menu().keyboard[1][1].text,
+    "ai_menu": app.kb_tests_menu().keyboard[1][1].text,
+    "generate_10": app.kb_ai_test_menu().keyboard[0][0].text,
+}
+# -----------------------------------------------------------------------------
+# Сценарії
+# -----------------------------------------------------------------------------
+async def scenario_logins(harness: Harness, args):
+    """Одночасна реєстрація нових організацій, а потім повторний вхід з паролем"""
+    # Користувачі з номерами після args.users ще не мають організацій (ті, що до, створені підготовкою інших сценаріїв)
+    users = range(args.users, 2 * args.users)
+    await asyncio.gather(*(harness.login(user) for user in users))
+    await asyncio.gather(*(harness.login(user) for user in users))
+async def add_materials(harness: Harness, telegram: FakeTelegram, users: int, count: int):
+    for user in range(users):
+        async with harness.pool.acquire() as con:
+            org = await app.get_org(con, harness.org_name(user))
+        for index in range(count):
+            file_id = f"bench-{harness.run_id}-{user}-{index}"
+            telegram.files[file_id] = " ".join(random.choices(WORDS, k=3000)).encode()
+            await app.save_file_to_db(
+                harness.pool, org["id"], "material", file_id, f"material-{index}.txt", f"u-{file_id}", "text/plain"
+            )
+async def scenario_files(harness: Harness, args):
+    """Перегляд списку матеріалів (альбоми документів) багатьма адміністраторами одночасно"""
+    async def flow(user: int):
+        await harness.send(user, BUTTONS["materials"])
+        for _ in range(args.repeat):
+            await harness.send(user, BUTTONS["view_materials"])
+        await harness.send(user, BUTTONS["materials_home"])
+    await harness.run_users(args.users, flow)
+async def scenario_generation(harness: Harness, args):
+    """Одночасні запити на генерацію тесту; чекаємо, поки фонова черга виконає всі завдання"""
+    chat_ids = [harness.chat_id(user) for user in range(args.users)]
+    started = time.perf_counter()
+
+    async def flow(user: int):
+        await harness.send(user, BUTTONS["tests"])
+        await harness.send(user, BUTTONS["ai_menu"])
+        await harness.send(user, BUTTONS["generate_10"])
+    await harness.run_users(args.users, flow)
+    while True:
+        async with harness.pool.acquire() as con:
+            pending = await con.fetchval(
+                "SELECT count(*) FROM generation_jobs WHERE chat_id = ANY($1::bigint[]) AND state IN ('queued', 'running')",
+                chat_ids,
+            )
+        if not pending or time.perf_counter() - started > args.timeout:
+            break
+        await asyncio.sleep(0.2)
+    async with harness.pool.acquire() as con:
+        jobs = await con.fetch(
+            "SELECT state, EXTRACT(EPOCH FROM updated_at - created_at) AS seconds FROM generation_jobs WHERE chat_id = ANY($1::bigint[])",
+            chat_ids,
+        )
+    for job in jobs:
+        harness.recorder.samples.setdefault(f"[job {job['state']}]", []).append(float(job["seconds"]))
+SCENARIOS = {
+    "logins": scenario_logins,
+    "files": scenario_files,
+    "generation": scenario_generation,
+}
+def report(name: str, recorder: Recorder, elapsed: float, memory_growth: int):
+    print(f"\n=== {name}: {recorder.updates} апдейтів за {elapsed:.2f} с, "
+          f"{recorder.updates / elapsed:.1f} апдейтів/с, помилок {recorder.errors}, "
+          f"пам'ять +{memory_growth / 2**20:.1f} МБ")
+    print(f"{'хендлер':40} {'к-сть':>6} {'p50, мс':>9} {'p95, мс':>9} {'p99, мс':>9}")
+    for handler, samples in sorted(recorder.samples.items()):
+        print(
+            f"{handler:40} {len(samples):6d} {percentile(samples, 0.5) * 1000:9.1f} "
+            f"{percentile(samples, 0.95) * 1000:9.1f} {percentile(samples, 0.99) * 1000:9.1f}"
+        )
+async def run(args):
+    telegram = FakeTelegram(args.telegram_latency / 1000)
+    openai = FakeOpenAI(args.openai_latency / 1000, args.openai_chunk_latency / 1000)
+    telegram_runner, telegram_url = await serve(telegram.app())
+    openai_runner, openai_url = await serve(openai.app())
+
+    app.DATABASE_URL = args.database_url
+    app.openai_client = AsyncOpenAI(api_key="bench", base_url=f"{openai_url}/v1", max_retries=0)
+    if not args.real_limits:
+        app.telegram_limiter = app.TelegramRateLimiter(10**9, 10**9, 10**9, app.TELEGRAM_MAX_RETRIES)
+    pool = await app.create_db_pool()
+    await app.setup_database(pool)
+    bot = Bot(token=FAKE_TOKEN, session=AiohttpSession(api=TelegramAPIServer.from_base(telegram_url)))
+    bot.session.middleware(app.TelegramMetricsMiddleware())
+    storage = app.PostgresStorage(pool)
+    storage.start()
+    dp = app.create_dispatcher(storage, pool)
+    await app.generation_queue.start(bot, pool, storage)
+    app.results_writer.start(pool)
+    app.openai_scheduler.start(pool)
+
+    harness = Harness(bot, dp, pool, f"{int(time.time())}-{random.randint(0, 9999)}")
+    scenarios = list(SCENARIOS) if args.scenario == "all" else [args.scenario]
+    try:
+        # Організації та матеріали потрібні всім сценаріям, крім входу
+        if scenarios != ["logins"]:
+            await harness.run_users(args.users, harness.login)
+            await add_materials(harness, telegram, args.users, args.materials)
+        for name in scenarios:
+            harness.recorder = Recorder()
+            gc.collect()
+            memory_before = rss_bytes()
+            started = time.perf_counter()
+            await SCENARIOS[name](harness, args)
+            elapsed = time.perf_counter() - started
+            gc.collect()
+            report(name, harness.recorder, elapsed, rss_bytes() - memory_before)
+        print(f"\nВиклики Telegram API: {dict(sorted(telegram.calls.items()))}; запитів до OpenAI: {openai.requests}")
+    finally:
+        await app.generation_queue.stop()
+        await app.results_writer.close()
+        await storage.close()
+        await bot.session.close()
+        await pool.close()
+        await telegram_runner.cleanup()
+        await openai_runner.cleanup()
+def parse_args():
+    parser = argparse.ArgumentParser(description="Офлайн-бенчмарк бота з фейковими Telegram і OpenAI")
+    parser.add_argument("--database-url", default=os.getenv("BENCH_DATABASE_URL"), help="окрема тестова база Postgres")
+    parser.add_argument("--scenario", choices=["all", *SCENARIOS], default="all")
+    parser.add_argument("--users", type=int, default=20, help="кількість одночасних користувачів")
+    parser.add_argument("--repeat", type=int, default=5, help="повтори перегляду файлів на користувача")
+    parser.add_argument("--materials", type=int, default=12, help="матеріалів на організацію")
+    parser.add_argument("--telegram-latency", type=float, default=20, help="затримка Bot API, мс")
+    parser.add_argument("--openai-latency", type=float, default=300, help="затримка першого токена OpenAI, мс")
+    parser.add_argument("--openai-chunk-latency", type=float, default=50, help="затримка на кожне питання в потоці, мс")
+    parser.add_argument("--timeout", type=float, default=300, help="максимальне очікування фонових завдань, с")
+    parser.add_argument("--real-limits", action="store_true", help="не вимикати ліміти відправки в Telegram")
+    args = parser.parse_args()
+    if not args.database_url:
+        parser.error("потрібен --database-url або BENCH_DATABASE_URL")
+    return args
+if __name__ == "__main__":
+    asyncio.run(run(parse_args()))
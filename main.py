@@ -1,9 +1,37 @@
+import time
+BOOT_STARTED = time.perf_counter()  # від цієї точки рахуються фази запуску (див. BootTimer)
 import os
 import asyncio
+import base64
+import codecs
+import contextlib
+import copy
+import csv
+import hashlib
+import heapq
+import hmac
+import itertools
+import io
+import json
+import math
+import multiprocessing
+import random
+import re
+import signal
+import uuid
+from array import array
+from datetime import datetime, timezone
+from collections import Counter, OrderedDict, deque
+from typing import NamedTuple
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 import asyncpg
-from aiogram import Bot, Dispatcher, Router, F
+from aiogram import BaseMiddleware, Bot, Dispatcher, Router, F
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.exceptions import TelegramAPIError, TelegramBadRequest, TelegramForbiddenError, TelegramRetryAfter
 from aiogram.filters import CommandStart, StateFilter
-from aiogram.fsm.storage.memory import MemoryStorage
+from aiogram.fsm.storage.base import BaseStorage, StateType, StorageKey
+from aiogram.fsm.storage.memory import SimpleEventIsolation
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import StatesGroup, State
 from aiogram.types import (
@@ -15,11 +43,11 @@ from aiogram.types import (
     ReplyKeyboardRemove,
     InlineKeyboardMarkup,
     InlineKeyboardButton,
-    FSInputFile,
+    BufferedInputFile,
+    InputMediaDocument,
+    Update,
 )
-from aiohttp import web
-from openai import AsyncOpenAI
-import tempfile
+from aiohttp import ClientError, ClientSession, ClientTimeout, UnixConnector, web
 # -----------------------------------------------------------------------------
 # Конфігурація: читаємо токен і параметри підключення до БД
 # -----------------------------------------------------------------------------
@@ -27,6 +55,121 @@ BOT_TOKEN = os.getenv("TELEGRAM_BOT_TOKEN")
 DATABASE_URL = os.getenv("DATABASE_URL")
 PORT = int(os.getenv("PORT", 10000))
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
+# Кеш витягнутого тексту матеріалів: ліміт LRU у пам'яті (символи) і розмір таблиці file_texts (байти)
+TEXT_CACHE_MAX_CHARS = int(os.getenv("TEXT_CACHE_MAX_CHARS", 5_000_000))
+TEXT_CACHE_DB_MAX_BYTES = int(os.getenv("TEXT_CACHE_DB_MAX_BYTES", 200 * 1024 * 1024))
+# Паралельне завантаження матеріалів: скільки файлів одночасно і тайм-аут завантаження одного файлу (секунди;
+# витягування тексту обмежене окремо EXTRACT_TIMEOUT)
+MATERIAL_DOWNLOAD_CONCURRENCY = int(os.getenv("MATERIAL_DOWNLOAD_CONCURRENCY", 4))
+MATERIAL_DOWNLOAD_TIMEOUT = float(os.getenv("MATERIAL_DOWNLOAD_TIMEOUT", 30))
+# Витягування тексту з документів: кількість процесів, ліміти розміру файлу/тексту і час на один файл
+EXTRACT_WORKERS = int(os.getenv("EXTRACT_WORKERS", 2))
+EXTRACT_MAX_BYTES = int(os.getenv("EXTRACT_MAX_BYTES", 20 * 1024 * 1024))
+EXTRACT_MAX_CHARS = int(os.getenv("EXTRACT_MAX_CHARS", 1_000_000))
+EXTRACT_TIMEOUT = float(os.getenv("EXTRACT_TIMEOUT", 60))
+# Скільки секунд процесорного часу понад EXTRACT_TIMEOUT дається обробнику, що не реагує на переривання, до його завершення
+EXTRACT_KILL_GRACE = float(os.getenv("EXTRACT_KILL_GRACE", 10))
+# Завантаження файлів з Telegram читається частинами такого розміру (байти)
+DOWNLOAD_CHUNK_SIZE = int(os.getenv("DOWNLOAD_CHUNK_SIZE", 64 * 1024))
+# Генерація тестів: модель, розмір фрагмента матеріалів (токени) і кількість одночасних запитів до OpenAI
+OPENAI_MODEL = os.getenv("OPENAI_MODEL", "gpt-4o-mini")
+GENERATION_CHUNK_TOKENS = int(os.getenv("GENERATION_CHUNK_TOKENS", 2500))
+GENERATION_CONCURRENCY = int(os.getenv("GENERATION_CONCURRENCY", 4))
+# Відбір матеріалів для генерації: розмір фрагмента в індексі, бюджет токенів матеріалів на один тест,
+# кількість організацій, чиї індекси тримаються в пам'яті
+INDEX_CHUNK_TOKENS = int(os.getenv("INDEX_CHUNK_TOKENS", 400))
+GENERATION_CONTEXT_TOKENS = int(os.getenv("GENERATION_CONTEXT_TOKENS", 12000))
+MATERIAL_INDEX_ORGS = int(os.getenv("MATERIAL_INDEX_ORGS", 200))
+# Повтори при оновленні тесту: поріг схожості (оцінка Жаккара), скільки разів догенеровувати замість відкинутих,
+# скільки останніх питань організації пам'ятати
+DUPLICATE_THRESHOLD = float(os.getenv("DUPLICATE_THRESHOLD", 0.5))
+DUPLICATE_TOPUP_ROUNDS = int(os.getenv("DUPLICATE_TOPUP_ROUNDS", 2))
+QUESTION_HISTORY_SIZE = int(os.getenv("QUESTION_HISTORY_SIZE", 2000))
+# Планувальник запитів до OpenAI: токенів за хвилину на весь бот і на одну організацію, денна квота організації
+# за замовчуванням (0 — без квоти; можна перевизначити в orgs.daily_token_quota), повтори після 429/5xx і межі затримки (секунди)
+OPENAI_TPM = int(os.getenv("OPENAI_TPM", 200000))
+OPENAI_ORG_TPM = int(os.getenv("OPENAI_ORG_TPM", 60000))
+OPENAI_ORG_DAILY_TOKENS = int(os.getenv("OPENAI_ORG_DAILY_TOKENS", 0))
+OPENAI_MAX_RETRIES = int(os.getenv("OPENAI_MAX_RETRIES", 4))
+OPENAI_RETRY_BASE_DELAY = float(os.getenv("OPENAI_RETRY_BASE_DELAY", 1))
+OPENAI_RETRY_MAX_DELAY = float(os.getenv("OPENAI_RETRY_MAX_DELAY", 30))
+# Потокова генерація: мінімальний інтервал між оновленнями повідомлення з прогресом (секунди)
+PROGRESS_EDIT_INTERVAL = float(os.getenv("PROGRESS_EDIT_INTERVAL", 1.5))
+# Кеш згенерованих тестів: час життя запису (секунди) і максимальна кількість записів
+GENERATED_TEST_CACHE_TTL = float(os.getenv("GENERATED_TEST_CACHE_TTL", 3600))
+GENERATED_TEST_CACHE_SIZE = int(os.getenv("GENERATED_TEST_CACHE_SIZE", 256))
+# Фонова черга генерації: кількість обробників, спроби, базова затримка повтору, опитування черги і оренда завдання (секунди)
+GENERATION_WORKERS = int(os.getenv("GENERATION_WORKERS", 2))
+GENERATION_MAX_ATTEMPTS = int(os.getenv("GENERATION_MAX_ATTEMPTS", 3))
+GENERATION_RETRY_DELAY = float(os.getenv("GENERATION_RETRY_DELAY", 10))
+GENERATION_POLL_INTERVAL = float(os.getenv("GENERATION_POLL_INTERVAL", 5))
+GENERATION_JOB_LEASE = int(os.getenv("GENERATION_JOB_LEASE", 600))
+# Сховище станів FSM: час життя неактивної сесії, час зберігання в пам'яті, період скидання змін (секунди)
+# і довжина рядка, починаючи з якої значення зберігається окремо (за посиланням)
+FSM_SESSION_TTL = int(os.getenv("FSM_SESSION_TTL", 7 * 24 * 3600))
+FSM_CACHE_IDLE = float(os.getenv("FSM_CACHE_IDLE", 600))
+FSM_FLUSH_INTERVAL = float(os.getenv("FSM_FLUSH_INTERVAL", 1))
+FSM_BLOB_THRESHOLD = int(os.getenv("FSM_BLOB_THRESHOLD", 4096))
+# Режим вебхука: якщо задано WEBHOOK_URL (публічна адреса сервісу), апдейти приходять на WEBHOOK_PATH замість polling;
+# WEBHOOK_SECRET у цьому режимі обов'язковий — Telegram передає його в заголовку кожного апдейту
+WEBHOOK_URL = os.getenv("WEBHOOK_URL")
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/webhook")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET")
+WEBHOOK_CONCURRENCY = int(os.getenv("WEBHOOK_CONCURRENCY", 32))
+WEBHOOK_QUEUE_SIZE = int(os.getenv("WEBHOOK_QUEUE_SIZE", 1000))
+# Скільки секунд при зупинці дообробляються (у супервізора — передаються обробникам) вже прийняті апдейти;
+# менше за 10 с, які супервізор чекає на завершення обробника
+WEBHOOK_DRAIN_TIMEOUT = float(os.getenv("WEBHOOK_DRAIN_TIMEOUT", 8))
+# Багатопроцесний режим: кількість процесів-обробників (1 — усе в одному процесі), каталог їхніх Unix-сокетів,
+# черга апдейтів до одного обробника і запас понад неї для polling, період і тайм-аут перевірки здоров'я (секунди), кількість невдалих перевірок
+# поспіль до перезапуску і час, який дається обробнику на запуск (секунди)
+WORKER_PROCESSES = int(os.getenv("WORKER_PROCESSES", 1))
+WORKER_SOCKET_DIR = os.getenv("WORKER_SOCKET_DIR", "/tmp")
+WORKER_QUEUE_SIZE = int(os.getenv("WORKER_QUEUE_SIZE", 1000))
+WORKER_OVERFLOW_SIZE = int(os.getenv("WORKER_OVERFLOW_SIZE", 20000))
+WORKER_HEALTH_INTERVAL = float(os.getenv("WORKER_HEALTH_INTERVAL", 5))
+WORKER_HEALTH_TIMEOUT = float(os.getenv("WORKER_HEALTH_TIMEOUT", 3))
+WORKER_HEALTH_FAILURES = int(os.getenv("WORKER_HEALTH_FAILURES", 3))
+WORKER_START_TIMEOUT = float(os.getenv("WORKER_START_TIMEOUT", 60))
+# Ліміти відправки в Telegram: повідомлень за секунду загалом і в один чат, допустимий сплеск для чату,
+# кількість повторів після RetryAfter, а також кількість файлів на сторінці списку для видалення
+TELEGRAM_GLOBAL_RATE = float(os.getenv("TELEGRAM_GLOBAL_RATE", 25))
+TELEGRAM_CHAT_RATE = float(os.getenv("TELEGRAM_CHAT_RATE", 1))
+TELEGRAM_CHAT_BURST = float(os.getenv("TELEGRAM_CHAT_BURST", 3))
+TELEGRAM_MAX_RETRIES = int(os.getenv("TELEGRAM_MAX_RETRIES", 5))
+FILES_PAGE_SIZE = int(os.getenv("FILES_PAGE_SIZE", 8))
+# Розсилка тестів: кількість обробників, розмір пакета доставок, спроби на одного отримувача і базова затримка повтору
+BROADCAST_WORKERS = int(os.getenv("BROADCAST_WORKERS", 2))
+BROADCAST_BATCH_SIZE = int(os.getenv("BROADCAST_BATCH_SIZE", 30))
+BROADCAST_MAX_ATTEMPTS = int(os.getenv("BROADCAST_MAX_ATTEMPTS", 5))
+BROADCAST_RETRY_DELAY = float(os.getenv("BROADCAST_RETRY_DELAY", 30))
+BROADCAST_LEASE = int(os.getenv("BROADCAST_LEASE", 300))
+# Проходження тестів: ліміт часу на тест за замовчуванням (0 — без ліміту), крок і кількість слотів колеса таймерів,
+# розмір кешу питань у пам'яті
+TEST_TIME_LIMIT_SECONDS = int(os.getenv("TEST_TIME_LIMIT_SECONDS", 0))
+TEST_TIMER_TICK = float(os.getenv("TEST_TIMER_TICK", 1))
+TEST_TIMER_SLOTS = int(os.getenv("TEST_TIMER_SLOTS", 3600))
+QUESTION_CACHE_SIZE = int(os.getenv("QUESTION_CACHE_SIZE", 5000))
+# Запис відповідей і результатів: розмір пакета, після якого буфер скидається одразу, і період скидання (секунди)
+RESULTS_FLUSH_SIZE = int(os.getenv("RESULTS_FLUSH_SIZE", 500))
+RESULTS_FLUSH_INTERVAL = float(os.getenv("RESULTS_FLUSH_INTERVAL", 2))
+# Аналітика: поріг проходження тесту (відсотки) і кількість рядків, які курсор експорту читає з БД за раз
+TEST_PASS_PERCENT = int(os.getenv("TEST_PASS_PERCENT", 70))
+EXPORT_FETCH_SIZE = int(os.getenv("EXPORT_FETCH_SIZE", 500))
+# Пул з'єднань з БД
+DB_POOL_MIN_SIZE = int(os.getenv("DB_POOL_MIN_SIZE", 2))
+DB_POOL_MAX_SIZE = int(os.getenv("DB_POOL_MAX_SIZE", 10))
+DB_COMMAND_TIMEOUT = float(os.getenv("DB_COMMAND_TIMEOUT", 30))
+DB_STATEMENT_CACHE_SIZE = int(os.getenv("DB_STATEMENT_CACHE_SIZE", 256))
+DB_MAX_INACTIVE_LIFETIME = float(os.getenv("DB_MAX_INACTIVE_LIFETIME", 300))
+# Паролі адміністраторів: параметри scrypt (N, r, p) і скільки хешів рахується одночасно в окремих потоках
+PASSWORD_SCRYPT_N = int(os.getenv("PASSWORD_SCRYPT_N", 2 ** 14))
+PASSWORD_SCRYPT_R = int(os.getenv("PASSWORD_SCRYPT_R", 8))
+PASSWORD_SCRYPT_P = int(os.getenv("PASSWORD_SCRYPT_P", 1))
+PASSWORD_HASH_WORKERS = int(os.getenv("PASSWORD_HASH_WORKERS", 2))
+# Кеш організацій за назвою: час життя запису (секунди) і максимальна кількість записів
+ORG_CACHE_TTL = float(os.getenv("ORG_CACHE_TTL", 60))
+ORG_CACHE_SIZE = int(os.getenv("ORG_CACHE_SIZE", 1024))
 if not DATABASE_URL:
     DB_USER = os.getenv("POSTGRES_USER", "postgres")
     DB_PASSWORD = os.getenv("POSTGRES_PASSWORD", "postgres")
@@ -34,8 +177,21 @@ if not DATABASE_URL:
     DB_PORT = os.getenv("POSTGRES_PORT", "5432")
     DB_NAME = os.getenv("POSTGRES_DB", "postgres")
     DATABASE_URL = f"postgresql://{DB_USER}:{DB_PASSWORD}@{DB_HOST}:{DB_PORT}/{DB_NAME}"
-# Ініціалізація OpenAI клієнта
-openai_client = AsyncOpenAI(api_key=OPENAI_API_KEY) if OPENAI_API_KEY else None
+# Клієнт OpenAI створюється під час першого запиту: імпорт SDK помітно сповільнює запуск, а потрібен лише для генерації
+openai_client = None
+def get_openai_client():
+    global openai_client
+    if openai_client is None:
+        from openai import AsyncOpenAI
+        # Повтори після 429/5xx виконує OpenAIScheduler, тому вбудовані повтори клієнта вимкнено
+        openai_client = AsyncOpenAI(api_key=OPENAI_API_KEY, max_retries=0)
+    return openai_client
+def openai_configured() -> bool:
+    return openai_client is not None or bool(OPENAI_API_KEY)
+def openai_retryable(e: Exception) -> bool:
+    """429, 5xx і помилки з'єднання OpenAI (SDK на цей момент уже імпортовано клієнтом)"""
+    from openai import APIConnectionError, InternalServerError, RateLimitError
+    return isinstance(e, (RateLimitError, InternalServerError, APIConnectionError))
 # -----------------------------------------------------------------------------
 # FSM (Машина станів) для керування діалогами
 # -----------------------------------------------------------------------------
@@ -53,6 +209,9 @@ class AdminFlow(StatesGroup):
     awaiting_file_deletion = State()
     # НОВИЙ СТАН для керування згенерованим тестом
     awaiting_ai_test_action = State()
+class UserFlow(StatesGroup):
+    waiting_org_name = State()
+    member_menu = State()
 # -----------------------------------------------------------------------------
 # Клавіатури для користувацького інтерфейсу
 # -----------------------------------------------------------------------------
@@ -85,6 +244,7 @@ def kb_tests_menu() -> ReplyKeyboardMarkup:
         keyboard=[
             [KeyboardButton(text=" 📥  Завантажити тест"), KeyboardButton(text=" 👁  Переглянути тести")],
             [KeyboardButton(text=" 🗑  Видалити тест"), KeyboardButton(text=" 🤖  Згенерувати тест ШІ")],
+            [KeyboardButton(text=" 📊  Результати")],
             [KeyboardButton(text=" 🏠  Головне меню")], # На окремому рядку
         ],
         resize_keyboard=True,
@@ -110,6 +270,45 @@ def kb_ai_test_actions() -> ReplyKeyboardMarkup:
         ],
         resize_keyboard=True,
     )
+def kb_file_listing(files: list, file_type: str, page: int) -> InlineKeyboardMarkup:
+    """Сторінка списку файлів для видалення: по кнопці на файл і навігація між сторінками"""
+    pages = max(1, -(-len(files) // FILES_PAGE_SIZE))
+    page = min(max(page, 0), pages - 1)
+    rows = [
+        [InlineKeyboardButton(
+            text=f"🗑 {file['filename']} ({file['uploaded_at'].strftime('%d.%m.%Y')})",
+            callback_data=f"delask_{file['id']}",
+        )]
+        for file in files[page * FILES_PAGE_SIZE:(page + 1) * FILES_PAGE_SIZE]
+    ]
+    if pages > 1:
+        navigation = []
+        if page > 0:
+            navigation.append(InlineKeyboardButton(text="◀️", callback_data=f"delpage_{file_type}_{page - 1}"))
+        navigation.append(InlineKeyboardButton(text=f"{page + 1}/{pages}", callback_data="delpage_noop"))
+        if page < pages - 1:
+            navigation.append(InlineKeyboardButton(text="▶️", callback_data=f"delpage_{file_type}_{page + 1}"))
+        rows.append(navigation)
+    return InlineKeyboardMarkup(inline_keyboard=rows)
+def kb_broadcast_status(broadcast_id: int) -> InlineKeyboardMarkup:
+    return InlineKeyboardMarkup(
+        inline_keyboard=[[InlineKeyboardButton(text="🔄 Оновити статус", callback_data=f"bcstatus_{broadcast_id}")]]
+    )
+def kb_results_export() -> InlineKeyboardMarkup:
+    return InlineKeyboardMarkup(
+        inline_keyboard=[[InlineKeyboardButton(text="📥 Завантажити CSV", callback_data="export_results")]]
+    )
+def kb_start_test(test_id: int) -> InlineKeyboardMarkup:
+    return InlineKeyboardMarkup(
+        inline_keyboard=[[InlineKeyboardButton(text="▶️ Пройти тест", callback_data=f"start_test_{test_id}")]]
+    )
+def kb_question_options(position: int, letters: list[str]) -> InlineKeyboardMarkup:
+    return InlineKeyboardMarkup(
+        inline_keyboard=[[
+            InlineKeyboardButton(text=letter, callback_data=f"ans_{position}_{index}")
+            for index, letter in enumerate(letters)
+        ]]
+    )
 def kb_delete_confirmation(file_id: int) -> InlineKeyboardMarkup:
     return InlineKeyboardMarkup(
         inline_keyboard=[
@@ -120,103 +319,1233 @@ def kb_delete_confirmation(file_id: int) -> InlineKeyboardMarkup:
         ]
     )
 # -----------------------------------------------------------------------------
+# Метрики у форматі Prometheus (/metrics)
+# -----------------------------------------------------------------------------
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+class Histogram:
+    __slots__ = ("buckets", "counts", "sum", "count")
+
+    def __init__(self, buckets: tuple):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.sum += value
+        self.count += 1
+        for index, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[index] += 1
+                break
+def escape_label(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+def format_labels(labels: tuple) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{name}="{escape_label(value)}"' for name, value in labels) + "}"
+class MetricsRegistry:
+    """Мінімальний реєстр лічильників, гістограм і датчиків з виводом у текстовому форматі Prometheus.
+
+    Датчики (gauge) не зберігаються, а знімаються під час запиту /metrics асинхронними колекторами."""
+    def __init__(self):
+        self._meta: dict[str, tuple[str, str]] = {}
+        self._counters: dict[str, dict[tuple, float]] = {}
+        self._histograms: dict[str, dict[tuple, Histogram]] = {}
+        self._buckets: dict[str, tuple] = {}
+        self._collectors = []
+
+    def counter(self, name: str, help_text: str):
+        self._meta[name] = ("counter", help_text)
+        self._counters[name] = {}
+
+    def histogram(self, name: str, help_text: str, buckets: tuple = LATENCY_BUCKETS):
+        self._meta[name] = ("histogram", help_text)
+        self._histograms[name] = {}
+        self._buckets[name] = buckets
+
+    def gauge(self, name: str, help_text: str):
+        self._meta[name] = ("gauge", help_text)
+
+    def collector(self, collect):
+        """collect() — корутина, що повертає список (назва, {мітки}, значення) для датчиків"""
+        self._collectors.append(collect)
+
+    def inc(self, name: str, value: float = 1, **labels):
+        series = self._counters[name]
+        key = tuple(sorted(labels.items()))
+        series[key] = series.get(key, 0) + value
+
+    def observe(self, name: str, value: float, **labels):
+        series = self._histograms[name]
+        key = tuple(sorted(labels.items()))
+        histogram = series.get(key)
+        if histogram is None:
+            histogram = series[key] = Histogram(self._buckets[name])
+        histogram.observe(value)
+
+    async def render(self) -> str:
+        gauges: dict[str, list] = {}
+        for collect in self._collectors:
+            try:
+                for name, labels, value in await collect():
+                    gauges.setdefault(name, []).append((tuple(sorted(labels.items())), value))
+            except Exception as e:
+                print(f"Помилка збору метрик: {e}")
+        lines = []
+        for name, (kind, help_text) in self._meta.items():
+            lines += [f"# HELP {name} {help_text}", f"# TYPE {name} {kind}"]
+            if kind == "counter":
+                lines += [f"{name}{format_labels(key)} {value}" for key, value in self._counters[name].items()]
+            elif kind == "gauge":
+                lines += [f"{name}{format_labels(key)} {value}" for key, value in gauges.get(name, [])]
+            else:
+                for key, histogram in self._histograms[name].items():
+                    cumulative = 0
+                    for bound, count in zip(histogram.buckets, histogram.counts):
+                        cumulative += count
+                        lines.append(f"{name}_bucket{format_labels(key + (('le', bound),))} {cumulative}")
+                    lines.append(f"{name}_bucket{format_labels(key + (('le', '+Inf'),))} {histogram.count}")
+                    lines.append(f"{name}_sum{format_labels(key)} {histogram.sum}")
+                    lines.append(f"{name}_count{format_labels(key)} {histogram.count}")
+        return "\n".join(lines) + "\n"
+metrics = MetricsRegistry()
+metrics.histogram("bot_update_seconds", "Час обробки апдейту за хендлером і станом FSM")
+metrics.counter("bot_update_errors_total", "Апдейти, обробка яких завершилась винятком")
+metrics.histogram("db_pool_acquire_seconds", "Очікування вільного з'єднання з пулу")
+metrics.histogram("password_hash_seconds", "Обчислення scrypt для паролів адміністраторів, разом з очікуванням потоку")
+metrics.gauge("db_pool_connections", "З'єднання пулу: усього, вільні та максимум")
+metrics.histogram("openai_request_seconds", "Тривалість запитів до OpenAI")
+metrics.counter("openai_tokens_total", "Використані токени OpenAI з response.usage")
+metrics.counter("openai_errors_total", "Помилки запитів до OpenAI")
+metrics.counter("openai_retries_total", "Повтори запитів до OpenAI після 429/5xx")
+metrics.histogram("telegram_request_seconds", "Тривалість викликів Telegram Bot API")
+metrics.counter("telegram_errors_total", "Помилки Telegram Bot API за методом і типом")
+metrics.counter("telegram_retry_after_total", "Відповіді RetryAfter від Telegram")
+metrics.gauge("queue_depth", "Кількість елементів у чергах і буферах")
+metrics.gauge("test_sessions_active", "Активні сесії проходження тестів")
+metrics.gauge("boot_phase_seconds", "Тривалість фаз запуску процесу")
+metrics.gauge("boot_first_update_seconds", "Час від запуску процесу до першого обробленого апдейту")
+metrics.gauge("worker_up", "Стан процесів-обробників у багатопроцесному режимі (1 — працює)")
+metrics.counter("worker_restarts_total", "Перезапуски процесів-обробників супервізором")
+class BootTimer:
+    """Тривалість фаз запуску від BOOT_STARTED і час до першого обробленого апдейту: у лог і на /metrics"""
+    def __init__(self, started: float):
+        self.started = started
+        self.last = started
+        self.phases: list[tuple[str, float]] = []
+        self.first_update: float | None = None
+        metrics.collector(self.collect)
+
+    def mark(self, phase: str):
+        now = time.perf_counter()
+        self.phases.append((phase, now - self.last))
+        self.last = now
+
+    def report(self):
+        phases = ", ".join(f"{phase} {seconds * 1000:.0f} мс" for phase, seconds in self.phases)
+        print(f"Запуск: {phases}; разом {(self.last - self.started) * 1000:.0f} мс")
+
+    def update_served(self):
+        if self.first_update is None:
+            self.first_update = time.perf_counter() - self.started
+            print(f"Перший апдейт оброблено через {self.first_update:.2f} с після запуску")
+
+    async def collect(self):
+        samples = [("boot_phase_seconds", {"phase": phase}, seconds) for phase, seconds in self.phases]
+        if self.first_update is not None:
+            samples.append(("boot_first_update_seconds", {}, self.first_update))
+        return samples
+boot_timer = BootTimer(BOOT_STARTED)
+class MetricsMiddleware(BaseMiddleware):
+    """Зовнішній middleware апдейтів: час обробки з міткою хендлера і стану FSM, у якому прийшов апдейт"""
+    async def __call__(self, handler, event, data):
+        # Бенчмарк передає власний trace через feed_update(..., metrics_trace=...), щоб знати обраний хендлер
+        trace = data.setdefault("metrics_trace", {"handler": "unhandled"})
+        started = time.perf_counter()
+        try:
+            return await handler(event, data)
+        except Exception:
+            metrics.inc("bot_update_errors_total", handler=trace["handler"])
+            raise
+        finally:
+            metrics.observe(
+                "bot_update_seconds", time.perf_counter() - started,
+                handler=trace["handler"], state=data.get("raw_state") or "none",
+            )
+            boot_timer.update_served()
+class HandlerNameMiddleware(BaseMiddleware):
+    """Внутрішній middleware роутера: повідомляє MetricsMiddleware, який хендлер обрано"""
+    async def __call__(self, handler, event, data):
+        trace = data.get("metrics_trace")
+        if trace is not None:
+            trace["handler"] = data["handler"].callback.__name__
+        return await handler(event, data)
+class TelegramMetricsMiddleware(BaseRequestMiddleware):
+    """Middleware сесії бота: тривалість кожного виклику API, помилки і RetryAfter"""
+    async def __call__(self, make_request, bot, method):
+        name = type(method).__name__
+        started = time.perf_counter()
+        try:
+            return await make_request(bot, method)
+        except TelegramRetryAfter:
+            metrics.inc("telegram_retry_after_total", method=name)
+            raise
+        except TelegramAPIError as e:
+            metrics.inc("telegram_errors_total", method=name, error=type(e).__name__)
+            raise
+        finally:
+            metrics.observe("telegram_request_seconds", time.perf_counter() - started, method=name)
+def record_openai_usage(usage):
+    if usage:
+        metrics.inc("openai_tokens_total", usage.prompt_tokens, type="prompt")
+        metrics.inc("openai_tokens_total", usage.completion_tokens, type="completion")
+# -----------------------------------------------------------------------------
 # Функції для роботи з базою даних
 # -----------------------------------------------------------------------------
-async def setup_database(pool: asyncpg.Pool):
-    """Створює необхідні таблиці, якщо вони не існують."""
+# Версійовані міграції схеми: (версія, опис, SQL). Зміни схеми додаються лише новими записами в кінець списку.
+# Перші міграції використовують IF NOT EXISTS, бо на старих базах ці таблиці вже створені попередньою версією бота.
+MIGRATIONS = [
+    (1, "організації та файли", """
+        CREATE TABLE IF NOT EXISTS orgs (
+            id SERIAL PRIMARY KEY,
+            name TEXT NOT NULL UNIQUE,
+            admin_password_hash TEXT NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS files (
+            id SERIAL PRIMARY KEY,
+            org_id INTEGER NOT NULL REFERENCES orgs(id) ON DELETE CASCADE,
+            file_type TEXT NOT NULL CHECK (file_type IN ('material', 'test')),
+            file_id TEXT NOT NULL,
+            filename TEXT NOT NULL,
+            uploaded_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+        );
+    """),
+    (2, "кеш тексту матеріалів", """
+        ALTER TABLE files ADD COLUMN IF NOT EXISTS file_unique_id TEXT;
+        ALTER TABLE files ADD COLUMN IF NOT EXISTS mime_type TEXT;
+        CREATE TABLE IF NOT EXISTS file_texts (
+            file_unique_id TEXT PRIMARY KEY,
+            content_hash TEXT NOT NULL,
+            content TEXT NOT NULL,
+            size_bytes INTEGER NOT NULL,
+            last_used_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+        );
+    """),
+    (3, "черга генерації тестів", """
+        CREATE TABLE IF NOT EXISTS generation_jobs (
+            id BIGSERIAL PRIMARY KEY,
+            org_id INTEGER NOT NULL REFERENCES orgs(id) ON DELETE CASCADE,
+            chat_id BIGINT NOT NULL,
+            user_id BIGINT NOT NULL,
+            num_questions INTEGER NOT NULL,
+            bypass_cache BOOLEAN NOT NULL DEFAULT FALSE,
+            state TEXT NOT NULL DEFAULT 'queued' CHECK (state IN ('queued', 'running', 'done', 'failed')),
+            attempts INTEGER NOT NULL DEFAULT 0,
+            run_after TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+            locked_until TIMESTAMPTZ,
+            last_error TEXT,
+            result TEXT,
+            created_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+            updated_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+        );
+        CREATE INDEX IF NOT EXISTS generation_jobs_pending_idx ON generation_jobs (run_after) WHERE state IN ('queued', 'running');
+        -- Не більше одного активного завдання на чат
+        CREATE UNIQUE INDEX IF NOT EXISTS generation_jobs_active_chat_idx ON generation_jobs (chat_id) WHERE state IN ('queued', 'running');
+    """),
+    (4, "стани FSM", """
+        CREATE TABLE IF NOT EXISTS fsm_sessions (
+            key TEXT PRIMARY KEY,
+            state TEXT,
+            data JSONB NOT NULL DEFAULT '{}',
+            updated_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+        );
+        CREATE INDEX IF NOT EXISTS fsm_sessions_updated_idx ON fsm_sessions (updated_at);
+        CREATE TABLE IF NOT EXISTS fsm_blobs (
+            key TEXT NOT NULL REFERENCES fsm_sessions(key) ON DELETE CASCADE,
+            field TEXT NOT NULL,
+            value TEXT NOT NULL,
+            PRIMARY KEY (key, field)
+        );
+    """),
+    (5, "індекси для списків файлів", """
+        -- Покриває фільтр і сортування get_files_by_type / count_files_by_type
+        CREATE INDEX IF NOT EXISTS files_org_type_uploaded_idx ON files (org_id, file_type, uploaded_at DESC);
+        CREATE INDEX IF NOT EXISTS files_file_unique_id_idx ON files (file_unique_id);
+    """),
+    (6, "отримувачі та розсилки", """
+        CREATE TABLE recipients (
+            org_id INTEGER NOT NULL REFERENCES orgs(id) ON DELETE CASCADE,
+            chat_id BIGINT NOT NULL,
+            user_id BIGINT NOT NULL,
+            full_name TEXT,
+            active BOOLEAN NOT NULL DEFAULT TRUE,
+            joined_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+            PRIMARY KEY (org_id, chat_id)
+        );
+        CREATE TABLE broadcasts (
+            id BIGSERIAL PRIMARY KEY,
+            org_id INTEGER NOT NULL REFERENCES orgs(id) ON DELETE CASCADE,
+            created_by BIGINT NOT NULL,
+            document_file_id TEXT NOT NULL,
+            caption TEXT,
+            state TEXT NOT NULL DEFAULT 'sending' CHECK (state IN ('sending', 'done')),
+            total INTEGER NOT NULL DEFAULT 0,
+            sent INTEGER NOT NULL DEFAULT 0,
+            failed INTEGER NOT NULL DEFAULT 0,
+            created_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+            finished_at TIMESTAMPTZ
+        );
+        CREATE TABLE broadcast_deliveries (
+            broadcast_id BIGINT NOT NULL REFERENCES broadcasts(id) ON DELETE CASCADE,
+            chat_id BIGINT NOT NULL,
+            state TEXT NOT NULL DEFAULT 'pending' CHECK (state IN ('pending', 'sending', 'sent', 'failed')),
+            attempts INTEGER NOT NULL DEFAULT 0,
+            run_after TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+            locked_until TIMESTAMPTZ,
+            last_error TEXT,
+            PRIMARY KEY (broadcast_id, chat_id)
+        );
+        CREATE INDEX broadcast_deliveries_pending_idx ON broadcast_deliveries (run_after) WHERE state IN ('pending', 'sending');
+    """),
+    (7, "структуровані тести", """
+        CREATE TABLE tests (
+            id BIGSERIAL PRIMARY KEY,
+            org_id INTEGER NOT NULL REFERENCES orgs(id) ON DELETE CASCADE,
+            title TEXT NOT NULL,
+            source TEXT NOT NULL CHECK (source IN ('generated', 'uploaded')),
+            file_row_id INTEGER REFERENCES files(id) ON DELETE CASCADE,
+            question_count INTEGER NOT NULL,
+            created_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+        );
+        CREATE INDEX tests_org_idx ON tests (org_id, created_at DESC);
+        CREATE TABLE questions (
+            test_id BIGINT NOT NULL REFERENCES tests(id) ON DELETE CASCADE,
+            position INTEGER NOT NULL,
+            text TEXT NOT NULL,
+            correct_option CHAR(1) NOT NULL,
+            PRIMARY KEY (test_id, position)
+        );
+        CREATE TABLE options (
+            test_id BIGINT NOT NULL,
+            position INTEGER NOT NULL,
+            letter CHAR(1) NOT NULL,
+            text TEXT NOT NULL,
+            PRIMARY KEY (test_id, position, letter),
+            FOREIGN KEY (test_id, position) REFERENCES questions(test_id, position) ON DELETE CASCADE
+        );
+    """),
+    (8, "ліміт часу тестів і тест у розсилці", """
+        ALTER TABLE tests ADD COLUMN time_limit_seconds INTEGER;
+        ALTER TABLE broadcasts ADD COLUMN test_id BIGINT REFERENCES tests(id) ON DELETE SET NULL;
+    """),
+    (9, "відповіді та результати проходження тестів", """
+        CREATE TABLE test_answers (
+            session_id UUID NOT NULL,
+            position SMALLINT NOT NULL,
+            test_id BIGINT NOT NULL REFERENCES tests(id) ON DELETE CASCADE,
+            org_id INTEGER NOT NULL,
+            chat_id BIGINT NOT NULL,
+            question_position SMALLINT NOT NULL,
+            answer CHAR(1) NOT NULL,
+            is_correct BOOLEAN NOT NULL,
+            answered_at TIMESTAMPTZ NOT NULL,
+            PRIMARY KEY (session_id, position)
+        );
+        CREATE INDEX test_answers_test_idx ON test_answers (test_id, question_position);
+        CREATE TABLE test_results (
+            session_id UUID PRIMARY KEY,
+            test_id BIGINT NOT NULL REFERENCES tests(id) ON DELETE CASCADE,
+            org_id INTEGER NOT NULL,
+            chat_id BIGINT NOT NULL,
+            user_id BIGINT NOT NULL,
+            score INTEGER NOT NULL,
+            total INTEGER NOT NULL,
+            timed_out BOOLEAN NOT NULL,
+            started_at TIMESTAMPTZ NOT NULL,
+            finished_at TIMESTAMPTZ NOT NULL
+        );
+        CREATE INDEX test_results_org_idx ON test_results (org_id, finished_at DESC);
+    """),
+    (10, "агрегати результатів тестів", """
+        CREATE TABLE test_stats (
+            test_id BIGINT PRIMARY KEY REFERENCES tests(id) ON DELETE CASCADE,
+            org_id INTEGER NOT NULL,
+            attempts INTEGER NOT NULL DEFAULT 0,
+            passed INTEGER NOT NULL DEFAULT 0,
+            score_sum BIGINT NOT NULL DEFAULT 0,
+            total_sum BIGINT NOT NULL DEFAULT 0
+        );
+        CREATE INDEX test_stats_org_idx ON test_stats (org_id);
+        CREATE TABLE question_stats (
+            test_id BIGINT NOT NULL REFERENCES tests(id) ON DELETE CASCADE,
+            question_position SMALLINT NOT NULL,
+            answered INTEGER NOT NULL DEFAULT 0,
+            correct INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (test_id, question_position)
+        );
+        CREATE TABLE employee_stats (
+            org_id INTEGER NOT NULL,
+            user_id BIGINT NOT NULL,
+            chat_id BIGINT NOT NULL,
+            attempts INTEGER NOT NULL DEFAULT 0,
+            passed INTEGER NOT NULL DEFAULT 0,
+            score_sum BIGINT NOT NULL DEFAULT 0,
+            total_sum BIGINT NOT NULL DEFAULT 0,
+            last_finished_at TIMESTAMPTZ,
+            PRIMARY KEY (org_id, user_id)
+        );
+    """),
+    (11, "фрагменти матеріалів для індексу", """
+        CREATE TABLE material_chunks (
+            file_row_id INTEGER NOT NULL REFERENCES files(id) ON DELETE CASCADE,
+            position INTEGER NOT NULL,
+            org_id INTEGER NOT NULL,
+            content TEXT NOT NULL,
+            PRIMARY KEY (file_row_id, position)
+        );
+        CREATE INDEX material_chunks_org_idx ON material_chunks (org_id);
+    """),
+    (12, "відбитки згенерованих питань", """
+        CREATE TABLE question_signatures (
+            id BIGSERIAL PRIMARY KEY,
+            org_id INTEGER NOT NULL REFERENCES orgs(id) ON DELETE CASCADE,
+            signature BYTEA NOT NULL
+        );
+        CREATE INDEX question_signatures_org_idx ON question_signatures (org_id, id DESC);
+    """),
+    (13, "квоти і облік токенів OpenAI", """
+        ALTER TABLE orgs ADD COLUMN daily_token_quota INTEGER;
+        CREATE TABLE openai_usage (
+            org_id INTEGER NOT NULL REFERENCES orgs(id) ON DELETE CASCADE,
+            day DATE NOT NULL,
+            tokens BIGINT NOT NULL DEFAULT 0,
+            PRIMARY KEY (org_id, day)
+        );
+    """),
+    (14, "пошук кешованого тексту за вмістом файлу", """
+        CREATE INDEX file_texts_content_hash_idx ON file_texts (content_hash);
+    """),
+    (15, "версія сесії FSM для перевірки кешу", """
+        ALTER TABLE fsm_sessions ADD COLUMN version BIGINT NOT NULL DEFAULT 0;
+    """),
+    (16, "перегляд тесту адміністратором", """
+        ALTER TABLE test_results ADD COLUMN preview BOOLEAN NOT NULL DEFAULT FALSE;
+    """),
+]
+MIGRATIONS_LOCK_ID = 0x436F7270  # ключ advisory lock, щоб міграції не запускались паралельно з кількох реплік
+async def schema_is_current(con: asyncpg.Connection) -> bool:
+    """Усі міграції вже застосовано — DDL і блокування можна пропустити"""
+    if not await con.fetchval("SELECT to_regclass('schema_migrations') IS NOT NULL"):
+        return False
+    versions = [version for version, _, _ in MIGRATIONS]
+    return await con.fetchval("SELECT count(*) FROM schema_migrations WHERE version = ANY($1::int[])", versions) == len(versions)
+async def setup_database(pool: asyncpg.Pool) -> bool:
+    """Застосовує міграції схеми, яких ще немає в таблиці schema_migrations. False — схема вже актуальна."""
     async with pool.acquire() as con:
-        await con.execute("""
-            CREATE TABLE IF NOT EXISTS orgs (
-                id SERIAL PRIMARY KEY,
-                name TEXT NOT NULL UNIQUE,
-                admin_password_hash TEXT NOT NULL
-            );
-        """)
-        await con.execute("""
-            CREATE TABLE IF NOT EXISTS files (
-                id SERIAL PRIMARY KEY,
-                org_id INTEGER NOT NULL REFERENCES orgs(id) ON DELETE CASCADE,
-                file_type TEXT NOT NULL CHECK (file_type IN ('material', 'test')),
-                file_id TEXT NOT NULL,
-                filename TEXT NOT NULL,
-                uploaded_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
-            );
-        """)
+        if await schema_is_current(con):
+            return False
+        await con.execute("SELECT pg_advisory_lock($1)", MIGRATIONS_LOCK_ID)
+        try:
+            await con.execute("""
+                CREATE TABLE IF NOT EXISTS schema_migrations (
+                    version INTEGER PRIMARY KEY,
+                    description TEXT NOT NULL,
+                    applied_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+                );
+            """)
+            applied = {row["version"] for row in await con.fetch("SELECT version FROM schema_migrations")}
+            for version, description, sql in MIGRATIONS:
+                if version in applied:
+                    continue
+                async with con.transaction():
+                    await con.execute(sql)
+                    await con.execute(
+                        "INSERT INTO schema_migrations (version, description) VALUES ($1, $2)", version, description
+                    )
+                print(f"Застосовано міграцію {version}: {description}")
+        finally:
+            await con.execute("SELECT pg_advisory_unlock($1)", MIGRATIONS_LOCK_ID)
+    return True
+# Запити гарячого шляху: кеш запитів asyncpg (statement_cache_size) готує кожен з них один раз на з'єднання,
+# далі вони виконуються без повторного розбору
+HOT_QUERIES = {
+    "get_org": "SELECT * FROM orgs WHERE name = $1",
+    "fsm_version": "SELECT version FROM fsm_sessions WHERE key = $1 AND updated_at > NOW() - make_interval(secs => $2)",
+    "upgrade_org_password": "UPDATE orgs SET admin_password_hash = $2 WHERE id = $1 AND admin_password_hash = $3 RETURNING *",
+    "insert_file": "INSERT INTO files (org_id, file_type, file_id, filename, file_unique_id, mime_type) VALUES ($1, $2, $3, $4, $5, $6) RETURNING id",
+    "files_by_type": "SELECT * FROM files WHERE org_id = $1 AND file_type = $2 ORDER BY uploaded_at DESC",
+    "count_files_by_type": "SELECT COUNT(*) FROM files WHERE org_id = $1 AND file_type = $2",
+    "get_file": "SELECT * FROM files WHERE id = $1",
+    "delete_file": "DELETE FROM files WHERE id = $1 AND org_id = $2 RETURNING *",
+    "get_question": """
+        SELECT q.text, q.correct_option, array_agg(o.letter ORDER BY o.letter) AS letters, array_agg(o.text ORDER BY o.letter) AS option_texts
+        FROM questions q JOIN options o ON o.test_id = q.test_id AND o.position = q.position
+        WHERE q.test_id = $1 AND q.position = $2
+        GROUP BY q.test_id, q.position
+    """,
+    "get_test": "SELECT id, org_id, title, question_count, time_limit_seconds FROM tests WHERE id = $1",
+    "get_openai_quota": """
+        SELECT COALESCE(o.daily_token_quota, $2) AS quota, COALESCE(u.tokens, 0) AS used
+        FROM orgs o LEFT JOIN openai_usage u ON u.org_id = o.id AND u.day = CURRENT_DATE
+        WHERE o.id = $1
+    """,
+    "add_openai_usage": """
+        INSERT INTO openai_usage (org_id, day, tokens) VALUES ($1, CURRENT_DATE, $2)
+        ON CONFLICT (org_id, day) DO UPDATE SET tokens = openai_usage.tokens + EXCLUDED.tokens
+    """,
+    "touch_file_text": "UPDATE file_texts SET last_used_at = NOW() WHERE file_unique_id = $1 RETURNING content_hash, content",
+}
+class TimedPool:
+    """Пул asyncpg, що вимірює час очікування вільного з'єднання. Працює лише через публічні acquire/release,
+    решта атрибутів (close, get_size тощо) береться з самого пулу"""
+    def __init__(self, pool: asyncpg.Pool):
+        self._pool = pool
+
+    def __getattr__(self, name):
+        return getattr(self._pool, name)
+
+    @contextlib.asynccontextmanager
+    async def acquire(self, *, timeout: float | None = None):
+        started = time.perf_counter()
+        try:
+            con = await self._pool.acquire(timeout=timeout)
+        finally:
+            metrics.observe("db_pool_acquire_seconds", time.perf_counter() - started)
+        try:
+            yield con
+        finally:
+            await self._pool.release(con)
+async def prepare_hot_queries(con: asyncpg.Connection):
+    """init пулу: кожне нове з'єднання одразу готує читальні HOT_QUERIES. Під час створення пулу DB_POOL_MIN_SIZE
+    з'єднань відкриваються паралельно, тож перші апдейти отримують теплі з'єднання з готовими запитами.
+    Запит потрапляє в кеш з'єднання (statement_cache_size) лише після виконання, тому SELECT виконуються
+    з NULL-параметрами (порожній результат), а запити на запис готуються при першому використанні"""
+    if not await schema_is_current(con):
+        return  # міграції ще не застосовано
+    for query in HOT_QUERIES.values():
+        if query.lstrip().upper().startswith("SELECT"):
+            params = max((int(n) for n in re.findall(r"\$(\d+)", query)), default=0)
+            await con.fetch(query, *[None] * params)
+async def create_db_pool() -> TimedPool:
+    pool = await asyncpg.create_pool(
+        DATABASE_URL,
+        min_size=DB_POOL_MIN_SIZE,
+        max_size=DB_POOL_MAX_SIZE,
+        command_timeout=DB_COMMAND_TIMEOUT,
+        statement_cache_size=DB_STATEMENT_CACHE_SIZE,
+        max_inactive_connection_lifetime=DB_MAX_INACTIVE_LIFETIME,
+        init=prepare_hot_queries,
+    )
+    return TimedPool(pool)
+# -----------------------------------------------------------------------------
+# Організації: кеш за назвою і паролі адміністраторів
+# -----------------------------------------------------------------------------
+class OrgCache:
+    """Кеш знайдених організацій за назвою з часом життя ORG_CACHE_TTL.
+    Відсутні організації не кешуються, щоб щойно створену одразу було видно."""
+    def __init__(self, ttl: float, max_size: int):
+        self.ttl = ttl
+        self.max_size = max_size
+        self._entries: OrderedDict[str, tuple[float, asyncpg.Record]] = OrderedDict()
+
+    def get(self, org_name: str) -> asyncpg.Record | None:
+        entry = self._entries.get(org_name)
+        if not entry:
+            return None
+        if entry[0] < time.monotonic():
+            del self._entries[org_name]
+            return None
+        self._entries.move_to_end(org_name)
+        return entry[1]
+
+    def put(self, org: asyncpg.Record):
+        self._entries[org["name"]] = (time.monotonic() + self.ttl, org)
+        self._entries.move_to_end(org["name"])
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def invalidate(self, org_name: str):
+        self._entries.pop(org_name, None)
+org_cache = OrgCache(ORG_CACHE_TTL, ORG_CACHE_SIZE)
 async def get_org(con: asyncpg.Connection, org_name: str) -> asyncpg.Record | None:
-    return await con.fetchrow("SELECT * FROM orgs WHERE name = $1", org_name)
-async def create_org(con: asyncpg.Connection, org_name: str, password: str) -> asyncpg.Record:
-    return await con.fetchrow(
+    return await con.fetchrow(HOT_QUERIES["get_org"], org_name)
+async def find_org(pool: asyncpg.Pool, org_name: str) -> asyncpg.Record | None:
+    """Організація за назвою: спершу з кешу, інакше з БД (з'єднання береться лише за промаху)"""
+    org = org_cache.get(org_name)
+    if org is None:
+        async with pool.acquire() as con:
+            org = await get_org(con, org_name)
+        if org:
+            org_cache.put(org)
+    return org
+async def create_org(con: asyncpg.Connection, org_name: str, password_hash: str) -> asyncpg.Record:
+    """password_hash рахується заздалегідь (hash_password), щоб не тримати з'єднання під час scrypt"""
+    org = await con.fetchrow(
         "INSERT INTO orgs (name, admin_password_hash) VALUES ($1, $2) RETURNING *",
         org_name,
-        password,
+        password_hash,
     )
+    org_cache.invalidate(org_name)
+    org_cache.put(org)
+    return org
+# scrypt звільняє GIL, тож хешування йде в окремих потоках і не блокує цикл подій.
+# Семафор обмежує чергу: під час масових входів решта запитів чекає, а не множить потоки.
+password_executor = ThreadPoolExecutor(max_workers=PASSWORD_HASH_WORKERS, thread_name_prefix="password")
+password_slots = asyncio.Semaphore(PASSWORD_HASH_WORKERS)
+def scrypt_hash(password: str, salt: bytes, n: int, r: int, p: int) -> bytes:
+    return hashlib.scrypt(password.encode("utf-8"), salt=salt, n=n, r=r, p=p, maxmem=256 * r * (n + p + 2), dklen=32)
+async def run_scrypt(password: str, salt: bytes, n: int, r: int, p: int) -> bytes:
+    async with password_slots:
+        started = time.perf_counter()
+        digest = await asyncio.get_running_loop().run_in_executor(password_executor, scrypt_hash, password, salt, n, r, p)
+        metrics.observe("password_hash_seconds", time.perf_counter() - started)
+        return digest
+async def hash_password(password: str) -> str:
+    """Повертає рядок виду scrypt$N$r$p$сіль$хеш (сіль і хеш у base64)"""
+    n, r, p = PASSWORD_SCRYPT_N, PASSWORD_SCRYPT_R, PASSWORD_SCRYPT_P
+    salt = os.urandom(16)
+    digest = await run_scrypt(password, salt, n, r, p)
+    return f"scrypt${n}${r}${p}${base64.b64encode(salt).decode()}${base64.b64encode(digest).decode()}"
+def password_needs_upgrade(stored: str) -> bool:
+    """Пароль збережено відкритим текстом або зі старими параметрами scrypt"""
+    return not stored.startswith(f"scrypt${PASSWORD_SCRYPT_N}${PASSWORD_SCRYPT_R}${PASSWORD_SCRYPT_P}$")
 async def check_password(org: asyncpg.Record, password: str) -> bool:
-    return org["admin_password_hash"] == password
-async def save_file_to_db(pool: asyncpg.Pool, org_id: int, file_type: str, file_id: str, filename: str):
+    stored = org["admin_password_hash"]
+    if not stored.startswith("scrypt$"):
+        # Організації, створені до переходу на scrypt, зберігають пароль як є
+        return hmac.compare_digest(stored.encode("utf-8"), password.encode("utf-8"))
+    try:
+        _, n, r, p, salt, expected = stored.split("$")
+        digest = await run_scrypt(password, base64.b64decode(salt), int(n), int(r), int(p))
+    except ValueError:
+        return False
+    return hmac.compare_digest(digest, base64.b64decode(expected))
+async def upgrade_org_password(pool: asyncpg.Pool, org: asyncpg.Record, password: str):
+    """Після успішного входу переписує відкритий або застарілий пароль у поточний формат scrypt"""
+    new_hash = await hash_password(password)
     async with pool.acquire() as con:
-        await con.execute(
-            "INSERT INTO files (org_id, file_type, file_id, filename) VALUES ($1, $2, $3, $4)",
-            org_id,
-            file_type,
-            file_id,
-            filename,
-        )
+        # Умова на старе значення: якщо пароль тим часом змінили, нічого не перезаписуємо
+        updated = await con.fetchrow(HOT_QUERIES["upgrade_org_password"], org["id"], new_hash, org["admin_password_hash"])
+    org_cache.invalidate(org["name"])
+    if updated:
+        org_cache.put(updated)
+async def save_file_to_db(pool: asyncpg.Pool, org_id: int, file_type: str, file_id: str, filename: str, file_unique_id: str | None = None, mime_type: str | None = None) -> int:
+    async with pool.acquire() as con:
+        return await con.fetchval(HOT_QUERIES["insert_file"], org_id, file_type, file_id, filename, file_unique_id, mime_type)
 async def get_files_by_type(pool: asyncpg.Pool, org_id: int, file_type: str):
     async with pool.acquire() as con:
-        return await con.fetch(
-            "SELECT * FROM files WHERE org_id = $1 AND file_type = $2 ORDER BY uploaded_at DESC",
-            org_id,
-            file_type,
-        )
+        return await con.fetch(HOT_QUERIES["files_by_type"], org_id, file_type)
 async def count_files_by_type(pool: asyncpg.Pool, org_id: int, file_type: str) -> int:
     async with pool.acquire() as con:
-        result = await con.fetchval(
-            "SELECT COUNT(*) FROM files WHERE org_id = $1 AND file_type = $2",
-            org_id,
-            file_type,
-        )
+        result = await con.fetchval(HOT_QUERIES["count_files_by_type"], org_id, file_type)
         return result or 0
-async def delete_file_by_id(pool: asyncpg.Pool, file_id: int):
+async def delete_file_by_id(pool: asyncpg.Pool, file_id: int, org_id: int | None) -> asyncpg.Record | None:
+    """Видаляє файл організації за один запит і повертає видалений запис (None, якщо файлу вже немає
+    або він належить іншій організації)"""
     async with pool.acquire() as con:
-        await con.execute("DELETE FROM files WHERE id = $1", file_id)
+        return await con.fetchrow(HOT_QUERIES["delete_file"], file_id, org_id)
 async def get_file_by_id(pool: asyncpg.Pool, file_id: int):
     async with pool.acquire() as con:
-        return await con.fetchrow("SELECT * FROM files WHERE id = $1", file_id)
+        return await con.fetchrow(HOT_QUERIES["get_file"], file_id)
 # -----------------------------------------------------------------------------
-# Функції для роботи з OpenAI
+# Сховище станів FSM у Postgres
 # -----------------------------------------------------------------------------
-async def download_file_content(bot: Bot, file_id: str) -> str:
-    """Завантажує файл з Telegram і повертає його текстовий вміст"""
-    try:
-        file = await bot.get_file(file_id)
-        file_path = file.file_path
+class CachedSession:
+    __slots__ = ("state", "data", "blob_hashes", "touched", "dirty", "version")
+
+    def __init__(self, state: str | None, data: dict, blob_hashes: dict[str, str], touched: float, version: int = 0):
+        self.state = state
+        self.data = data
+        self.blob_hashes = blob_hashes  # поле -> хеш значення, яке вже лежить у fsm_blobs
+        self.touched = touched
+        self.dirty = False
+        self.version = version  # fsm_sessions.version, з якою збігається кеш (0 — рядка немає)
+class PostgresStorage(BaseStorage):
+    """FSM-сховище на пулі asyncpg: гарячий кеш у пам'яті, відкладений запис змін одним upsert,
+    видалення неактивних сесій за TTL і зберігання великих значень окремо від основного рядка.
+
+    Кожен запис збільшує fsm_sessions.version. Перед використанням кешованої сесії її версія звіряється з БД
+    одним запитом за первинним ключем, тож сесію, змінену іншою реплікою, буде перечитано."""
+    def __init__(self, pool: asyncpg.Pool):
+        self.pool = pool
+        self._sessions: dict[str, CachedSession] = {}
+        self._dirty: set[str] = set()
+        self._flush_lock = asyncio.Lock()
+        self._task: asyncio.Task | None = None
+
+    @staticmethod
+    def _key(key: StorageKey) -> str:
+        return f"{key.bot_id}:{key.chat_id}:{key.user_id}:{key.thread_id or ''}:{key.business_connection_id or ''}:{key.destiny}"
 
-        # Завантажуємо файл
-        file_bytes = await bot.download_file(file_path)
+    async def _load(self, key: StorageKey) -> CachedSession:
+        skey = self._key(key)
+        now = asyncio.get_running_loop().time()
+        session = self._sessions.get(skey)
+        if session:
+            session.touched = now
+            if session.dirty:
+                return session  # незаписані зміни цього процесу новіші за БД
+            async with self.pool.acquire() as con:
+                version = await con.fetchval(HOT_QUERIES["fsm_version"], skey, FSM_SESSION_TTL)
+            if (version or 0) == session.version or session.dirty:
+                return session
+            del self._sessions[skey]  # сесію змінила інша репліка — перечитуємо
+        async with self.pool.acquire() as con:
+            row = await con.fetchrow(
+                """
+                SELECT s.state, s.data::text AS data, s.version,
+                       COALESCE(jsonb_object_agg(b.field, b.value) FILTER (WHERE b.field IS NOT NULL), '{}')::text AS blobs
+                FROM fsm_sessions s LEFT JOIN fsm_blobs b ON b.key = s.key
+                WHERE s.key = $1 AND s.updated_at > NOW() - make_interval(secs => $2)
+                GROUP BY s.key
+                """,
+                skey,
+                FSM_SESSION_TTL,
+            )
+        session = self._sessions.get(skey)  # поки чекали на БД, сесію міг створити інший обробник
+        if session:
+            return session
+        if row:
+            data, blobs = json.loads(row["data"]), json.loads(row["blobs"])
+            for field, value in data.items():
+                if isinstance(value, dict) and "__blob__" in value:
+                    data[field] = blobs.get(field)
+            hashes = {field: hashlib.sha256(value.encode("utf-8")).hexdigest() for field, value in blobs.items()}
+            session = CachedSession(row["state"], data, hashes, now, row["version"])
+        else:
+            session = CachedSession(None, {}, {}, now)
+        self._sessions[skey] = session
+        return session
+
+    def _mark_dirty(self, key: StorageKey, session: CachedSession):
+        session.dirty = True
+        self._dirty.add(self._key(key))
+
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        session = await self._load(key)
+        session.state = state.state if isinstance(state, State) else state
+        self._mark_dirty(key, session)
+
+    async def get_state(self, key: StorageKey) -> str | None:
+        return (await self._load(key)).state
+
+    async def set_data(self, key: StorageKey, data: dict) -> None:
+        session = await self._load(key)
+        session.data = copy.deepcopy(data)
+        self._mark_dirty(key, session)
+
+    async def get_data(self, key: StorageKey) -> dict:
+        return copy.deepcopy((await self._load(key)).data)
+
+    async def flush(self):
+        """Записує всі змінені сесії в БД одним пакетом"""
+        async with self._flush_lock:
+            if not self._dirty:
+                return
+            keys, self._dirty = self._dirty, set()
+            rows, blob_upserts, blob_fields, snapshots = [], [], [], []
+            for skey in keys:
+                session = self._sessions.get(skey)
+                if not session:
+                    continue
+                session.dirty = False
+                inline, hashes = {}, {}
+                for field, value in session.data.items():
+                    if isinstance(value, str) and len(value) >= FSM_BLOB_THRESHOLD:
+                        inline[field] = {"__blob__": True}
+                        hashes[field] = hashlib.sha256(value.encode("utf-8")).hexdigest()
+                        # Велике значення переписуємо лише тоді, коли воно змінилося
+                        if session.blob_hashes.get(field) != hashes[field]:
+                            blob_upserts.append((skey, field, value))
+                    else:
+                        inline[field] = value
+                rows.append((skey, session.state, json.dumps(inline, ensure_ascii=False)))
+                blob_fields.append((skey, list(hashes)))
+                snapshots.append((session, hashes))
+            versions = []
+            try:
+                async with self.pool.acquire() as con:
+                    async with con.transaction():
+                        if rows:
+                            versions = await con.fetch(
+                                """
+                                INSERT INTO fsm_sessions (key, state, data, updated_at, version)
+                                SELECT key, state, data::jsonb, NOW(), 1 FROM unnest($1::text[], $2::text[], $3::text[]) AS r(key, state, data)
+                                ON CONFLICT (key) DO UPDATE
+                                SET state = EXCLUDED.state, data = EXCLUDED.data, updated_at = NOW(),
+                                    version = fsm_sessions.version + 1
+                                RETURNING key, version
+                                """,
+                                *map(list, zip(*rows)),
+                            )
+                        await con.executemany(
+                            "DELETE FROM fsm_blobs WHERE key = $1 AND NOT (field = ANY($2::text[]))", blob_fields
+                        )
+                        if blob_upserts:
+                            await con.executemany(
+                                """
+                                INSERT INTO fsm_blobs (key, field, value) VALUES ($1, $2, $3)
+                                ON CONFLICT (key, field) DO UPDATE SET value = EXCLUDED.value
+                                """,
+                                blob_upserts,
+                            )
+            except Exception:
+                # Повертаємо сесії в чергу на запис, щоб не втратити зміни
+                self._dirty |= keys
+                raise
+            for session, hashes in snapshots:
+                session.blob_hashes = hashes
+            for row in versions:
+                session = self._sessions.get(row["key"])
+                if session:
+                    session.version = row["version"]
+
+    async def expire(self):
+        """Прибирає з пам'яті неактивні сесії та видаляє з БД сесії, старші за TTL"""
+        deadline = asyncio.get_running_loop().time() - FSM_CACHE_IDLE
+        for skey in [k for k, v in self._sessions.items() if v.touched < deadline and not v.dirty and k not in self._dirty]:
+            del self._sessions[skey]
+        async with self.pool.acquire() as con:
+            await con.execute(
+                "DELETE FROM fsm_sessions WHERE updated_at < NOW() - make_interval(secs => $1)", FSM_SESSION_TTL
+            )
+
+    def start(self):
+        self._task = asyncio.create_task(self._background())
+
+    async def _background(self):
+        ticks = 0
+        while True:
+            await asyncio.sleep(FSM_FLUSH_INTERVAL)
+            ticks += 1
+            try:
+                await self.flush()
+                if ticks * FSM_FLUSH_INTERVAL >= 60:
+                    ticks = 0
+                    await self.expire()
+            except Exception as e:
+                print(f"Помилка збереження станів FSM: {e}")
 
-        # Спробуємо прочитати як текст
+    async def close(self) -> None:
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        await self.flush()
+class FSMFlushMiddleware(BaseMiddleware):
+    """Після обробки апдейту записує всі зміни FSM, зроблені хендлером, одним пакетом"""
+    def __init__(self, storage: PostgresStorage):
+        self.storage = storage
+
+    async def __call__(self, handler, event, data):
         try:
-            content = file_bytes.read().decode('utf-8')
-        except:
-            # Якщо не вдалося декодувати як UTF-8, спробуємо інші кодування
-            file_bytes.seek(0)
+            return await handler(event, data)
+        finally:
             try:
-                content = file_bytes.read().decode('cp1251')
-            except:
-                file_bytes.seek(0)
-                content = file_bytes.read().decode('latin-1')
+                await self.storage.flush()
+            except Exception as e:
+                print(f"Помилка збереження станів FSM: {e}")
+# -----------------------------------------------------------------------------
+# Витягування тексту з документів (PDF / DOCX / TXT)
+# -----------------------------------------------------------------------------
+class ExtractionError(Exception):
+    """Файл неможливо перетворити на текст (непідтримуваний формат, завеликий, пошкоджений)."""
+def decode_text(raw: bytes) -> str:
+    """Декодує байти файлу як текст, перебираючи поширені кодування"""
+    try:
+        return raw.decode('utf-8')
+    except UnicodeDecodeError:
+        # Якщо не вдалося декодувати як UTF-8, спробуємо інші кодування
+        try:
+            return raw.decode('cp1251')
+        except UnicodeDecodeError:
+            return raw.decode('latin-1')
+class TextStreamDecoder:
+    """Інкрементно декодує текстовий файл, що надходить частинами, і зупиняється після max_chars символів.
+    Спершу пробує UTF-8; якщо файл виявився в іншому кодуванні, один раз перекодовує прочитане (як decode_text)."""
+    def __init__(self, max_chars: int):
+        self.max_chars = max_chars
+        self.parts: list[str] = []
+        self.chars = 0
+        self.raw: bytearray | None = bytearray()  # прочитані байти потрібні лише до переходу з UTF-8
+        self.decoder = codecs.getincrementaldecoder("utf-8")()
 
-        return content
-    except Exception as e:
-        print(f"Помилка при завантаженні файлу: {e}")
-        return ""
-async def generate_test_questions(materials_content: str, num_questions: int) -> str:
-    """Генерує тестові питання на основі матеріалів через OpenAI API"""
-    if not openai_client:
-        return " ❌  OpenAI API  не   налаштовано .  Додайте  OPENAI_API_KEY  у   змінні   середовища ."
+    def _append(self, text: str):
+        self.parts.append(text)
+        self.chars += len(text)
+
+    def feed(self, data: bytes) -> bool:
+        """Додає частину файлу. False — ліміт символів досягнуто, далі читати не треба"""
+        if self.raw is None:
+            self._append(self.decoder.decode(data))
+        else:
+            self.raw += data
+            try:
+                self._append(self.decoder.decode(data))
+            except UnicodeDecodeError:
+                raw, self.raw = bytes(self.raw), None
+                try:
+                    raw.decode("cp1251")
+                    encoding = "cp1251"
+                except UnicodeDecodeError:
+                    encoding = "latin-1"
+                self.decoder = codecs.getincrementaldecoder(encoding)(errors="replace")
+                self.parts, self.chars = [], 0
+                self._append(self.decoder.decode(raw))
+        return self.chars < self.max_chars
 
+    def text(self) -> str:
+        try:
+            self.parts.append(self.decoder.decode(b"", final=True))
+        except UnicodeDecodeError:
+            pass  # файл обірвано лімітом посеред символу
+        return "".join(self.parts)[:self.max_chars]
+def extract_pdf_text(raw: bytes) -> str:
+    from pypdf import PdfReader  # важкий імпорт потрібен лише у процесі-обробнику
+    reader = PdfReader(io.BytesIO(raw))
+    return "\n\n".join(page.extract_text() or "" for page in reader.pages)
+DOCX_NS = "{http://schemas.openxmlformats.org/wordprocessingml/2006/main}"
+def extract_docx_text(raw: bytes) -> str:
+    import zipfile  # як і pypdf, потрібні лише у процесі-обробнику
+    import xml.etree.ElementTree as ET
+    with zipfile.ZipFile(io.BytesIO(raw)) as archive:
+        xml_data = archive.read("word/document.xml")
+    paragraphs = []
+    for paragraph in ET.fromstring(xml_data).iter(f"{DOCX_NS}p"):
+        parts = []
+        for node in paragraph.iter():
+            if node.tag == f"{DOCX_NS}t" and node.text:
+                parts.append(node.text)
+            elif node.tag == f"{DOCX_NS}tab":
+                parts.append("\t")
+            elif node.tag in (f"{DOCX_NS}br", f"{DOCX_NS}cr"):
+                parts.append("\n")
+        paragraphs.append("".join(parts))
+    return "\n".join(paragraphs)
+# Реєстр обробників: (функція, чи виконувати в окремому процесі)
+TEXT_EXTRACTORS_BY_MIME = {
+    "text/plain": (decode_text, False),
+    "text/markdown": (decode_text, False),
+    "text/csv": (decode_text, False),
+    "application/pdf": (extract_pdf_text, True),
+    "application/vnd.openxmlformats-officedocument.wordprocessingml.document": (extract_docx_text, True),
+}
+TEXT_EXTRACTORS_BY_EXT = {
+    ".txt": (decode_text, False),
+    ".md": (decode_text, False),
+    ".csv": (decode_text, False),
+    ".pdf": (extract_pdf_text, True),
+    ".docx": (extract_docx_text, True),
+}
+def register_text_extractor(func, mime_types: tuple = (), extensions: tuple = (), in_process: bool = True):
+    """Додає обробник для нових форматів (функція має бути на рівні модуля, щоб її можна було передати в процес)"""
+    for mime_type in mime_types:
+        TEXT_EXTRACTORS_BY_MIME[mime_type] = (func, in_process)
+    for ext in extensions:
+        TEXT_EXTRACTORS_BY_EXT[ext.lower()] = (func, in_process)
+def find_text_extractor(filename: str | None, mime_type: str | None, raw: bytes):
+    if mime_type in TEXT_EXTRACTORS_BY_MIME:
+        return TEXT_EXTRACTORS_BY_MIME[mime_type]
+    ext = os.path.splitext(filename or "")[1].lower()
+    if ext in TEXT_EXTRACTORS_BY_EXT:
+        return TEXT_EXTRACTORS_BY_EXT[ext]
+    # Невідомий тип: приймаємо як текст, лише якщо файл не схожий на бінарний
+    if (mime_type or "").startswith("text/") or b"\x00" not in raw[:4096]:
+        return decode_text, False
+    raise ExtractionError("непідтримуваний формат файлу")
+CONTROL_CHARS_RE = re.compile(r"[\x00-\x08\x0b\x0c\x0e-\x1f\x7f]")
+def normalize_text(text: str) -> str:
+    """Прибирає керівні символи та зайві пробіли, залишаючи абзаци"""
+    text = CONTROL_CHARS_RE.sub("", text.replace("\r\n", "\n").replace("\r", "\n"))
+    text = re.sub(r"[ \t\u00a0]+", " ", text)
+    text = re.sub(r" *\n *", "\n", text)
+    return re.sub(r"\n{3,}", "\n\n", text).strip()
+def run_text_extractor(func, raw: bytes, max_chars: int) -> str:
+    """Виконується в процесі-обробнику: витягує і нормалізує текст"""
+    return normalize_text(func(raw))[:max_chars]
+def on_extract_timeout(signum, frame):
+    raise ExtractionError("перевищено час обробки файлу")
+def extract_in_worker(func, raw: bytes, max_chars: int, timeout: float) -> str:
+    """Виконується в процесі пулу. Ліміт часу відраховується від початку обробки файлу: SIGALRM перериває
+    Python-код, а процес, що застряг у C-коді й не реагує, ядро завершує сигналом SIGVTALRM після ще
+    EXTRACT_KILL_GRACE секунд процесорного часу"""
+    signal.signal(signal.SIGALRM, on_extract_timeout)
+    signal.signal(signal.SIGVTALRM, signal.SIG_DFL)
+    signal.setitimer(signal.ITIMER_REAL, timeout)
+    signal.setitimer(signal.ITIMER_VIRTUAL, timeout + EXTRACT_KILL_GRACE)
     try:
-        prompt = f"""На основі наступних навчальних матеріалів створи {num_questions} тестових питань з 4 варіантами відповідей (A, B, C, D).
+        return run_text_extractor(func, raw, max_chars)
+    finally:
+        signal.setitimer(signal.ITIMER_REAL, 0)
+        signal.setitimer(signal.ITIMER_VIRTUAL, 0)
+extract_executor: ProcessPoolExecutor | None = None
+# Задач у пулі не більше, ніж процесів: кожна одразу потрапляє у вільний процес і не чекає в черзі пулу
+extract_slots = asyncio.Semaphore(EXTRACT_WORKERS)
+def get_extract_executor() -> ProcessPoolExecutor:
+    global extract_executor
+    if extract_executor is None:
+        extract_executor = ProcessPoolExecutor(max_workers=EXTRACT_WORKERS)
+    return extract_executor
+def replace_extract_executor(broken: ProcessPoolExecutor):
+    """Пул, чий процес завершено, більше не приймає задач — наступні підуть у новий пул"""
+    global extract_executor
+    if extract_executor is broken:
+        extract_executor = None
+    broken.shutdown(wait=False)
+def release_extract_slot(future: asyncio.Future):
+    extract_slots.release()
+    if not future.cancelled():
+        future.exception()  # результат скасованого очікувача нікому не потрібен — не попереджаємо про нього
+async def extract_text(raw: bytes, filename: str | None, mime_type: str | None) -> str:
+    """Перетворює вміст документа на текст, не блокуючи цикл подій"""
+    if len(raw) > EXTRACT_MAX_BYTES:
+        raise ExtractionError(f"файл завеликий ({len(raw) // 1024 // 1024} МБ)")
+    func, in_process = find_text_extractor(filename, mime_type, raw)
+    if not in_process:
+        return run_text_extractor(func, raw, EXTRACT_MAX_CHARS)
+    loop = asyncio.get_running_loop()
+    for attempt in range(2):
+        await extract_slots.acquire()
+        executor = get_extract_executor()
+        started = time.monotonic()
+        try:
+            future = loop.run_in_executor(executor, extract_in_worker, func, raw, EXTRACT_MAX_CHARS, EXTRACT_TIMEOUT)
+        except BaseException:
+            extract_slots.release()
+            raise
+        # Місце звільняється, лише коли задача в процесі справді завершилась: якщо того, хто чекає, скасовано,
+        # процес усе одно дообробляє файл, і нова задача не має потрапити в чергу пулу
+        future.add_done_callback(release_extract_slot)
+        try:
+            return await asyncio.shield(future)
+        except BrokenProcessPool:
+            # Процес пулу завершився (завис у C-коді або впав): замінюємо пул. Задача, що сама вичерпала
+            # ліміт часу, завершується помилкою, а інші задачі того ж пулу один раз повторюються в новому
+            replace_extract_executor(executor)
+            if attempt or time.monotonic() - started >= EXTRACT_TIMEOUT:
+                raise ExtractionError("перевищено час обробки файлу")
+        except ExtractionError:
+            raise
+        except Exception as e:
+            raise ExtractionError(f"не вдалося прочитати файл: {e}") from e
+# -----------------------------------------------------------------------------
+# Кеш витягнутого тексту матеріалів
+# -----------------------------------------------------------------------------
+class ExtractedTextCache:
+    """Кеш тексту матеріалів за file_unique_id: LRU у пам'яті поверх таблиці file_texts."""
+    def __init__(self, max_chars: int, db_max_bytes: int):
+        self.max_chars = max_chars
+        self.db_max_bytes = db_max_bytes
+        self._entries: OrderedDict[str, tuple[str, str]] = OrderedDict()  # file_unique_id -> (hash, text)
+        self._chars = 0
+
+    def _remember(self, file_unique_id: str, content_hash: str, text: str):
+        old = self._entries.pop(file_unique_id, None)
+        if old:
+            self._chars -= len(old[1])
+        if len(text) > self.max_chars:
+            return
+        self._entries[file_unique_id] = (content_hash, text)
+        self._chars += len(text)
+        # Витісняємо найдавніше використані записи, доки не вкладемося в ліміт
+        while self._chars > self.max_chars:
+            _, (_, evicted) = self._entries.popitem(last=False)
+            self._chars -= len(evicted)
+
+    async def get(self, pool: asyncpg.Pool, file_unique_id: str) -> str | None:
+        entry = self._entries.get(file_unique_id)
+        if entry:
+            self._entries.move_to_end(file_unique_id)
+            return entry[1]
+        async with pool.acquire() as con:
+            row = await con.fetchrow(HOT_QUERIES["touch_file_text"], file_unique_id)
+        if not row:
+            return None
+        self._remember(file_unique_id, row["content_hash"], row["content"])
+        return row["content"]
+
+    async def find_by_hash(self, pool: asyncpg.Pool, content_hash: str) -> str | None:
+        """Текст, уже витягнутий з файлу з тим самим вмістом (той самий документ, надісланий заново, має інший
+        file_unique_id)"""
+        for cached_hash, text in self._entries.values():
+            if cached_hash == content_hash:
+                return text
+        async with pool.acquire() as con:
+            return await con.fetchval("SELECT content FROM file_texts WHERE content_hash = $1 LIMIT 1", content_hash)
+
+    async def put(self, pool: asyncpg.Pool, file_unique_id: str, content_hash: str, text: str):
+        self._remember(file_unique_id, content_hash, text)
+        async with pool.acquire() as con:
+            await con.execute(
+                """
+                INSERT INTO file_texts (file_unique_id, content_hash, content, size_bytes)
+                VALUES ($1, $2, $3, $4)
+                ON CONFLICT (file_unique_id) DO UPDATE
+                SET content_hash = EXCLUDED.content_hash, content = EXCLUDED.content,
+                    size_bytes = EXCLUDED.size_bytes, last_used_at = NOW()
+                """,
+                file_unique_id,
+                content_hash,
+                text,
+                len(text.encode("utf-8")),
+            )
+            # Витісняємо найстаріші записи, якщо таблиця перевищила ліміт розміру
+            await con.execute(
+                """
+                DELETE FROM file_texts WHERE file_unique_id IN (
+                    SELECT file_unique_id FROM (
+                        SELECT file_unique_id, SUM(size_bytes) OVER (ORDER BY last_used_at DESC) AS running
+                        FROM file_texts
+                    ) t WHERE running > $1
+                )
+                """,
+                self.db_max_bytes,
+            )
+text_cache = ExtractedTextCache(TEXT_CACHE_MAX_CHARS, TEXT_CACHE_DB_MAX_BYTES)
+# -----------------------------------------------------------------------------
+# Функції для роботи з OpenAI
+# -----------------------------------------------------------------------------
+async def stream_telegram_file(bot: Bot, file_path: str):
+    """Читає файл з Telegram частинами по DOWNLOAD_CHUNK_SIZE, не тримаючи весь файл у пам'яті"""
+    api = bot.session.api
+    if api.is_local:
+        with open(api.wrap_local_file.to_local(file_path), "rb") as f:
+            while chunk := await asyncio.to_thread(f.read, DOWNLOAD_CHUNK_SIZE):
+                yield chunk
+        return
+    async for chunk in bot.session.stream_content(
+        url=api.file_url(bot.token, file_path),
+        timeout=MATERIAL_DOWNLOAD_TIMEOUT,
+        chunk_size=DOWNLOAD_CHUNK_SIZE,
+        raise_for_status=True,
+    ):
+        yield chunk
+async def download_file_text(bot: Bot, file_id: str, filename: str | None = None, mime_type: str | None = None, pool: asyncpg.Pool | None = None) -> tuple[str, str, str]:
+    """Завантажує файл з Telegram потоком і повертає (file_unique_id, sha256 прочитаних байтів, текст).
+
+    Текстові файли декодуються на льоту і читаються лише до EXTRACT_MAX_CHARS символів. PDF/DOCX потребують
+    файлу цілком, тому збираються в пам'яті, але не більше EXTRACT_MAX_BYTES — інакше завантаження переривається.
+    З pool текст файлу, вміст якого вже є в кеші (за sha256), береться звідти без повторного витягування."""
+    file = await bot.get_file(file_id, request_timeout=int(MATERIAL_DOWNLOAD_TIMEOUT))
+    if file.file_size and file.file_size > EXTRACT_MAX_BYTES:
+        raise ExtractionError(f"файл завеликий ({file.file_size // 1024 // 1024} МБ)")
+    digest = hashlib.sha256()
+    async with contextlib.aclosing(stream_telegram_file(bot, file.file_path)) as stream:
+        chunk = await anext(stream, b"")
+        func, _ = find_text_extractor(filename, mime_type, chunk)
+        if func is decode_text:
+            decoder = TextStreamDecoder(EXTRACT_MAX_CHARS)
+            while chunk:
+                digest.update(chunk)
+                if not decoder.feed(chunk):
+                    break
+                chunk = await anext(stream, b"")
+            return file.file_unique_id, digest.hexdigest(), normalize_text(decoder.text())[:EXTRACT_MAX_CHARS]
+        buffer = bytearray()
+        while chunk:
+            digest.update(chunk)
+            buffer += chunk
+            if len(buffer) > EXTRACT_MAX_BYTES:
+                raise ExtractionError(f"файл завеликий (понад {EXTRACT_MAX_BYTES // 1024 // 1024} МБ)")
+            chunk = await anext(stream, b"")
+    content_hash = digest.hexdigest()
+    text = await text_cache.find_by_hash(pool, content_hash) if pool else None
+    if text is None:
+        text = await extract_text(bytes(buffer), filename, mime_type)
+    return file.file_unique_id, content_hash, text
+async def cache_file_text(bot: Bot, pool: asyncpg.Pool, file_id: str, filename: str | None = None, mime_type: str | None = None) -> tuple[str, str]:
+    """Завантажує файл, витягує текст і кладе його в кеш. Повертає (file_unique_id, текст)"""
+    file_unique_id, content_hash, text = await download_file_text(bot, file_id, filename, mime_type, pool)
+    await text_cache.put(pool, file_unique_id, content_hash, text)
+    return file_unique_id, text
+async def get_material_text(bot: Bot, pool: asyncpg.Pool, material: asyncpg.Record) -> str:
+    """Повертає текст матеріалу з кешу, а за його відсутності завантажує файл з Telegram"""
+    if material["file_unique_id"]:
+        cached = await text_cache.get(pool, material["file_unique_id"])
+        if cached is not None:
+            return cached
+    file_unique_id, text = await cache_file_text(bot, pool, material["file_id"], material["filename"], material["mime_type"])
+    if not material["file_unique_id"]:
+        # Старі записи не мають file_unique_id — дописуємо його, щоб наступного разу влучити в кеш
+        async with pool.acquire() as con:
+            await con.execute("UPDATE files SET file_unique_id = $1 WHERE id = $2", file_unique_id, material["id"])
+    return text
+material_download_semaphore = asyncio.Semaphore(MATERIAL_DOWNLOAD_CONCURRENCY)
+async def load_materials_texts(bot: Bot, pool: asyncpg.Pool, materials: list[asyncpg.Record]) -> tuple[list[tuple[asyncpg.Record, str]], list[str]]:
+    """Паралельно отримує тексти матеріалів і повертає ([(матеріал, текст)], список помилок по файлах)"""
+    async def load(material: asyncpg.Record) -> str:
+        # Тайм-аут завантаження діє на сам потік (stream_telegram_file), а витягування має власний EXTRACT_TIMEOUT
+        async with material_download_semaphore:
+            return await get_material_text(bot, pool, material)
+
+    results = await asyncio.gather(*(load(m) for m in materials), return_exceptions=True)
+    # gather зберігає порядок, тож тексти йдуть у тому ж порядку, що й матеріали
+    texts, errors = [], []
+    for material, result in zip(materials, results):
+        if isinstance(result, asyncio.TimeoutError):
+            errors.append(f"{material['filename']}: перевищено час завантаження")
+        elif isinstance(result, Exception):
+            errors.append(f"{material['filename']}: {result}")
+        elif isinstance(result, BaseException):
+            raise result
+        elif not result.strip():
+            errors.append(f"{material['filename']}: файл не містить тексту")
+        else:
+            texts.append((material, result))
+    return texts, errors
+# Версія промпту: змініть при редагуванні build_generation_prompt, щоб старі записи кешу тестів не використовувались
+PROMPT_VERSION = 1
+# Грубі оцінки для бюджетування: символів на токен (кирилиця) і токенів відповіді на одне питання
+CHARS_PER_TOKEN = 3
+TOKENS_PER_QUESTION = 150
+QUESTION_START_RE = re.compile(r"^\s*(\d+)[.)]\s*", re.MULTILINE)
+ANSWER_LINE_RE = re.compile(r"^\s*Правильна відповідь\s*:\s*\S")
+def estimate_tokens(text: str) -> int:
+    return len(text) // CHARS_PER_TOKEN + 1
+def split_into_chunks(text: str, max_tokens: int) -> list[str]:
+    """Ділить матеріали на фрагменти до max_tokens, намагаючись не розривати абзаци"""
+    max_chars = max_tokens * CHARS_PER_TOKEN
+    chunks, current = [], ""
+    for paragraph in text.split("\n\n"):
+        paragraph = paragraph.strip()
+        if not paragraph:
+            continue
+        # Задовгий абзац ріжемо на шматки фіксованого розміру
+        pieces = [paragraph[k:k + max_chars] for k in range(0, len(paragraph), max_chars)]
+        for piece in pieces:
+            if current and len(current) + len(piece) + 2 > max_chars:
+                chunks.append(current)
+                current = ""
+            current = f"{current}\n\n{piece}" if current else piece
+    if current:
+        chunks.append(current)
+    return chunks
+def distribute_questions(sizes: list[int], total: int) -> list[int]:
+    """Розподіляє питання між фрагментами пропорційно їх розміру (кумулятивне округлення рівномірно розкидає залишок)"""
+    whole = sum(sizes)
+    allocation, cumulative, previous = [], 0, 0
+    for size in sizes:
+        cumulative += size
+        boundary = int(total * cumulative / whole + 0.5)
+        allocation.append(boundary - previous)
+        previous = boundary
+    return allocation
+def split_questions(text: str) -> list[str]:
+    """Розбиває відповідь моделі на окремі питання, відкидаючи обірвані (без правильної відповіді)"""
+    starts = [m.start() for m in QUESTION_START_RE.finditer(text)]
+    blocks = [text[a:b].strip() for a, b in zip(starts, starts[1:] + [len(text)])]
+    return [block for block in blocks if "Правильна відповідь" in block]
+def renumber_questions(blocks: list[str]) -> str:
+    return "\n\n".join(
+        QUESTION_START_RE.sub(f"{number}. ", block, count=1) for number, block in enumerate(blocks, start=1)
+    )
+def build_generation_prompt(materials_content: str, num_questions: int, avoid: list[str] | None = None) -> str:
+    """avoid — формулювання питань, яких не можна повторювати (для догенерації замість відкинутих повторів)"""
+    avoid_text = ""
+    if avoid:
+        avoid_text = "Не повторюй ці питання і не став близьких до них за змістом:\n" + "\n".join(f"- {stem}" for stem in avoid) + "\n"
+    return f"""На основі наступних навчальних матеріалів створи {num_questions} тестових питань з 4 варіантами відповідей (A, B, C, D).
 Для кожного питання вкажи правильну відповідь.
 Формат відповіді:
 1. [Питання]
@@ -226,21 +1555,1642 @@ C) [варіант]
 D) [варіант]
 Правильна відповідь: [буква]
 Навчальні матеріали:
-{materials_content[:8000]}
-Створи {num_questions} питань українською мовою:"""
-        response = await openai_client.chat.completions.create(
-            model="gpt-4o-mini",
-            messages=[
-                {"role": "system", "content": "Ти - експерт з створення тестових питань для навчання. Створюй якісні питання на основі наданих матеріалів."},
-                {"role": "user", "content": prompt}
-            ],
-            temperature=0.7,
-            max_tokens=3000,
+{materials_content}
+{avoid_text}Створи {num_questions} питань українською мовою:"""
+class GenerationProgress:
+    """Показує прогрес генерації, редагуючи одне повідомлення не частіше за PROGRESS_EDIT_INTERVAL"""
+    def __init__(self, message: Message, total: int):
+        self.message = message
+        self.total = total
+        self._shown = None
+        self._last_edit = 0.0
+
+    async def update(self, done: int, force: bool = False):
+        text = f"⏳ {min(done, self.total)}/{self.total} питань готово..."
+        now = asyncio.get_running_loop().time()
+        if text == self._shown or (not force and now - self._last_edit < PROGRESS_EDIT_INTERVAL):
+            return
+        self._shown, self._last_edit = text, now
+        try:
+            await self.message.edit_text(text)
+        except Exception as e:
+            print(f"Не вдалося оновити прогрес генерації: {e}")
+async def stream_completion(request: dict, on_question):
+    """Отримує відповідь моделі потоком і викликає on_question(k) щоразу, коли завершено k-те питання.
+    Повертає (текст, usage)"""
+    stream = await get_openai_client().chat.completions.create(**request, stream=True, stream_options={"include_usage": True})
+    parts, line, completed, usage = [], "", 0, None
+    async for event in stream:
+        # Остання подія потоку містить лише usage
+        usage = event.usage or usage
+        if not event.choices or not event.choices[0].delta.content:
+            continue
+        delta = event.choices[0].delta.content
+        parts.append(delta)
+        # Питання вважається готовим, коли надійшов повний рядок з правильною відповіддю
+        *finished, line = (line + delta).split("\n")
+        new = sum(1 for finished_line in finished if ANSWER_LINE_RE.match(finished_line))
+        if new:
+            completed += new
+            await on_question(completed)
+    if ANSWER_LINE_RE.match(line):
+        await on_question(completed + 1)
+    return "".join(parts), usage
+async def generate_chunk_questions(chunk: str, num_questions: int, on_question=None, org_id: int | None = None, priority: int = 1, avoid: list[str] | None = None) -> list[str]:
+    """Генерує питання по одному фрагменту матеріалів"""
+    request = dict(
+        model=OPENAI_MODEL,
+        messages=[
+            {"role": "system", "content": "Ти - експерт з створення тестових питань для навчання. Створюй якісні питання на основі наданих матеріалів."},
+            {"role": "user", "content": build_generation_prompt(chunk, num_questions, avoid)}
+        ],
+        temperature=0.7,
+        max_tokens=num_questions * TOKENS_PER_QUESTION + 200,
+    )
+    mode = "stream" if on_question else "plain"
+
+    async def make_call():
+        started = time.perf_counter()
+        try:
+            if on_question:
+                content, usage = await stream_completion(request, on_question)
+            else:
+                response = await get_openai_client().chat.completions.create(**request)
+                content, usage = response.choices[0].message.content or "", response.usage
+        except Exception as e:
+            metrics.inc("openai_errors_total", error=type(e).__name__)
+            raise
+        finally:
+            metrics.observe("openai_request_seconds", time.perf_counter() - started, mode=mode)
+        record_openai_usage(usage)
+        return content, usage
+
+    estimate = sum(estimate_tokens(message["content"]) for message in request["messages"]) + request["max_tokens"]
+    content = await openai_scheduler.call(org_id, priority, estimate, make_call)
+    return split_questions(content)[:num_questions]
+async def generate_test_questions(materials_content: str, num_questions: int, progress: GenerationProgress | None = None, org_id: int | None = None, priority: int = 1, avoid: list[str] | None = None) -> str:
+    """Генерує тестові питання на основі матеріалів через OpenAI API (паралельно по фрагментах).
+    Якщо передано progress, відповіді читаються потоком і прогрес показується адміністратору.
+    org_id і priority передаються планувальнику запитів (квоти організації та черговість), avoid — у промпт."""
+    if not openai_configured():
+        return " ❌  OpenAI API  не   налаштовано .  Додайте  OPENAI_API_KEY  у   змінні   середовища ."
+
+    chunks = split_into_chunks(materials_content, GENERATION_CHUNK_TOKENS)
+    allocation = distribute_questions([len(c) for c in chunks], num_questions)
+    jobs = [(chunk, count) for chunk, count in zip(chunks, allocation) if count > 0]
+    done_per_chunk = [0] * len(jobs)
+
+    def progress_callback(index: int, count: int):
+        if not progress:
+            return None
+        async def on_question(done: int):
+            done_per_chunk[index] = min(done, count)
+            await progress.update(sum(done_per_chunk))
+        return on_question
+
+    results = await asyncio.gather(
+        *(
+            generate_chunk_questions(chunk, count, progress_callback(index, count), org_id, priority, avoid)
+            for index, (chunk, count) in enumerate(jobs)
+        ),
+        return_exceptions=True,
+    )
+
+    blocks, first_error = [], None
+    for result in results:
+        if isinstance(result, Exception):
+            first_error = first_error or result
+            print(f"Помилка генерації фрагмента: {result}")
+        else:
+            blocks.extend(result)
+    if progress:
+        await progress.update(len(blocks), force=True)
+    if not blocks and isinstance(first_error, OpenAIQuotaExceeded):
+        raise first_error
+    if not blocks:
+        return f" ❌   Помилка   при   генерації   тесту : {first_error}" if first_error else " ❌   Помилка   при   генерації   тесту : модель не повернула жодного питання"
+    return renumber_questions(blocks)
+class GeneratedTestCache:
+    """TTL/LRU кеш згенерованих тестів з об'єднанням однакових одночасних запитів в один виклик"""
+    def __init__(self, ttl: float, max_entries: int):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._entries: OrderedDict[str, tuple[float, str]] = OrderedDict()  # ключ -> (час закінчення, тест)
+        self._inflight: dict[str, asyncio.Future] = {}
+
+    @staticmethod
+    def make_key(materials_content: str, num_questions: int) -> str:
+        digest = hashlib.sha256(materials_content.encode("utf-8")).hexdigest()
+        return f"{digest}:{num_questions}:{OPENAI_MODEL}:{PROMPT_VERSION}"
+
+    def get(self, key: str) -> str | None:
+        entry = self._entries.get(key)
+        if not entry:
+            return None
+        if entry[0] < asyncio.get_running_loop().time():
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        return entry[1]
+
+    def put(self, key: str, test_content: str):
+        self._entries[key] = (asyncio.get_running_loop().time() + self.ttl, test_content)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    async def get_or_generate(self, key: str, generate, bypass: bool = False) -> str:
+        """Повертає тест з кешу або генерує його; bypass=True ігнорує кеш (але не запит, що вже виконується)"""
+        if not bypass:
+            cached = self.get(key)
+            if cached is not None:
+                return cached
+        inflight = self._inflight.get(key)
+        if inflight:
+            return await asyncio.shield(inflight)
+        future = asyncio.get_running_loop().create_future()
+        self._inflight[key] = future
+        try:
+            test_content = await generate()
+            # Кешуємо лише успішні результати, а не повідомлення про помилку
+            if split_questions(test_content):
+                self.put(key, test_content)
+            future.set_result(test_content)
+            return test_content
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except Exception as e:
+            future.set_exception(e)
+            future.exception()  # позначаємо помилку обробленою, якщо інших очікувачів немає
+            raise
+        finally:
+            self._inflight.pop(key, None)
+generated_test_cache = GeneratedTestCache(GENERATED_TEST_CACHE_TTL, GENERATED_TEST_CACHE_SIZE)
+# -----------------------------------------------------------------------------
+# Індекс матеріалів і відбір контексту для генерації
+# -----------------------------------------------------------------------------
+INDEX_WORD_RE = re.compile(r"[^\W\d_]{3,}")
+# Параметри BM25 і баланс між інформативністю та різноманітністю (MMR)
+BM25_K1 = 1.2
+BM25_B = 0.75
+MMR_LAMBDA = 0.7
+class IndexedChunk:
+    __slots__ = ("file_row_id", "position", "text", "tokens", "terms", "length")
+
+    def __init__(self, file_row_id: int, position: int, text: str):
+        self.file_row_id = file_row_id
+        self.position = position
+        self.text = text
+        self.tokens = estimate_tokens(text)
+        self.terms = Counter(word.lower() for word in INDEX_WORD_RE.findall(text))
+        self.length = sum(self.terms.values())
+class MaterialIndex:
+    """Індекс фрагментів матеріалів однієї організації з частотами документів для BM25.
+
+    select() замість перших N символів бере фрагменти, найближчі до центроїда матеріалів організації (косинусна
+    схожість BM25-векторів з їхньою сумою), штрафуючи схожість з уже обраними, доки не вичерпано бюджет токенів.
+    Титульні сторінки, зміст і глосарії складаються з унікальних для них слів, які рідко повторюються в решті
+    тексту, тож далекі від центроїда. Вага на токен для цього не годиться: короткий фрагмент з рідкісних слів
+    отримує найвищу густину."""
+    def __init__(self):
+        self.chunks: dict[tuple[int, int], IndexedChunk] = {}
+        self.df: Counter = Counter()
+        self.total_length = 0
+
+    def file_ids(self) -> set[int]:
+        return {file_row_id for file_row_id, _ in self.chunks}
+
+    def add(self, chunk: IndexedChunk):
+        key = (chunk.file_row_id, chunk.position)
+        if key in self.chunks:
+            return
+        self.chunks[key] = chunk
+        self.df.update(chunk.terms.keys())
+        self.total_length += chunk.length
+
+    def remove_file(self, file_row_id: int):
+        for key in [key for key in self.chunks if key[0] == file_row_id]:
+            chunk = self.chunks.pop(key)
+            self.df.subtract(chunk.terms.keys())
+            self.total_length -= chunk.length
+        self.df = +self.df  # прибираємо нульові лічильники
+
+    def _vectors(self) -> list[tuple[IndexedChunk, dict[str, float], float]]:
+        count = len(self.chunks)
+        average = self.total_length / count or 1
+        idf = {term: math.log(1 + (count - df + 0.5) / (df + 0.5)) for term, df in self.df.items()}
+        vectors = []
+        for chunk in self.chunks.values():
+            norm = BM25_K1 * (1 - BM25_B + BM25_B * chunk.length / average)
+            weights = {term: idf[term] * tf * (BM25_K1 + 1) / (tf + norm) for term, tf in chunk.terms.items()}
+            vectors.append((chunk, weights, math.sqrt(sum(w * w for w in weights.values())) or 1.0))
+        return vectors
+
+    def select(self, budget_tokens: int) -> str:
+        chunks = sorted(self.chunks.values(), key=lambda c: (c.file_row_id, c.position))
+        if sum(chunk.tokens for chunk in chunks) <= budget_tokens:
+            return "\n\n".join(chunk.text for chunk in chunks)
+        vectors = self._vectors()
+        centroid: Counter = Counter()
+        for _, weights, norm in vectors:
+            for term, weight in weights.items():
+                centroid[term] += weight / norm
+        centroid_norm = math.sqrt(sum(w * w for w in centroid.values())) or 1.0
+        relevance = [sum(w * centroid[t] for t, w in weights.items()) / (norm * centroid_norm) for _, weights, norm in vectors]
+        top = max(relevance) or 1.0
+        similarity = [0.0] * len(vectors)  # максимальна косинусна схожість з уже обраними
+        remaining = set(range(len(vectors)))
+        selected, used = [], 0
+        while remaining:
+            fitting = [i for i in remaining if used + vectors[i][0].tokens <= budget_tokens]
+            if not fitting:
+                break
+            best = max(fitting, key=lambda i: MMR_LAMBDA * relevance[i] / top - (1 - MMR_LAMBDA) * similarity[i])
+            remaining.discard(best)
+            chunk, weights, norm = vectors[best]
+            selected.append(chunk)
+            used += chunk.tokens
+            for i in remaining:
+                other, other_weights, other_norm = vectors[i]
+                if len(other_weights) < len(weights):
+                    dot = sum(w * weights.get(t, 0.0) for t, w in other_weights.items())
+                else:
+                    dot = sum(w * other_weights.get(t, 0.0) for t, w in weights.items())
+                similarity[i] = max(similarity[i], dot / (norm * other_norm))
+        # Обрані фрагменти подаються в порядку документа, щоб зберегти зв'язність тексту
+        selected.sort(key=lambda c: (c.file_row_id, c.position))
+        return "\n\n".join(chunk.text for chunk in selected)
+class MaterialIndexRegistry:
+    """Індекси організацій: фрагменти зберігаються в material_chunks, в пам'яті — LRU з MATERIAL_INDEX_ORGS індексів"""
+    def __init__(self, max_orgs: int):
+        self.max_orgs = max_orgs
+        self._indexes: OrderedDict[int, MaterialIndex] = OrderedDict()
+        self._loading: dict[int, asyncio.Future] = {}
+
+    async def get(self, pool: asyncpg.Pool, org_id: int) -> MaterialIndex:
+        index = self._indexes.get(org_id)
+        if index is not None:
+            self._indexes.move_to_end(org_id)
+            return index
+        if org_id in self._loading:
+            return await asyncio.shield(self._loading[org_id])
+        future = self._loading[org_id] = asyncio.get_running_loop().create_future()
+        try:
+            async with pool.acquire() as con:
+                rows = await con.fetch("SELECT file_row_id, position, content FROM material_chunks WHERE org_id = $1", org_id)
+            index = MaterialIndex()
+            for row in rows:
+                index.add(IndexedChunk(row["file_row_id"], row["position"], row["content"]))
+            self._indexes[org_id] = index
+            if len(self._indexes) > self.max_orgs:
+                self._indexes.popitem(last=False)
+            future.set_result(index)
+            return index
+        except BaseException as e:
+            future.set_exception(e)
+            future.exception()  # позначаємо виняток як отриманий, якщо ніхто не чекав
+            raise
+        finally:
+            del self._loading[org_id]
+
+    async def add_material(self, pool: asyncpg.Pool, org_id: int, file_row_id: int, text: str):
+        chunks = [IndexedChunk(file_row_id, position, piece) for position, piece in enumerate(split_into_chunks(text, INDEX_CHUNK_TOKENS))]
+        async with pool.acquire() as con:
+            await con.executemany(
+                "INSERT INTO material_chunks (file_row_id, position, org_id, content) VALUES ($1, $2, $3, $4) ON CONFLICT DO NOTHING",
+                [(file_row_id, chunk.position, org_id, chunk.text) for chunk in chunks],
+            )
+        index = self._indexes.get(org_id)
+        if index is not None:
+            for chunk in chunks:
+                index.add(chunk)
+
+    async def sync(self, pool: asyncpg.Pool, org_id: int, file_row_ids: set[int]) -> tuple[MaterialIndex, set[int]]:
+        """Узгоджує індекс з поточним списком матеріалів: прибирає видалені файли (їх могли видалити через інший
+        процес-обробник), догружає з material_chunks проіндексовані іншими процесами. Повертає (індекс, id файлів,
+        яких немає і в БД — їх треба проіндексувати)"""
+        index = await self.get(pool, org_id)
+        indexed = index.file_ids()
+        for file_row_id in indexed - file_row_ids:
+            index.remove_file(file_row_id)
+        missing = file_row_ids - indexed
+        if missing:
+            async with pool.acquire() as con:
+                rows = await con.fetch(
+                    "SELECT file_row_id, position, content FROM material_chunks WHERE org_id = $1 AND file_row_id = ANY($2::int[])",
+                    org_id,
+                    list(missing),
+                )
+            for row in rows:
+                index.add(IndexedChunk(row["file_row_id"], row["position"], row["content"]))
+            missing -= {row["file_row_id"] for row in rows}
+        return index, missing
+
+    def remove_material(self, org_id: int, file_row_id: int):
+        # Рядки material_chunks видаляються каскадно разом з файлом
+        index = self._indexes.get(org_id)
+        if index is not None:
+            index.remove_file(file_row_id)
+material_indexes = MaterialIndexRegistry(MATERIAL_INDEX_ORGS)
+async def select_materials_context(bot: Bot, pool: asyncpg.Pool, org_id: int, materials: list[asyncpg.Record], budget_tokens: int) -> tuple[str, list[str]]:
+    """Повертає (відібраний текст матеріалів у межах бюджету, список помилок). Контекст береться лише з
+    переданих materials; матеріали, завантажені до появи індексу, індексуються тут при першій генерації."""
+    index, missing_ids = await material_indexes.sync(pool, org_id, {material["id"] for material in materials})
+    missing = [material for material in materials if material["id"] in missing_ids]
+    errors = []
+    if missing:
+        texts, errors = await load_materials_texts(bot, pool, missing)
+        for material, text in texts:
+            await material_indexes.add_material(pool, org_id, material["id"], text)
+    return index.select(budget_tokens), errors
+# -----------------------------------------------------------------------------
+# Пошук повторів серед згенерованих питань (MinHash)
+# -----------------------------------------------------------------------------
+# 64 хеш-функції виду (a*x + b) mod p; коефіцієнти фіксовані, бо відбитки зберігаються в БД між перезапусками
+MINHASH_PRIME = (1 << 61) - 1
+MINHASH_BANDS = 32  # LSH: 32 смуги по 2 значення — кандидати знаходяться вже при схожості ~0.3
+_minhash_random = random.Random(20240611)
+MINHASH_COEFFICIENTS = [(_minhash_random.randrange(1, MINHASH_PRIME), _minhash_random.randrange(MINHASH_PRIME)) for _ in range(64)]
+SHINGLE_WORD_RE = re.compile(r"\w+")
+def question_signature(block: str) -> array:
+    """MinHash-відбиток питання за шинглами з трьох слів (без номера і рядка з правильною відповіддю)"""
+    body = "\n".join(line for line in QUESTION_START_RE.sub("", block, count=1).splitlines() if not ANSWER_LINE_RE.match(line))
+    words = SHINGLE_WORD_RE.findall(body.lower())
+    shingles = {" ".join(words[k:k + 3]) for k in range(max(1, len(words) - 2))}
+    hashes = [int.from_bytes(hashlib.blake2b(shingle.encode(), digest_size=8).digest(), "little") for shingle in shingles]
+    return array("I", (min((a * h + b) % MINHASH_PRIME for h in hashes) & 0xFFFFFFFF for a, b in MINHASH_COEFFICIENTS))
+class QuestionHistory:
+    """Відбитки питань з LSH-кошиками: перевірка нового питання торкається лише кандидатів з його кошиків"""
+    def __init__(self, max_size: int = QUESTION_HISTORY_SIZE):
+        self.max_size = max_size
+        self.signatures: OrderedDict[int, array] = OrderedDict()
+        self.buckets: dict[tuple[int, bytes], set[int]] = {}
+        self._next_id = 0
+
+    @staticmethod
+    def _bands(signature: array):
+        rows = len(signature) // MINHASH_BANDS
+        for band in range(MINHASH_BANDS):
+            yield band, signature[band * rows:(band + 1) * rows].tobytes()
+
+    def add(self, signature: array):
+        key = self._next_id
+        self._next_id += 1
+        self.signatures[key] = signature
+        for band in self._bands(signature):
+            self.buckets.setdefault(band, set()).add(key)
+        if len(self.signatures) > self.max_size:
+            old_key, old = self.signatures.popitem(last=False)
+            for band in self._bands(old):
+                bucket = self.buckets[band]
+                bucket.discard(old_key)
+                if not bucket:
+                    del self.buckets[band]
+
+    def is_duplicate(self, signature: array, threshold: float) -> bool:
+        candidates = set()
+        for band in self._bands(signature):
+            candidates |= self.buckets.get(band, set())
+        for key in candidates:
+            other = self.signatures[key]
+            if sum(x == y for x, y in zip(signature, other)) / len(signature) >= threshold:
+                return True
+        return False
+class QuestionHistoryRegistry:
+    """Історія питань організацій: відбитки в таблиці question_signatures, у пам'яті — LRU історій"""
+    def __init__(self, max_orgs: int):
+        self.max_orgs = max_orgs
+        self._histories: OrderedDict[int, QuestionHistory] = OrderedDict()
+
+    async def get(self, pool: asyncpg.Pool, org_id: int) -> QuestionHistory:
+        history = self._histories.get(org_id)
+        if history is not None:
+            self._histories.move_to_end(org_id)
+            return history
+        async with pool.acquire() as con:
+            rows = await con.fetch(
+                "SELECT signature FROM question_signatures WHERE org_id = $1 ORDER BY id DESC LIMIT $2",
+                org_id,
+                QUESTION_HISTORY_SIZE,
+            )
+        history = self._histories.get(org_id)  # могли завантажити паралельно
+        if history is None:
+            history = QuestionHistory()
+            for row in reversed(rows):
+                history.add(array("I", row["signature"]))
+            self._histories[org_id] = history
+            if len(self._histories) > self.max_orgs:
+                self._histories.popitem(last=False)
+        return history
+
+    async def remember(self, pool: asyncpg.Pool, org_id: int, blocks: list[str]):
+        history = await self.get(pool, org_id)
+        signatures = [question_signature(block) for block in blocks]
+        for signature in signatures:
+            history.add(signature)
+        async with pool.acquire() as con:
+            async with con.transaction():
+                await con.executemany(
+                    "INSERT INTO question_signatures (org_id, signature) VALUES ($1, $2)",
+                    [(org_id, signature.tobytes()) for signature in signatures],
+                )
+                await con.execute(
+                    """
+                    DELETE FROM question_signatures WHERE org_id = $1 AND id <= (
+                        SELECT id FROM question_signatures WHERE org_id = $1 ORDER BY id DESC OFFSET $2 LIMIT 1
+                    )
+                    """,
+                    org_id,
+                    QUESTION_HISTORY_SIZE,
+                )
+question_history = QuestionHistoryRegistry(MATERIAL_INDEX_ORGS)
+# Скільки формулювань питань передавати в промпт догенерації, щоб він не розростався
+TOPUP_AVOID_STEMS = 30
+def question_stem(block: str) -> str:
+    """Перший рядок питання без номера — коротке формулювання для промпту"""
+    return QUESTION_START_RE.sub("", block.strip(), count=1).split("\n", 1)[0].strip()[:200]
+async def drop_repeated_questions(pool: asyncpg.Pool, org_id: int, blocks: list[str], materials_content: str, num_questions: int) -> list[str]:
+    """Відкидає питання, майже однакові з уже згенерованими для організації (і між собою), та догенеровує
+    окремим невеликим запитом лише стільки питань, скільки бракує. У промпт догенерації передаються формулювання
+    відкинутих і вже прийнятих питань, інакше модель на тих самих матеріалах повертає ті самі питання"""
+    history = await question_history.get(pool, org_id)
+    current = QuestionHistory()
+    kept, rejected, dropped = [], [], 0
+    def take(candidates: list[str]):
+        nonlocal dropped
+        for block in candidates:
+            if len(kept) >= num_questions:
+                return
+            signature = question_signature(block)
+            if history.is_duplicate(signature, DUPLICATE_THRESHOLD) or current.is_duplicate(signature, DUPLICATE_THRESHOLD):
+                dropped += 1
+                rejected.append(block)
+                continue
+            current.add(signature)
+            kept.append(block)
+    take(blocks)
+    for _ in range(DUPLICATE_TOPUP_ROUNDS):
+        missing = num_questions - len(kept)
+        if missing <= 0 or not dropped:
+            break
+        print(f"Відкинуто повторів: {dropped}, догенеровую {missing} питань")
+        dropped = 0
+        avoid = [question_stem(block) for block in rejected[-TOPUP_AVOID_STEMS:] + kept][:TOPUP_AVOID_STEMS]
+        take(split_questions(await generate_test_questions(materials_content, missing, org_id=org_id, priority=OPENAI_PRIORITY_TOPUP, avoid=avoid)))
+    return kept
+# -----------------------------------------------------------------------------
+# Розбір тестів і сховище питань
+# -----------------------------------------------------------------------------
+class ParsedQuestion(NamedTuple):
+    text: str
+    options: list[tuple[str, str]]  # (літера, текст варіанта)
+    correct: str
+OPTION_LINE_RE = re.compile(r"^\s*([A-DАВС])\s*[).:]\s*(.*)$")
+CORRECT_ANSWER_RE = re.compile(r"^\s*Правильна відповідь\s*:\s*([A-DАВС])", re.IGNORECASE)
+QUESTION_LINE_RE = re.compile(r"^\s*(\d+)\s*[.)]\s*(.*)$")
+# Кириличні літери, що виглядають як латинські (модель і люди часто їх плутають)
+OPTION_LETTERS = str.maketrans("АВС", "ABC")
+def parse_test_text(text: str) -> list[ParsedQuestion]:
+    """Розбирає тест у форматі «1. / A) ... D) / Правильна відповідь: X» за один прохід по рядках.
+    Питання без правильної відповіді або з менш ніж двома варіантами пропускаються."""
+    questions = []
+    question_lines, options, correct = None, [], None
+
+    def flush():
+        if question_lines is None or correct is None or len(options) < 2:
+            return
+        letters = {letter for letter, _ in options}
+        if correct in letters:
+            questions.append(ParsedQuestion(" ".join(question_lines).strip(), options, correct))
+
+    for line in text.splitlines():
+        if not line.strip():
+            continue
+        match = CORRECT_ANSWER_RE.match(line)
+        if match and question_lines is not None:
+            correct = match.group(1).upper().translate(OPTION_LETTERS)
+            continue
+        match = OPTION_LINE_RE.match(line)
+        if match and question_lines is not None and correct is None:
+            options.append((match.group(1).translate(OPTION_LETTERS), match.group(2).strip()))
+            continue
+        match = QUESTION_LINE_RE.match(line)
+        if match:
+            flush()
+            question_lines, options, correct = [match.group(2)], [], None
+            continue
+        # Продовження тексту питання або останнього варіанта
+        if question_lines is not None and correct is None:
+            if options:
+                letter, option_text = options[-1]
+                options[-1] = (letter, f"{option_text} {line.strip()}")
+            else:
+                question_lines.append(line.strip())
+    flush()
+    return questions
+async def save_parsed_test(pool: asyncpg.Pool, org_id: int, title: str, source: str, questions: list[ParsedQuestion], file_row_id: int | None = None) -> int:
+    """Зберігає розібраний тест у таблиці tests / questions / options і повертає id тесту"""
+    async with pool.acquire() as con:
+        async with con.transaction():
+            test_id = await con.fetchval(
+                """
+                INSERT INTO tests (org_id, title, source, file_row_id, question_count, time_limit_seconds)
+                VALUES ($1, $2, $3, $4, $5, $6) RETURNING id
+                """,
+                org_id,
+                title,
+                source,
+                file_row_id,
+                len(questions),
+                TEST_TIME_LIMIT_SECONDS or None,
+            )
+            await con.copy_records_to_table(
+                "questions",
+                records=[(test_id, position, q.text, q.correct) for position, q in enumerate(questions, start=1)],
+                columns=["test_id", "position", "text", "correct_option"],
+            )
+            await con.copy_records_to_table(
+                "options",
+                records=[
+                    (test_id, position, letter, option_text)
+                    for position, q in enumerate(questions, start=1)
+                    for letter, option_text in q.options
+                ],
+                columns=["test_id", "position", "letter", "text"],
+            )
+    return test_id
+async def delete_test(pool: asyncpg.Pool, test_id: int):
+    async with pool.acquire() as con:
+        await con.execute("DELETE FROM tests WHERE id = $1", test_id)
+async def get_test(pool: asyncpg.Pool, test_id: int) -> asyncpg.Record | None:
+    async with pool.acquire() as con:
+        return await con.fetchrow(HOT_QUERIES["get_test"], test_id)
+question_cache: OrderedDict[tuple[int, int], asyncpg.Record] = OrderedDict()
+async def get_question(pool: asyncpg.Pool, test_id: int, position: int) -> asyncpg.Record | None:
+    """Повертає питання №position (з 1) з варіантами одним індексованим запитом.
+    Питання незмінні, тому популярні з них тримаємо в LRU-кеші."""
+    key = (test_id, position)
+    row = question_cache.get(key)
+    if row is not None:
+        question_cache.move_to_end(key)
+        return row
+    async with pool.acquire() as con:
+        row = await con.fetchrow(HOT_QUERIES["get_question"], test_id, position)
+    if row is not None:
+        question_cache[key] = row
+        if len(question_cache) > QUESTION_CACHE_SIZE:
+            question_cache.popitem(last=False)
+    return row
+# -----------------------------------------------------------------------------
+# Фонова черга генерації тестів
+# -----------------------------------------------------------------------------
+async def enqueue_generation_job(pool: asyncpg.Pool, org_id: int, chat_id: int, user_id: int, num_questions: int, bypass_cache: bool) -> int | None:
+    """Ставить завдання в чергу. Повертає None, якщо для цього чату вже є активне завдання"""
+    async with pool.acquire() as con:
+        job_id = await con.fetchval(
+            """
+            INSERT INTO generation_jobs (org_id, chat_id, user_id, num_questions, bypass_cache)
+            VALUES ($1, $2, $3, $4, $5)
+            ON CONFLICT (chat_id) WHERE state IN ('queued', 'running') DO NOTHING
+            RETURNING id
+            """,
+            org_id,
+            chat_id,
+            user_id,
+            num_questions,
+            bypass_cache,
+        )
+    if job_id is not None:
+        generation_queue.wake_up()
+    return job_id
+async def claim_generation_job(pool: asyncpg.Pool, shard: int = 0, shards: int = 1) -> asyncpg.Record | None:
+    """Бере наступне завдання: спершу організації з найменшою кількістю активних завдань, далі найстаріші.
+    У багатопроцесному режимі лише завдання чатів свого обробника (див. chat_shard)"""
+    async with pool.acquire() as con:
+        return await con.fetchrow(
+            """
+            UPDATE generation_jobs
+            SET state = 'running', attempts = attempts + 1, updated_at = NOW(),
+                locked_until = NOW() + make_interval(secs => $1)
+            WHERE id = (
+                SELECT j.id FROM generation_jobs j
+                LEFT JOIN (
+                    SELECT org_id, COUNT(*) AS running FROM generation_jobs
+                    WHERE state = 'running' AND locked_until > NOW() GROUP BY org_id
+                ) r ON r.org_id = j.org_id
+                WHERE ((j.state = 'queued' AND j.run_after <= NOW())
+                   OR (j.state = 'running' AND j.locked_until <= NOW()))
+                  AND abs(j.chat_id) % $2 = $3
+                ORDER BY COALESCE(r.running, 0), j.created_at
+                LIMIT 1
+                FOR UPDATE OF j SKIP LOCKED
+            )
+            RETURNING *
+            """,
+            GENERATION_JOB_LEASE,
+            shards,
+            shard,
+        )
+async def finish_generation_job(pool: asyncpg.Pool, job_id: int, result: str):
+    async with pool.acquire() as con:
+        await con.execute(
+            "UPDATE generation_jobs SET state = 'done', result = $2, last_error = NULL, locked_until = NULL, updated_at = NOW() WHERE id = $1",
+            job_id,
+            result,
+        )
+async def fail_generation_job(pool: asyncpg.Pool, job: asyncpg.Record, error: str, retry: bool) -> bool:
+    """Повертає завдання в чергу з експоненційною затримкою або остаточно позначає невдалим. True — буде повтор"""
+    will_retry = retry and job["attempts"] < GENERATION_MAX_ATTEMPTS
+    async with pool.acquire() as con:
+        await con.execute(
+            """
+            UPDATE generation_jobs
+            SET state = $2, last_error = $3, locked_until = NULL, updated_at = NOW(),
+                run_after = NOW() + make_interval(secs => $4)
+            WHERE id = $1
+            """,
+            job["id"],
+            "queued" if will_retry else "failed",
+            error,
+            GENERATION_RETRY_DELAY * 2 ** (job["attempts"] - 1),
+        )
+    return will_retry
+async def requeue_interrupted_jobs(pool: asyncpg.Pool, shard: int = 0, shards: int = 1) -> int:
+    """Повертає в чергу завдання свого обробника, чия оренда вже минула (процес, що їх виконував, зупинився).
+    Завдання з чинною орендою може ще виконувати інша репліка — їх не чіпаємо"""
+    async with pool.acquire() as con:
+        result = await con.execute(
+            """
+            UPDATE generation_jobs SET state = 'queued', locked_until = NULL, updated_at = NOW()
+            WHERE state = 'running' AND locked_until <= NOW() AND abs(chat_id) % $1 = $2
+            """,
+            shards,
+            shard,
+        )
+    return int(result.split()[-1])
+class GenerationJobError(Exception):
+    """Помилка завдання генерації; retry=False означає, що повтор не допоможе (наприклад, немає матеріалів)."""
+    def __init__(self, message: str, retry: bool = True):
+        super().__init__(message)
+        self.retry = retry
+async def deliver_generated_test(bot: Bot, storage: BaseStorage, job: asyncpg.Record, test_content: str, test_id: int):
+    """Надсилає готовий тест у чат і переводить адміністратора в меню дій з тестом"""
+    num_questions = job["num_questions"]
+    # Документ формується в пам'яті — без тимчасових файлів на диску, які могли лишитися після помилки
+    sent = await bot.send_document(
+        chat_id=job["chat_id"],
+        document=BufferedInputFile(test_content.encode("utf-8"), filename=f"Згенерований_тест_{num_questions}_питань.txt"),
+        caption=f" ✅  Тест з {num_questions} питань успішно згенеровано!"
+    )
+
+    state = FSMContext(storage=storage, key=StorageKey(bot_id=bot.id, chat_id=job["chat_id"], user_id=job["user_id"]))
+    await state.update_data(
+        generated_test_content=test_content, num_questions=num_questions,
+        generated_test_file_id=sent.document.file_id, generated_test_id=test_id,
+    )
+    await bot.send_message(
+        job["chat_id"],
+        "✅ Тест успішно згенеровано! Оберіть наступну дію:",
+        reply_markup=kb_ai_test_actions()
+    )
+    await state.set_state(AdminFlow.awaiting_ai_test_action)
+async def run_generation_job(bot: Bot, pool: asyncpg.Pool, storage: BaseStorage, job: asyncpg.Record):
+    num_questions = job["num_questions"]
+    materials = await get_files_by_type(pool, job["org_id"], "material")
+    if not materials:
+        raise GenerationJobError("спочатку завантажте навчальні матеріали", retry=False)
+
+    status = await bot.send_message(job["chat_id"], f"⏳ Генерую {num_questions} питань на основі ваших матеріалів...\n⏳ 0/{num_questions} питань готово...")
+
+    # Завантажуємо вміст матеріалів
+    # Замість усіх матеріалів підряд беремо найінформативніші фрагменти в межах бюджету токенів
+    materials_content, errors = await select_materials_context(bot, pool, job["org_id"], materials, GENERATION_CONTEXT_TOKENS)
+    if errors:
+        await bot.send_message(job["chat_id"], "⚠️ Не вдалося прочитати деякі матеріали:\n" + "\n".join(f"• {e}" for e in errors))
+    if not materials_content.strip():
+        raise GenerationJobError("не вдалося прочитати вміст матеріалів. Переконайтеся, що файли містять текст", retry=False)
+
+    # Генеруємо тест
+    progress = GenerationProgress(status, num_questions)
+    priority = OPENAI_PRIORITY_REGENERATE if job["bypass_cache"] else OPENAI_PRIORITY_GENERATE
+    generated = False  # False — тест узято з кешу або з чужого запиту, його відбитки вже в історії
+
+    async def generate():
+        nonlocal generated
+        generated = True
+        return await generate_test_questions(materials_content, num_questions, progress, job["org_id"], priority)
+
+    try:
+        test_content = await generated_test_cache.get_or_generate(
+            GeneratedTestCache.make_key(materials_content, num_questions), generate, bypass=job["bypass_cache"],
         )
+    except OpenAIQuotaExceeded as e:
+        raise GenerationJobError(str(e), retry=False)
+    if job["bypass_cache"]:
+        # «Оновити тест»: модель не пам'ятає попередніх варіантів, тож прибираємо повтори і догенеровуємо лише нестачу
+        blocks = await drop_repeated_questions(pool, job["org_id"], split_questions(test_content), materials_content, num_questions)
+        if blocks:
+            test_content = renumber_questions(blocks)
+            generated = True
+    questions = parse_test_text(test_content)
+    if not questions:
+        print(f"Генерація не дала питань: {test_content}")
+        raise GenerationJobError("модель не повернула жодного питання")
+    await progress.update(len(questions), force=True)
+
+    # Розбираємо тест один раз і зберігаємо структуровано — проходження читатиме питання з БД
+    test_id = await save_parsed_test(pool, job["org_id"], f"Згенерований тест ({len(questions)} питань)", "generated", questions)
+    try:
+        await deliver_generated_test(bot, storage, job, test_content, test_id)
+    except Exception:
+        await delete_test(pool, test_id)  # повторна спроба збереже тест заново
+        raise
+    if generated:
+        try:
+            await question_history.remember(pool, job["org_id"], split_questions(test_content))
+        except Exception as e:
+            print(f"Не вдалося зберегти відбитки питань: {e}")
+    await finish_generation_job(pool, job["id"], test_content)
+class GenerationQueue:
+    """Пул фонових обробників, що забирають завдання з таблиці generation_jobs"""
+    def __init__(self, workers: int):
+        self.workers = workers
+        self.shard, self.shards = 0, 1
+        self._wake = asyncio.Event()
+        self._tasks: list[asyncio.Task] = []
+
+    def wake_up(self):
+        self._wake.set()
+
+    async def start(self, bot: Bot, pool: asyncpg.Pool, storage: BaseStorage, shard: int = 0, shards: int = 1):
+        # Завдання чату виконує той самий обробник, що й апдейти чату: стан FSM у кеші storage лишається актуальним
+        self.shard, self.shards = shard, shards
+        requeued = await requeue_interrupted_jobs(pool, shard, shards)
+        if requeued:
+            print(f"Повернуто в чергу перерваних завдань генерації: {requeued}")
+        self._tasks = [asyncio.create_task(self._worker(bot, pool, storage)) for _ in range(self.workers)]
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    async def _worker(self, bot: Bot, pool: asyncpg.Pool, storage: BaseStorage):
+        while True:
+            try:
+                job = await claim_generation_job(pool, self.shard, self.shards)
+            except Exception as e:
+                print(f"Помилка черги генерації: {e}")
+                job = None
+            if job is None:
+                try:
+                    await asyncio.wait_for(self._wake.wait(), GENERATION_POLL_INTERVAL)
+                except asyncio.TimeoutError:
+                    pass
+                self._wake.clear()
+                continue
+            try:
+                await run_generation_job(bot, pool, storage, job)
+            except Exception as e:
+                retry = e.retry if isinstance(e, GenerationJobError) else True
+                print(f"Завдання генерації {job['id']} завершилося помилкою: {e}")
+                try:
+                    if not await fail_generation_job(pool, job, str(e), retry):
+                        await bot.send_message(job["chat_id"], f" ❌ Не вдалося згенерувати тест: {e}")
+                except Exception as report_error:
+                    print(f"Не вдалося зафіксувати помилку завдання {job['id']}: {report_error}")
+generation_queue = GenerationQueue(GENERATION_WORKERS)
+# -----------------------------------------------------------------------------
+# Доставка повідомлень з урахуванням лімітів Telegram
+# -----------------------------------------------------------------------------
+class TokenBucket:
+    """Відро токенів з резервуванням: кожен виклик одразу бере токени і дізнається, скільки чекати"""
+    __slots__ = ("rate", "capacity", "tokens", "updated", "blocked_until")
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+
+    def reserve(self, cost: float = 1) -> float:
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        self.tokens -= cost
+        return max(0.0, -self.tokens / self.rate, self.blocked_until - now)
+
+    def block(self, seconds: float):
+        self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+
+    def idle(self) -> bool:
+        now = time.monotonic()
+        return now >= self.blocked_until and self.tokens + (now - self.updated) * self.rate >= self.capacity
+class TelegramRateLimiter:
+    """Загальний ліміт бота і окремі ліміти на кожен чат; повторює виклики після RetryAfter"""
+    def __init__(self, global_rate: float, chat_rate: float, chat_burst: float, max_retries: int):
+        self.global_bucket = TokenBucket(global_rate, global_rate)
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.max_retries = max_retries
+        self._chats: dict[int, TokenBucket] = {}
+
+    def _chat_bucket(self, chat_id: int) -> TokenBucket:
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            if len(self._chats) > 10_000:
+                # Забуваємо чати, які вже повністю відновили ліміт
+                self._chats = {k: v for k, v in self._chats.items() if not v.idle()}
+            bucket = self._chats[chat_id] = TokenBucket(self.chat_rate, self.chat_burst)
+        return bucket
+
+    async def call(self, chat_id: int, make_call, cost: int = 1):
+        """Виконує make_call() (фабрика корутини виклику API) у межах лімітів. cost — кількість повідомлень"""
+        chat_bucket = self._chat_bucket(chat_id)
+        for attempt in range(self.max_retries + 1):
+            wait = max(self.global_bucket.reserve(cost), chat_bucket.reserve())
+            if wait:
+                await asyncio.sleep(wait)
+            try:
+                return await make_call()
+            except TelegramRetryAfter as e:
+                if attempt == self.max_retries:
+                    raise
+                chat_bucket.block(e.retry_after)
+telegram_limiter = TelegramRateLimiter(TELEGRAM_GLOBAL_RATE, TELEGRAM_CHAT_RATE, TELEGRAM_CHAT_BURST, TELEGRAM_MAX_RETRIES)
+def format_file_caption(file: asyncpg.Record) -> str:
+    return f" 📄  {file['filename']}\n 📅  Завантажено: {file['uploaded_at'].strftime('%d.%m.%Y %H:%M')}"
+async def send_documents_batched(bot: Bot, chat_id: int, files: list) -> list[str]:
+    """Надсилає файли альбомами по 10 штук. Повертає список помилок по окремих файлах"""
+    errors = []
+    for start in range(0, len(files), 10):
+        batch = files[start:start + 10]
+        if len(batch) > 1:
+            media = [InputMediaDocument(media=file["file_id"], caption=format_file_caption(file)) for file in batch]
+            try:
+                await telegram_limiter.call(chat_id, lambda: bot.send_media_group(chat_id=chat_id, media=media), cost=len(media))
+                continue
+            except TelegramRetryAfter:
+                raise
+            except Exception as e:
+                # Альбом не пройшов через якийсь із файлів — надсилаємо по одному, щоб знайти проблемний
+                print(f"Не вдалося надіслати альбом: {e}")
+        for file in batch:
+            try:
+                await telegram_limiter.call(chat_id, lambda: bot.send_document(
+                    chat_id=chat_id, document=file["file_id"], caption=format_file_caption(file)
+                ))
+            except Exception as e:
+                errors.append(f"{file['filename']}: {e}")
+    return errors
+# -----------------------------------------------------------------------------
+# Планувальник запитів до OpenAI
+# -----------------------------------------------------------------------------
+# Пріоритети (менше — раніше): догенерація вже майже готового тесту, нова генерація, оновлення тесту
+OPENAI_PRIORITY_TOPUP = 0
+OPENAI_PRIORITY_GENERATE = 1
+OPENAI_PRIORITY_REGENERATE = 2
+class OpenAIQuotaExceeded(Exception):
+    pass
+class OpenAIScheduler:
+    """Єдина точка виходу до OpenAI.
 
-        return response.choices[0].message.content
+    Одночасно виконується не більше concurrency запитів; решта чекає в черзі за пріоритетом (у межах пріоритету —
+    за часом надходження). Перед запитом його оцінка токенів резервується у відрі організації — очікування на нього
+    йде ще до того, як зайнято місце, тож організація понад свій TPM не блокує інших, — а вже на зайнятому місці
+    у загальному відрі (TPM). Після відповіді резерв виправляється на фактичний usage. Паузи між повторами теж
+    не тримають місця. Денні квоти організацій рахуються в openai_usage.
+    429, 5xx і помилки з'єднання повторюються з експоненційною затримкою з випадковим розкидом."""
+    def __init__(self, concurrency: int, tpm: int, org_tpm: int, max_retries: int):
+        self.concurrency = concurrency
+        self.max_retries = max_retries
+        self.active = 0
+        self.waiting: list[tuple[int, int, asyncio.Future]] = []
+        self._sequence = itertools.count()
+        self.tpm_bucket = TokenBucket(tpm / 60, tpm)
+        self.org_tpm = org_tpm
+        self._org_buckets: dict[int, TokenBucket] = {}
+        self.pool: asyncpg.Pool | None = None
+
+    def start(self, pool: asyncpg.Pool):
+        self.pool = pool
+
+    def _org_bucket(self, org_id: int) -> TokenBucket:
+        bucket = self._org_buckets.get(org_id)
+        if bucket is None:
+            if len(self._org_buckets) > 10_000:
+                self._org_buckets = {k: v for k, v in self._org_buckets.items() if not v.idle()}
+            bucket = self._org_buckets[org_id] = TokenBucket(self.org_tpm / 60, self.org_tpm)
+        return bucket
+
+    async def _acquire(self, priority: int):
+        if self.active < self.concurrency and not self.waiting:
+            self.active += 1
+            return
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self.waiting, (priority, next(self._sequence), future))
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                self._release()  # місце вже передали цьому запиту — віддаємо далі
+            raise
+
+    def _release(self):
+        # Місце передається найпріоритетнішому з тих, хто чекає, без зменшення лічильника
+        while self.waiting:
+            _, _, future = heapq.heappop(self.waiting)
+            if not future.done():
+                future.set_result(None)
+                return
+        self.active -= 1
+
+    async def check_quota(self, org_id: int):
+        if self.pool is None:
+            return
+        async with self.pool.acquire() as con:
+            row = await con.fetchrow(HOT_QUERIES["get_openai_quota"], org_id, OPENAI_ORG_DAILY_TOKENS)
+        if row and row["quota"] and row["used"] >= row["quota"]:
+            raise OpenAIQuotaExceeded("денну квоту генерації організації вичерпано, спробуйте завтра")
+
+    async def _record_usage(self, org_id: int, tokens: int):
+        if self.pool is None:
+            return
+        try:
+            async with self.pool.acquire() as con:
+                await con.fetchval(HOT_QUERIES["add_openai_usage"], org_id, tokens)
+        except Exception as e:
+            print(f"Не вдалося записати використання токенів: {e}")
+
+    async def call(self, org_id: int | None, priority: int, estimate: int, make_call):
+        """Виконує make_call() -> (результат, usage) з урахуванням лімітів і повертає результат"""
+        if org_id is not None:
+            await self.check_quota(org_id)
+        for attempt in range(self.max_retries + 1):
+            if org_id is not None:
+                wait = self._org_bucket(org_id).reserve(estimate)
+                if wait:
+                    await asyncio.sleep(wait)
+            await self._acquire(priority)
+            try:
+                wait = self.tpm_bucket.reserve(estimate)
+                if wait:
+                    await asyncio.sleep(wait)
+                result, usage = await make_call()
+                break
+            except Exception as e:
+                # Невдала спроба теж могла витратити ліміт, тож резерв не повертаємо
+                if attempt == self.max_retries or not openai_retryable(e):
+                    raise
+                delay = random.uniform(0, min(OPENAI_RETRY_MAX_DELAY, OPENAI_RETRY_BASE_DELAY * 2 ** attempt))
+                retry_after = getattr(getattr(e, "response", None), "headers", {}).get("retry-after")
+                if retry_after and retry_after.replace(".", "", 1).isdigit():
+                    delay = max(delay, float(retry_after))
+                metrics.inc("openai_retries_total", error=type(e).__name__)
+                print(f"OpenAI: {type(e).__name__}, повтор через {delay:.1f} с")
+            finally:
+                self._release()
+            await asyncio.sleep(delay)
+        used = usage.total_tokens if usage else estimate
+        correction = used - estimate
+        self.tpm_bucket.reserve(correction)
+        if org_id is not None:
+            self._org_bucket(org_id).reserve(correction)
+            await self._record_usage(org_id, used)
+        return result
+openai_scheduler = OpenAIScheduler(GENERATION_CONCURRENCY, OPENAI_TPM, OPENAI_ORG_TPM, OPENAI_MAX_RETRIES)
+# -----------------------------------------------------------------------------
+# Розсилка тестів користувачам
+# -----------------------------------------------------------------------------
+async def add_recipient(pool: asyncpg.Pool, org_id: int, chat_id: int, user_id: int, full_name: str):
+    async with pool.acquire() as con:
+        await con.execute(
+            """
+            INSERT INTO recipients (org_id, chat_id, user_id, full_name) VALUES ($1, $2, $3, $4)
+            ON CONFLICT (org_id, chat_id) DO UPDATE SET full_name = EXCLUDED.full_name, active = TRUE
+            """,
+            org_id,
+            chat_id,
+            user_id,
+            full_name,
+        )
+async def is_recipient(pool: asyncpg.Pool, org_id: int, chat_id: int) -> bool:
+    async with pool.acquire() as con:
+        return await con.fetchval("SELECT EXISTS (SELECT 1 FROM recipients WHERE org_id = $1 AND chat_id = $2)", org_id, chat_id)
+async def create_broadcast(pool: asyncpg.Pool, org_id: int, created_by: int, document_file_id: str, caption: str, test_id: int | None = None) -> asyncpg.Record:
+    """Створює розсилку і чергу доставок для всіх активних користувачів організації"""
+    async with pool.acquire() as con:
+        async with con.transaction():
+            broadcast_id = await con.fetchval(
+                "INSERT INTO broadcasts (org_id, created_by, document_file_id, caption, test_id) VALUES ($1, $2, $3, $4, $5) RETURNING id",
+                org_id,
+                created_by,
+                document_file_id,
+                caption,
+                test_id,
+            )
+            await con.execute(
+                """
+                INSERT INTO broadcast_deliveries (broadcast_id, chat_id)
+                SELECT $1, chat_id FROM recipients WHERE org_id = $2 AND active AND chat_id <> $3
+                """,
+                broadcast_id,
+                org_id,
+                created_by,
+            )
+            broadcast = await con.fetchrow(
+                """
+                UPDATE broadcasts SET total = (SELECT COUNT(*) FROM broadcast_deliveries WHERE broadcast_id = $1),
+                    state = CASE WHEN EXISTS (SELECT 1 FROM broadcast_deliveries WHERE broadcast_id = $1) THEN 'sending' ELSE 'done' END
+                WHERE id = $1 RETURNING *
+                """,
+                broadcast_id,
+            )
+    broadcast_queue.wake_up()
+    return broadcast
+async def get_broadcast_status(pool: asyncpg.Pool, broadcast_id: int) -> asyncpg.Record | None:
+    async with pool.acquire() as con:
+        return await con.fetchrow("SELECT * FROM broadcasts WHERE id = $1", broadcast_id)
+def format_broadcast_status(broadcast: asyncpg.Record) -> str:
+    pending = broadcast["total"] - broadcast["sent"] - broadcast["failed"]
+    title = "✅ Розсилку завершено" if broadcast["state"] == "done" else "📤 Розсилка триває"
+    return (
+        f"{title}\n"
+        f"Надіслано: {broadcast['sent']}/{broadcast['total']}\n"
+        f"Не доставлено: {broadcast['failed']}\n"
+        f"В черзі: {pending}"
+    )
+async def claim_broadcast_deliveries(pool: asyncpg.Pool, limit: int, shard: int = 0, shards: int = 1) -> list[asyncpg.Record]:
+    async with pool.acquire() as con:
+        return await con.fetch(
+            """
+            UPDATE broadcast_deliveries d
+            SET state = 'sending', attempts = d.attempts + 1, locked_until = NOW() + make_interval(secs => $2)
+            FROM broadcasts b
+            WHERE b.id = d.broadcast_id AND (d.broadcast_id, d.chat_id) IN (
+                SELECT broadcast_id, chat_id FROM broadcast_deliveries
+                WHERE ((state = 'pending' AND run_after <= NOW()) OR (state = 'sending' AND locked_until <= NOW()))
+                  AND abs(chat_id) % $3 = $4
+                ORDER BY run_after
+                LIMIT $1
+                FOR UPDATE SKIP LOCKED
+            )
+            RETURNING d.broadcast_id, d.chat_id, d.attempts, b.org_id, b.document_file_id, b.caption, b.test_id
+            """,
+            limit,
+            BROADCAST_LEASE,
+            shards,
+            shard,
+        )
+async def record_broadcast_results(pool: asyncpg.Pool, results: list[tuple]):
+    """Зберігає результати пакета доставок і оновлює лічильники розсилок одним транзакційним записом.
+    results: (broadcast_id, chat_id, org_id, стан, помилка, затримка повтору в секундах)"""
+    async with pool.acquire() as con:
+        async with con.transaction():
+            await con.executemany(
+                """
+                UPDATE broadcast_deliveries
+                SET state = $3, last_error = $4, locked_until = NULL, run_after = NOW() + make_interval(secs => $5)
+                WHERE broadcast_id = $1 AND chat_id = $2
+                """,
+                [(b, c, st, err, delay) for b, c, _, st, err, delay in results],
+            )
+            counters: dict[int, list[int]] = {}
+            for broadcast_id, _, _, state, _, _ in results:
+                sent_failed = counters.setdefault(broadcast_id, [0, 0])
+                if state == "sent":
+                    sent_failed[0] += 1
+                elif state == "failed":
+                    sent_failed[1] += 1
+            await con.executemany(
+                "UPDATE broadcasts SET sent = sent + $2, failed = failed + $3 WHERE id = $1",
+                [(broadcast_id, sent, failed) for broadcast_id, (sent, failed) in counters.items()],
+            )
+            # Користувачі, які заблокували бота, більше не отримують розсилок
+            blocked = [(org_id, chat_id) for _, chat_id, org_id, state, error, _ in results if state == "failed" and error == "blocked"]
+            if blocked:
+                await con.executemany("UPDATE recipients SET active = FALSE WHERE org_id = $1 AND chat_id = $2", blocked)
+            await con.execute(
+                """
+                UPDATE broadcasts b SET state = 'done', finished_at = NOW()
+                WHERE b.id = ANY($1::bigint[]) AND b.state = 'sending' AND NOT EXISTS (
+                    SELECT 1 FROM broadcast_deliveries d WHERE d.broadcast_id = b.id AND d.state IN ('pending', 'sending')
+                )
+                """,
+                list(counters),
+            )
+async def deliver_broadcast_message(bot: Bot, delivery: asyncpg.Record) -> tuple:
+    """Надсилає тест одному отримувачу і повертає рядок результату для record_broadcast_results"""
+    key = (delivery["broadcast_id"], delivery["chat_id"], delivery["org_id"])
+    try:
+        await telegram_limiter.call(delivery["chat_id"], lambda: bot.send_document(
+            chat_id=delivery["chat_id"], document=delivery["document_file_id"], caption=delivery["caption"],
+            reply_markup=kb_start_test(delivery["test_id"]) if delivery["test_id"] else None,
+        ))
+        return (*key, "sent", None, 0)
+    except TelegramForbiddenError:
+        return (*key, "failed", "blocked", 0)
+    except TelegramBadRequest as e:
+        return (*key, "failed", str(e), 0)
     except Exception as e:
-        return f" ❌   Помилка   при   генерації   тесту : {str(e)}"
+        if delivery["attempts"] >= BROADCAST_MAX_ATTEMPTS:
+            return (*key, "failed", str(e), 0)
+        return (*key, "pending", str(e), BROADCAST_RETRY_DELAY * 2 ** (delivery["attempts"] - 1))
+class BroadcastQueue:
+    """Обробники, що розсилають повідомлення з broadcast_deliveries пакетами в межах лімітів Telegram"""
+    def __init__(self, workers: int):
+        self.workers = workers
+        self.shard, self.shards = 0, 1
+        self._wake = asyncio.Event()
+        self._tasks: list[asyncio.Task] = []
+
+    def wake_up(self):
+        self._wake.set()
+
+    async def start(self, bot: Bot, pool: asyncpg.Pool, shard: int = 0, shards: int = 1):
+        # Кожен обробник розсилає лише своїм чатам, тож ліміт на чат рахується в одному процесі.
+        # Обробники інших чатів не отримують wake_up і підхоплюють розсилку під час опитування черги.
+        self.shard, self.shards = shard, shards
+        # Доставки, перервані перезапуском, повертаються в чергу — розсилка продовжиться з того ж місця.
+        # Лише з минулою орендою: чинну тримає інша репліка, яка ще надсилає повідомлення
+        async with pool.acquire() as con:
+            await con.execute(
+                """
+                UPDATE broadcast_deliveries SET state = 'pending', locked_until = NULL
+                WHERE state = 'sending' AND locked_until <= NOW() AND abs(chat_id) % $1 = $2
+                """,
+                shards,
+                shard,
+            )
+        self._tasks = [asyncio.create_task(self._worker(bot, pool)) for _ in range(self.workers)]
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    async def _worker(self, bot: Bot, pool: asyncpg.Pool):
+        while True:
+            try:
+                deliveries = await claim_broadcast_deliveries(pool, BROADCAST_BATCH_SIZE, self.shard, self.shards)
+                if deliveries:
+                    results = await asyncio.gather(*(deliver_broadcast_message(bot, d) for d in deliveries))
+                    await record_broadcast_results(pool, results)
+                    continue
+            except Exception as e:
+                print(f"Помилка розсилки: {e}")
+            try:
+                await asyncio.wait_for(self._wake.wait(), GENERATION_POLL_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+            self._wake.clear()
+broadcast_queue = BroadcastQueue(BROADCAST_WORKERS)
+# -----------------------------------------------------------------------------
+# Проходження тестів: сесії та таймери
+# -----------------------------------------------------------------------------
+class TestSession:
+    """Компактний стан проходження: порядок питань, відповіді, бітова карта правильних, дедлайн"""
+    __slots__ = ("session_id", "chat_id", "user_id", "org_id", "test_id", "order", "answers", "correct", "position", "deadline", "started_at", "preview")
+
+    def __init__(self, chat_id: int, user_id: int, org_id: int, test_id: int, question_count: int, deadline: float, preview: bool = False):
+        self.session_id = uuid.uuid4()
+        self.chat_id = chat_id
+        self.user_id = user_id
+        self.org_id = org_id
+        self.test_id = test_id
+        self.order = array("H", range(1, question_count + 1))  # номери питань у тесті в порядку показу
+        random.shuffle(self.order)
+        self.answers = bytearray(question_count)  # 0 — без відповіді, інакше індекс варіанта + 1
+        self.correct = bytearray((question_count + 7) // 8)
+        self.position = 0
+        self.deadline = deadline  # time.monotonic(), 0 — без ліміту часу
+        self.started_at = time.time()
+        self.preview = preview  # адміністратор перевіряє тест перед розсилкою — не рахується в статистиці працівників
+
+    def record(self, option_index: int, is_correct: bool):
+        self.answers[self.position] = option_index + 1
+        if is_correct:
+            self.correct[self.position >> 3] |= 1 << (self.position & 7)
+        self.position += 1
+
+    @property
+    def finished(self) -> bool:
+        return self.position >= len(self.order)
+
+    @property
+    def score(self) -> int:
+        return sum(bin(byte).count("1") for byte in self.correct)
+class TimerWheel:
+    """Одне колесо таймерів на всі сесії: раз на tick секунд обробляється один слот замість окремої задачі на кожного"""
+    def __init__(self, tick: float, size: int):
+        self.tick = tick
+        self.size = size
+        self.slots: list[dict] = [{} for _ in range(size)]  # ключ -> скільки ще повних обертів чекати
+        self.where: dict = {}  # ключ -> індекс слота
+        self.cursor = 0
+        self._task: asyncio.Task | None = None
+
+    def schedule(self, key, delay: float):
+        self.cancel(key)
+        ticks = max(1, math.ceil(delay / self.tick))
+        index = (self.cursor + ticks) % self.size
+        self.slots[index][key] = (ticks - 1) // self.size
+        self.where[key] = index
+
+    def cancel(self, key):
+        index = self.where.pop(key, None)
+        if index is not None:
+            self.slots[index].pop(key, None)
+
+    def _advance(self) -> list:
+        self.cursor = (self.cursor + 1) % self.size
+        slot, expired = self.slots[self.cursor], []
+        for key, rounds in list(slot.items()):
+            if rounds:
+                slot[key] = rounds - 1
+            else:
+                del slot[key]
+                del self.where[key]
+                expired.append(key)
+        return expired
+
+    def start(self, on_expire):
+        self._task = asyncio.create_task(self._run(on_expire))
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+
+    async def _run(self, on_expire):
+        next_tick = time.monotonic() + self.tick
+        while True:
+            await asyncio.sleep(max(0.0, next_tick - time.monotonic()))
+            # Якщо цикл подій відставав, доганяємо всі пропущені тіки
+            while next_tick <= time.monotonic():
+                next_tick += self.tick
+                for key in self._advance():
+                    try:
+                        on_expire(key)
+                    except Exception as e:
+                        print(f"Помилка таймера тесту: {e}")
+# Помилки, після яких повтор того самого запису нічого не змінить
+RESULT_DATA_ERRORS = (asyncpg.IntegrityConstraintViolationError, asyncpg.DataError)
+class ResultsWriter:
+    """Буфер відкладеного запису відповідей і результатів.
+
+    Хендлери лише додають записи в пам'ять; фонова задача скидає їх пакетами через COPY у тимчасову таблицю
+    і переносить у основну з ON CONFLICT DO NOTHING. Ключі (session_id, position) та session_id роблять повторний
+    запис того самого пакета після збою безпечним, тож пакет, не записаний через збій з'єднання, повертається в буфер.
+    Записи тестів, видалених під час проходження, пропускаються; якщо пакет відхилено через самі дані, він
+    записується по одному запису, а записи, що не вставляються, відкидаються — інакше вони блокували б усі наступні."""
+    def __init__(self, flush_size: int, flush_interval: float):
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
+        self.answers: list[tuple] = []
+        self.results: list[tuple] = []
+        self.pool: asyncpg.Pool | None = None
+        self._wake = asyncio.Event()
+        self._lock = asyncio.Lock()
+        self._task: asyncio.Task | None = None
+
+    def add_answer(self, session: TestSession, question_position: int, answer: str, is_correct: bool):
+        self.answers.append((
+            session.session_id, session.position, session.test_id, session.org_id, session.chat_id,
+            question_position, answer, is_correct, datetime.now(timezone.utc),
+        ))
+        if len(self.answers) >= self.flush_size:
+            self._wake.set()
+
+    def add_result(self, session: TestSession, timed_out: bool):
+        self.results.append((
+            session.session_id, session.test_id, session.org_id, session.chat_id, session.user_id,
+            session.score, len(session.order), timed_out,
+            datetime.fromtimestamp(session.started_at, timezone.utc), datetime.now(timezone.utc), session.preview,
+        ))
+        self._wake.set()
+
+    def start(self, pool: asyncpg.Pool):
+        self.pool = pool
+        self._task = asyncio.create_task(self._background())
+
+    async def flush(self):
+        async with self._lock:
+            answers, self.answers = self.answers, []
+            results, self.results = self.results, []
+            if not answers and not results:
+                return
+            try:
+                await self._write_batch(answers, results)
+            except RESULT_DATA_ERRORS as e:
+                print(f"Пакет результатів відхилено ({e}), записуємо по одному")
+                await self._write_one_by_one(answers, results)
+            except BaseException:
+                # Записи повертаються в буфер і потраплять у наступний пакет (доставка щонайменше один раз)
+                self.answers[:0] = answers
+                self.results[:0] = results
+                raise
+
+    async def _write_batch(self, answers: list[tuple], results: list[tuple]):
+        async with self.pool.acquire() as con:
+            async with con.transaction():
+                await self._write(con, answers, results)
+
+    async def _write_one_by_one(self, answers: list[tuple], results: list[tuple]):
+        records = [([answer], []) for answer in answers] + [([], [result]) for result in results]
+        for index, (record_answers, record_results) in enumerate(records):
+            try:
+                await self._write_batch(record_answers, record_results)
+            except RESULT_DATA_ERRORS as e:
+                print(f"Відкинуто запис результату {(record_answers or record_results)[0][:3]}: {e}")
+            except BaseException:
+                # Збій не через дані — решта записів повертається в буфер
+                self.answers[:0] = [answer for rest, _ in records[index:] for answer in rest]
+                self.results[:0] = [result for _, rest in records[index:] for result in rest]
+                raise
+
+    async def _write(self, con: asyncpg.Connection, answers: list[tuple], results: list[tuple]):
+        if answers:
+            await con.execute(
+                "CREATE TEMP TABLE IF NOT EXISTS test_answers_stage (LIKE test_answers) ON COMMIT DELETE ROWS"
+            )
+            await con.copy_records_to_table("test_answers_stage", records=answers)
+            # Агрегати оновлюються лише рядками, які справді вставлено, тож повтор пакета їх не подвоює
+            await con.execute("""
+                WITH inserted AS (
+                    INSERT INTO test_answers SELECT s.* FROM test_answers_stage s
+                    WHERE EXISTS (SELECT 1 FROM tests t WHERE t.id = s.test_id)
+                    ON CONFLICT DO NOTHING
+                    RETURNING test_id, question_position, is_correct
+                )
+                INSERT INTO question_stats (test_id, question_position, answered, correct)
+                SELECT test_id, question_position, count(*), count(*) FILTER (WHERE is_correct)
+                FROM inserted GROUP BY test_id, question_position
+                ON CONFLICT (test_id, question_position) DO UPDATE
+                SET answered = question_stats.answered + EXCLUDED.answered,
+                    correct = question_stats.correct + EXCLUDED.correct
+            """)
+        if results:
+            await con.execute(
+                "CREATE TEMP TABLE IF NOT EXISTS test_results_stage (LIKE test_results) ON COMMIT DELETE ROWS"
+            )
+            await con.copy_records_to_table("test_results_stage", records=results)
+            await con.execute("""
+                WITH inserted AS (
+                    INSERT INTO test_results SELECT s.* FROM test_results_stage s
+                    WHERE EXISTS (SELECT 1 FROM tests t WHERE t.id = s.test_id)
+                    ON CONFLICT DO NOTHING
+                    RETURNING *, (score * 100 >= total * $1) AS is_passed
+                ), by_test AS (
+                    INSERT INTO test_stats (test_id, org_id, attempts, passed, score_sum, total_sum)
+                    SELECT test_id, org_id, count(*), count(*) FILTER (WHERE is_passed), sum(score), sum(total)
+                    FROM inserted GROUP BY test_id, org_id
+                    ON CONFLICT (test_id) DO UPDATE
+                    SET attempts = test_stats.attempts + EXCLUDED.attempts,
+                        passed = test_stats.passed + EXCLUDED.passed,
+                        score_sum = test_stats.score_sum + EXCLUDED.score_sum,
+                        total_sum = test_stats.total_sum + EXCLUDED.total_sum
+                )
+                INSERT INTO employee_stats (org_id, user_id, chat_id, attempts, passed, score_sum, total_sum, last_finished_at)
+                SELECT org_id, user_id, max(chat_id), count(*), count(*) FILTER (WHERE is_passed), sum(score), sum(total), max(finished_at)
+                FROM inserted WHERE NOT preview GROUP BY org_id, user_id
+                ON CONFLICT (org_id, user_id) DO UPDATE
+                SET chat_id = EXCLUDED.chat_id,
+                    attempts = employee_stats.attempts + EXCLUDED.attempts,
+                    passed = employee_stats.passed + EXCLUDED.passed,
+                    score_sum = employee_stats.score_sum + EXCLUDED.score_sum,
+                    total_sum = employee_stats.total_sum + EXCLUDED.total_sum,
+                    last_finished_at = GREATEST(employee_stats.last_finished_at, EXCLUDED.last_finished_at)
+            """, TEST_PASS_PERCENT)
+
+    async def _background(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._wake.wait(), self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wake.clear()
+            try:
+                await self.flush()
+            except Exception as e:
+                print(f"Помилка запису результатів тестів: {e}")
+
+    async def close(self):
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        await self.flush()
+results_writer = ResultsWriter(RESULTS_FLUSH_SIZE, RESULTS_FLUSH_INTERVAL)
+class TestSessionEngine:
+    """Активні сесії проходження тестів (по одній на чат) і спільне колесо таймерів для обмежених у часі тестів"""
+    def __init__(self, tick: float, slots: int):
+        self.sessions: dict[int, TestSession] = {}
+        self.timers = TimerWheel(tick, slots)
+        self.bot: Bot | None = None
+        self.pool: asyncpg.Pool | None = None
+        # Посилання на задачі завершення за таймером, інакше збирач сміття може знищити їх до завершення
+        self._finishing: set[asyncio.Task] = set()
+
+    def start(self, bot: Bot, pool: asyncpg.Pool):
+        self.bot, self.pool = bot, pool
+        self.timers.start(self._on_timeout)
+
+    async def stop(self):
+        await self.timers.stop()
+        await asyncio.gather(*self._finishing, return_exceptions=True)
+
+    def begin(self, chat_id: int, user_id: int, test: asyncpg.Record, preview: bool = False) -> TestSession:
+        previous = self.sessions.pop(chat_id, None)
+        if previous:
+            self.timers.cancel(chat_id)
+        time_limit = test["time_limit_seconds"] or 0
+        deadline = time.monotonic() + time_limit if time_limit else 0.0
+        session = TestSession(chat_id, user_id, test["org_id"], test["id"], test["question_count"], deadline, preview)
+        self.sessions[chat_id] = session
+        if time_limit:
+            self.timers.schedule(chat_id, time_limit)
+        return session
+
+    def _on_timeout(self, chat_id: int):
+        session = self.sessions.get(chat_id)
+        if session:
+            task = asyncio.create_task(self.finish(session, timed_out=True))
+            self._finishing.add(task)
+            task.add_done_callback(self._finished)
+
+    def _finished(self, task: asyncio.Task):
+        self._finishing.discard(task)
+        if not task.cancelled() and task.exception():
+            print(f"Помилка завершення тесту за часом: {task.exception()}")
+
+    def abandon(self, session: TestSession):
+        """Завершує сесію без результату (тест видалили під час проходження)"""
+        if self.sessions.get(session.chat_id) is session:
+            del self.sessions[session.chat_id]
+            self.timers.cancel(session.chat_id)
+
+    async def finish(self, session: TestSession, timed_out: bool = False):
+        if self.sessions.get(session.chat_id) is not session:
+            return  # сесію вже завершено або замінено новою
+        del self.sessions[session.chat_id]
+        self.timers.cancel(session.chat_id)
+        results_writer.add_result(session, timed_out)
+        total = len(session.order)
+        percent = round(session.score * 100 / total) if total else 0
+        title = "⏰ Час вийшов!" if timed_out else "✅ Тест завершено!"
+        await telegram_limiter.call(session.chat_id, lambda: self.bot.send_message(
+            session.chat_id, f"{title}\nПравильних відповідей: {session.score}/{total} ({percent}%)"
+        ))
+test_engine = TestSessionEngine(TEST_TIMER_TICK, TEST_TIMER_SLOTS)
+def format_question(session: TestSession, question: asyncpg.Record) -> str:
+    lines = [f"Питання {session.position + 1}/{len(session.order)}"]
+    if session.deadline:
+        remaining = max(0, int(session.deadline - time.monotonic()))
+        lines[0] += f"   ⏱ {remaining // 60:02d}:{remaining % 60:02d}"
+    lines += ["", question["text"], ""]
+    lines += [f"{letter}) {text}" for letter, text in zip(question["letters"], question["option_texts"])]
+    return "\n".join(lines)
+async def abandon_deleted_test(message: Message, session: TestSession):
+    test_engine.abandon(session)
+    await message.answer(" ❌ Тест видалено, проходження завершено.")
+async def show_current_question(message: Message, session: TestSession, pool: asyncpg.Pool, edit: bool):
+    question = await get_question(pool, session.test_id, session.order[session.position])
+    if question is None:
+        await abandon_deleted_test(message, session)
+        return
+    text = format_question(session, question)
+    markup = kb_question_options(session.position, question["letters"])
+    if edit:
+        await message.edit_text(text, reply_markup=markup)
+    else:
+        await message.answer(text, reply_markup=markup)
+async def start_test_session(message: Message, chat_id: int, user_id: int, org_id: int | None, test_id: int, pool: asyncpg.Pool, preview: bool = False):
+    """Запускає проходження тесту в чаті і показує перше питання"""
+    test = await get_test(pool, test_id)
+    if not test or test["org_id"] != org_id:
+        await message.answer(" ❌ Тест не знайдено.")
+        return
+    if not test["question_count"]:
+        await message.answer(" ❌ У тесті немає питань.")
+        return
+    session = test_engine.begin(chat_id, user_id, test, preview)
+    intro = f"🧪 {test['title']}\nПитань: {test['question_count']}"
+    if test["time_limit_seconds"]:
+        intro += f"\nЧас на проходження: {test['time_limit_seconds'] // 60} хв"
+    await message.answer(intro)
+    await show_current_question(message, session, pool, edit=False)
+# -----------------------------------------------------------------------------
+# Аналітика результатів
+# -----------------------------------------------------------------------------
+# Скільки працівників показувати в зведенні серед найкращих і найслабших
+SUMMARY_EMPLOYEES = 5
+def percent(part: int, whole: int) -> int:
+    return round(part * 100 / whole) if whole else 0
+async def get_results_summary(pool: asyncpg.Pool, org_id: int) -> str:
+    """Зведення з агрегатних таблиць: читаються лише готові лічильники, а не сирі відповіді"""
+    async with pool.acquire() as con:
+        tests = await con.fetch(
+            """
+            SELECT t.title, s.attempts, s.passed, s.score_sum, s.total_sum
+            FROM test_stats s JOIN tests t ON t.id = s.test_id
+            WHERE s.org_id = $1 ORDER BY t.created_at DESC LIMIT 10
+            """,
+            org_id,
+        )
+        hardest = await con.fetch(
+            """
+            SELECT t.title, q.question_position, q.answered, q.correct
+            FROM question_stats q JOIN tests t ON t.id = q.test_id
+            WHERE t.org_id = $1 AND q.answered > 0
+            ORDER BY q.correct::float / q.answered, q.answered DESC LIMIT 5
+            """,
+            org_id,
+        )
+        employees = await con.fetchrow(
+            "SELECT count(*) AS total, count(*) FILTER (WHERE passed > 0) AS passed FROM employee_stats WHERE org_id = $1",
+            org_id,
+        )
+        # Найкращі й найслабші за середнім балом; при малій кількості працівників списки перетинаються
+        ranked = await con.fetch(
+            """
+            (SELECT e.chat_id, r.full_name, e.attempts, e.score_sum, e.total_sum, TRUE AS top
+             FROM employee_stats e LEFT JOIN recipients r ON r.org_id = e.org_id AND r.chat_id = e.chat_id
+             WHERE e.org_id = $1 AND e.total_sum > 0
+             ORDER BY e.score_sum::float / e.total_sum DESC, e.attempts DESC LIMIT $2)
+            UNION ALL
+            (SELECT e.chat_id, r.full_name, e.attempts, e.score_sum, e.total_sum, FALSE AS top
+             FROM employee_stats e LEFT JOIN recipients r ON r.org_id = e.org_id AND r.chat_id = e.chat_id
+             WHERE e.org_id = $1 AND e.total_sum > 0
+             ORDER BY e.score_sum::float / e.total_sum, e.attempts DESC LIMIT $2)
+            """,
+            org_id,
+            SUMMARY_EMPLOYEES,
+        )
+    if not tests:
+        return " 📭  Результатів проходження тестів ще немає."
+    lines = [" 📊  Результати тестів", ""]
+    for test in tests:
+        lines.append(
+            f"• {test['title']}: спроб {test['attempts']}, склали {percent(test['passed'], test['attempts'])}%, "
+            f"середній бал {percent(test['score_sum'], test['total_sum'])}%"
+        )
+    if hardest:
+        lines += ["", "Найскладніші питання:"]
+        for question in hardest:
+            lines.append(
+                f"• {question['title']}, питання {question['question_position']}: "
+                f"правильно {percent(question['correct'], question['answered'])}% з {question['answered']}"
+            )
+    lines += ["", f"Працівників пройшли тести: {employees['total']}, склали хоча б один: {employees['passed']}"]
+    best = [row for row in ranked if row["top"]]
+    shown = {row["chat_id"] for row in best}
+    worst = [row for row in ranked if not row["top"] and row["chat_id"] not in shown]
+    best_title = "Найвищий середній бал:" if worst else "Середній бал працівників:"
+    for title, rows in ((best_title, best), ("Найнижчий середній бал:", worst)):
+        if rows:
+            lines += ["", title]
+            lines += [
+                f"• {row['full_name'] or row['chat_id']}: {percent(row['score_sum'], row['total_sum'])}%, спроб {row['attempts']}"
+                for row in rows
+            ]
+    return "\n".join(lines)
+async def export_results_csv(pool: asyncpg.Pool, org_id: int) -> bytes:
+    """Формує CSV з усіма результатами організації.
+
+    Рядки читаються серверним курсором порціями по EXPORT_FETCH_SIZE і одразу пишуться в буфер,
+    тож повний набір записів ніколи не тримається в пам'яті у вигляді списку."""
+    buffer = io.BytesIO()
+    text = io.TextIOWrapper(buffer, encoding="utf-8-sig", newline="")
+    writer = csv.writer(text)
+    writer.writerow(["Тест", "Працівник", "Chat ID", "Бал", "Усього", "Відсоток", "Склав", "Час вийшов", "Завершено"])
+    async with pool.acquire() as con:
+        async with con.transaction():
+            cursor = con.cursor(
+                """
+                SELECT t.title, r.full_name, tr.chat_id, tr.score, tr.total, tr.timed_out, tr.finished_at
+                FROM test_results tr
+                JOIN tests t ON t.id = tr.test_id
+                LEFT JOIN recipients r ON r.org_id = tr.org_id AND r.chat_id = tr.chat_id
+                WHERE tr.org_id = $1
+                ORDER BY tr.finished_at
+                """,
+                org_id,
+                prefetch=EXPORT_FETCH_SIZE,
+            )
+            async for row in cursor:
+                score_percent = percent(row["score"], row["total"])
+                writer.writerow([
+                    row["title"], row["full_name"] or "", row["chat_id"], row["score"], row["total"], score_percent,
+                    "так" if row["score"] * 100 >= row["total"] * TEST_PASS_PERCENT else "ні", "так" if row["timed_out"] else "ні",
+                    row["finished_at"].strftime("%Y-%m-%d %H:%M"),
+                ])
+    text.flush()
+    return buffer.getvalue()
 # -----------------------------------------------------------------------------
 # Обробники повідомлень (хендлери)
 # -----------------------------------------------------------------------------
@@ -259,12 +3209,23 @@ async def choose_admin(msg: Message, state: FSMContext):
     await state.set_state(AdminFlow.waiting_org_name)
 @router.message(StateFilter(AdminFlow.choose_role), F.text == " 🎓  Я Користувач")
 async def choose_user(msg: Message, state: FSMContext):
-    await msg.answer("Цей режим поки що в розробці. Будь ласка, оберіть роль адміністратора.")
+    await msg.answer("Введіть назву вашої організації:", reply_markup=ReplyKeyboardRemove())
+    await state.set_state(UserFlow.waiting_org_name)
+@router.message(StateFilter(UserFlow.waiting_org_name))
+async def got_user_org_name(msg: Message, state: FSMContext, pool: asyncpg.Pool):
+    org_name = msg.text.strip()
+    org = await find_org(pool, org_name)
+    if not org:
+        await msg.answer(" ❌ Організацію не знайдено. Перевірте назву та спробуйте ще раз або почніть з початку /start.")
+        return
+    await add_recipient(pool, org["id"], msg.chat.id, msg.from_user.id, msg.from_user.full_name)
+    await state.update_data(org_id=org["id"], org_name=org_name)
+    await msg.answer(f"✅ Ви приєдналися до організації '{org_name}'. Тести від адміністратора надходитимуть у цей чат.")
+    await state.set_state(UserFlow.member_menu)
 @router.message(StateFilter(AdminFlow.waiting_org_name))
 async def got_org_name(msg: Message, state: FSMContext, pool: asyncpg.Pool):
     org_name = msg.text.strip()
-    async with pool.acquire() as con:
-        org = await get_org(con, org_name)
+    org = await find_org(pool, org_name)
     if org:
         await state.update_data(org_id=org["id"], org_name=org_name)
         await msg.answer("Організацію знайдено. Введіть пароль адміністратора:")
@@ -281,8 +3242,9 @@ async def got_new_password(msg: Message, state: FSMContext, pool: asyncpg.Pool):
         return
     data = await state.get_data()
     org_name = data["org_name"]
+    password_hash = await hash_password(password)
     async with pool.acquire() as con:
-        org = await create_org(con, org_name, password)
+        org = await create_org(con, org_name, password_hash)
     await state.update_data(org_id=org["id"])
     await msg.answer(f" ✅   Організацію  '{org_name}'  створено !  Вхід   виконано .", reply_markup=kb_main_menu())
     await state.set_state(AdminFlow.main_menu)
@@ -291,9 +3253,10 @@ async def got_existing_password(msg: Message, state: FSMContext, pool: asyncpg.P
     password = msg.text.strip()
     data = await state.get_data()
     org_name = data["org_name"]
-    async with pool.acquire() as con:
-        org = await get_org(con, org_name)
+    org = await find_org(pool, org_name)
     if org and await check_password(org, password):
+        if password_needs_upgrade(org["admin_password_hash"]):
+            await upgrade_org_password(pool, org, password)
         await msg.answer(f" ✅   Вхід   виконано !  Вітаємо   в   організації  '{org_name}'.", reply_markup=kb_main_menu())
         await state.set_state(AdminFlow.main_menu)
     else:
@@ -340,15 +3303,9 @@ async def view_materials(msg: Message, state: FSMContext, pool: asyncpg.Pool, bo
 
     await msg.answer(f" 📚  Знайдено матеріалів: {len(files)}")
 
-    for file in files:
-        try:
-            await bot.send_document(
-                chat_id=msg.chat.id,
-                document=file["file_id"],
-                caption=f" 📄  {file['filename']}\n 📅  Завантажено: {file['uploaded_at'].strftime('%d.%m.%Y %H:%M')}"
-            )
-        except Exception as e:
-            await msg.answer(f" ❌   Помилка   при   відправці  файлу '{file['filename']}': {e}")
+    errors = await send_documents_batched(bot, msg.chat.id, files)
+    if errors:
+        await msg.answer("❌ Не вдалося надіслати деякі файли:\n" + "\n".join(f"• {e}" for e in errors))
 @router.message(StateFilter(AdminFlow.materials_menu), F.text == " 🗑  Видалити матеріал")
 async def delete_material_request(msg: Message, state: FSMContext, pool: asyncpg.Pool):
     data = await state.get_data()
@@ -360,11 +3317,7 @@ async def delete_material_request(msg: Message, state: FSMContext, pool: asyncpg
         await msg.answer(" 📭  Матеріали відсутні.")
         return
 
-    for file in files:
-        await msg.answer(
-            f" 📄  {file['filename']}\n 📅  Завантажено: {file['uploaded_at'].strftime('%d.%m.%Y %H:%M')}\n\nВидалити цей файл?",
-            reply_markup=kb_delete_confirmation(file["id"])
-        )
+    await msg.answer("Оберіть файл для видалення:", reply_markup=kb_file_listing(files, "material", 0))
 @router.message(StateFilter(AdminFlow.materials_menu), F.text == " 🏠  Головне меню")
 async def back_to_main_1(msg: Message, state: FSMContext):
     await msg.answer("Головне меню:", reply_markup=kb_main_menu())
@@ -396,15 +3349,9 @@ async def view_tests(msg: Message, state: FSMContext, pool: asyncpg.Pool, bot: B
 
     await msg.answer(f" 🧪  Знайдено тестів: {len(files)}")
 
-    for file in files:
-        try:
-            await bot.send_document(
-                chat_id=msg.chat.id,
-                document=file["file_id"],
-                caption=f" 📄  {file['filename']}\n 📅  Завантажено: {file['uploaded_at'].strftime('%d.%m.%Y %H:%M')}"
-            )
-        except Exception as e:
-            await msg.answer(f" ❌   Помилка   при   відправці   файлу  '{file['filename']}': {e}")
+    errors = await send_documents_batched(bot, msg.chat.id, files)
+    if errors:
+        await msg.answer("❌ Не вдалося надіслати деякі файли:\n" + "\n".join(f"• {e}" for e in errors))
 @router.message(StateFilter(AdminFlow.tests_menu), F.text == " 🗑  Видалити тест")
 async def delete_test_request(msg: Message, state: FSMContext, pool: asyncpg.Pool):
     data = await state.get_data()
@@ -416,26 +3363,27 @@ async def delete_test_request(msg: Message, state: FSMContext, pool: asyncpg.Poo
         await msg.answer(" 📭  Тести відсутні.")
         return
 
-    for file in files:
-        await msg.answer(
-            f" 📄  {file['filename']}\n 📅  Завантажено: {file['uploaded_at'].strftime('%d.%m.%Y %H:%M')}\n\nВидалити цей файл?",
-            reply_markup=kb_delete_confirmation(file["id"])
-        )
+    await msg.answer("Оберіть файл для видалення:", reply_markup=kb_file_listing(files, "test", 0))
 @router.message(StateFilter(AdminFlow.tests_menu), F.text == " 🤖  Згенерувати тест ШІ")
 async def show_ai_test_menu(msg: Message, state: FSMContext):
-    if not openai_client:
+    if not openai_configured():
         await msg.answer(" ❌  OpenAI API  не   налаштовано .  Зверніться   до   адміністратора   системи .")
         return
 
     await msg.answer(" 🤖  Оберіть кількість питань для генерації:", reply_markup=kb_ai_test_menu())
     await state.set_state(AdminFlow.ai_test_menu)
+@router.message(StateFilter(AdminFlow.tests_menu), F.text == " 📊  Результати")
+async def show_results(msg: Message, state: FSMContext, pool: asyncpg.Pool):
+    data = await state.get_data()
+    summary = await get_results_summary(pool, data.get("org_id"))
+    await msg.answer(summary, reply_markup=kb_results_export())
 @router.message(StateFilter(AdminFlow.tests_menu), F.text == " 🏠  Головне меню")
 async def back_to_main_2(msg: Message, state: FSMContext):
     await msg.answer("Головне меню:", reply_markup=kb_main_menu())
     await state.set_state(AdminFlow.main_menu)
 # --- Меню генерації тестів ШІ ---
 @router.message(StateFilter(AdminFlow.ai_test_menu), F.text.startswith("Згенерувати"))
-async def generate_ai_test(msg: Message, state: FSMContext, pool: asyncpg.Pool, bot: Bot):
+async def generate_ai_test(msg: Message, state: FSMContext, pool: asyncpg.Pool):
     # Витягуємо кількість питань з тексту
     text = msg.text
     if "10" in text:
@@ -460,46 +3408,14 @@ async def generate_ai_test(msg: Message, state: FSMContext, pool: asyncpg.Pool,
         await msg.answer(" ❌   Спочатку   завантажте   навчальні   матеріали !")
         return
 
-    await msg.answer(f" ⏳   Генерую  {num_questions} питань на основі ваших матеріалів... Це може зайняти до 30 секунд.")
-
-    # Завантажуємо вміст матеріалів
-    materials_content = ""
-    for material in materials:
-        content = await download_file_content(bot, material["file_id"])
-        materials_content += content + "\n\n"
-
-    if not materials_content.strip():
-        await msg.answer(" ❌   Не   вдалося   прочитати   вміст   матеріалів .  Переконайтеся ,  що   файли   містять   текст .")
+    job_id = await enqueue_generation_job(
+        pool, org_id, msg.chat.id, msg.from_user.id, num_questions, data.get("bypass_test_cache", False)
+    )
+    if job_id is None:
+        await msg.answer("⏳ Попередній тест ще генерується. Дочекайтеся результату, будь ласка.")
         return
-
-    # Генеруємо тест
-    test_content = await generate_test_questions(materials_content, num_questions)
-
-    # Зберігаємо тест у файл і відправляємо
-    try:
-        with tempfile.NamedTemporaryFile(mode='w', suffix='.txt', delete=False, encoding='utf-8') as f:
-            f.write(test_content)
-            temp_path = f.name
-
-        await bot.send_document(
-            chat_id=msg.chat.id,
-            document=FSInputFile(temp_path, filename=f"Згенерований_тест_{num_questions}_питань.txt"),
-            caption=f" ✅  Тест з {num_questions} питань успішно згенеровано!"
-        )
-
-        # Видаляємо тимчасовий файл
-        os.unlink(temp_path)
-        
-        # НОВИЙ ФЛОУ: Перехід у меню дій з тестом
-        await state.update_data(generated_test_content=test_content, num_questions=num_questions)
-        await msg.answer(
-            "✅ Тест успішно згенеровано! Оберіть наступну дію:",
-            reply_markup=kb_ai_test_actions()
-        )
-        await state.set_state(AdminFlow.awaiting_ai_test_action)
-
-    except Exception as e:
-        await msg.answer(f" ❌   Помилка   при   збереженні   тесту : {e}")
+    await state.update_data(bypass_test_cache=False)
+    await msg.answer(f"⏳ Тест з {num_questions} питань поставлено в чергу на генерацію. Я надішлю його, щойно він буде готовий.")
 
 @router.message(StateFilter(AdminFlow.ai_test_menu), F.text == " 🏠  Головне меню")
 async def back_to_main_from_ai(msg: Message, state: FSMContext):
@@ -512,7 +3428,7 @@ async def back_to_main_from_ai(msg: Message, state: FSMContext):
 async def back_from_ai_actions(msg: Message, state: FSMContext):
     """Повертає до загального меню тестів і очищає дані згенерованого тесту."""
     await state.set_data(
-        {k: v for k, v in (await state.get_data()).items() if k not in ['generated_test_content', 'num_questions']}
+        {k: v for k, v in (await state.get_data()).items() if k not in ['generated_test_content', 'num_questions', 'generated_test_file_id', 'generated_test_id']}
     ) # Очищаємо дані згенерованого тесту
     await msg.answer("Повертаюсь до меню тестів:", reply_markup=kb_tests_menu())
     await state.set_state(AdminFlow.tests_menu)
@@ -520,21 +3436,40 @@ async def back_from_ai_actions(msg: Message, state: FSMContext):
 @router.message(StateFilter(AdminFlow.awaiting_ai_test_action), F.text == "🔄 Оновити тест")
 async def regenerate_ai_test_request(msg: Message, state: FSMContext):
     """Повертає до меню вибору кількості питань для повторної генерації."""
+    await state.update_data(bypass_test_cache=True)  # Оновлення має дати новий тест, а не взяти його з кешу
     await msg.answer("🤖 Оберіть кількість питань для повторної генерації:", reply_markup=kb_ai_test_menu())
     await state.set_state(AdminFlow.ai_test_menu) # Повертаємось у стан генерації
 
 @router.message(StateFilter(AdminFlow.awaiting_ai_test_action), F.text == "📤 Направити Користувачам")
-async def send_test_to_users(msg: Message):
-    """Placeholder: Тут має бути логіка збереження тесту в БД і відправки користувачам."""
-    await msg.answer(" 🏗️ Функціонал відправки користувачам знаходиться в розробці. Спершу потрібно створити логіку проходження тестів.")
+async def send_test_to_users(msg: Message, state: FSMContext, pool: asyncpg.Pool):
+    """Ставить згенерований тест у розсилку всім користувачам організації."""
+    data = await state.get_data()
+    document_file_id = data.get("generated_test_file_id")
+    if not document_file_id:
+        await msg.answer(" ❌ Не знайдено згенерований тест. Згенеруйте тест ще раз.")
+        return
+    caption = f"🧪 Новий тест від адміністратора організації '{data.get('org_name')}' ({data.get('num_questions')} питань)"
+    broadcast = await create_broadcast(pool, data["org_id"], msg.chat.id, document_file_id, caption, data.get("generated_test_id"))
+    if broadcast["total"] == 0:
+        await msg.answer("📭 У вашій організації ще немає користувачів. Попросіть працівників обрати роль «Я Користувач» і ввести назву організації.")
+        return
+    await msg.answer(
+        f"📤 Розсилку розпочато: {broadcast['total']} отримувачів.\n\n{format_broadcast_status(broadcast)}",
+        reply_markup=kb_broadcast_status(broadcast["id"]),
+    )
 
 @router.message(StateFilter(AdminFlow.awaiting_ai_test_action), F.text == "▶️ Пройти тест (Admin)")
-async def start_admin_test_preview(msg: Message):
-    """Placeholder: Тут має бути логіка запуску тесту для адміністратора."""
-    await msg.answer(" 🚧 Функціонал проходження тесту знаходиться в розробці. Щоб його реалізувати, потрібно створити логіку перетворення текстового файлу тесту на запитання бота.")
+async def start_admin_test_preview(msg: Message, state: FSMContext, pool: asyncpg.Pool):
+    """Запускає згенерований тест для адміністратора, щоб перевірити його перед розсилкою."""
+    data = await state.get_data()
+    test_id = data.get("generated_test_id")
+    if not test_id:
+        await msg.answer(" ❌ Не знайдено згенерований тест. Згенеруйте тест ще раз.")
+        return
+    await start_test_session(msg, msg.chat.id, msg.from_user.id, data.get("org_id"), test_id, pool, preview=True)
 
 # --- Обробка завантаження файлів ---
-async def handle_document_upload(msg: Message, state: FSMContext, pool: asyncpg.Pool, file_type: str):
+async def handle_document_upload(msg: Message, state: FSMContext, pool: asyncpg.Pool, bot: Bot, file_type: str):
     if not msg.document:
         await msg.answer("Будь ласка, надішліть саме документ (файл).")
         return
@@ -545,8 +3480,27 @@ async def handle_document_upload(msg: Message, state: FSMContext, pool: asyncpg.
         return
     doc = msg.document
     try:
-        await save_file_to_db(pool, org_id, file_type, doc.file_id, doc.file_name)
+        file_row_id = await save_file_to_db(pool, org_id, file_type, doc.file_id, doc.file_name, doc.file_unique_id, doc.mime_type)
         await msg.answer(f" ✅   Файл  '{doc.file_name}'  успішно   збережено .")
+        if file_type == "material":
+            # Одразу витягуємо текст матеріалу в кеш і індекс, щоб генерація тестів не завантажувала файл повторно
+            try:
+                _, material_text = await cache_file_text(bot, pool, doc.file_id, doc.file_name, doc.mime_type)
+                await material_indexes.add_material(pool, org_id, file_row_id, material_text)
+            except Exception as e:
+                print(f"Не вдалося проіндексувати матеріал: {e}")
+        else:
+            # Розбираємо завантажений тест одразу, щоб його можна було проходити в боті
+            try:
+                _, test_text = await cache_file_text(bot, pool, doc.file_id, doc.file_name, doc.mime_type)
+                questions = parse_test_text(test_text)
+                if questions:
+                    await save_parsed_test(pool, org_id, doc.file_name, "uploaded", questions, file_row_id)
+                    await msg.answer(f"🧩 Розпізнано питань: {len(questions)}.")
+                else:
+                    await msg.answer("⚠️ Не вдалося розпізнати питання. Очікуваний формат: «1. Питання», «A) ... D) варіанти», «Правильна відповідь: A».")
+            except Exception as e:
+                print(f"Не вдалося розібрати тест: {e}")
     except Exception as e:
         await msg.answer(f" ❌   Сталася   помилка   при   збереженні   файлу : {e}")
     # Повернення до відповідного меню
@@ -557,23 +3511,25 @@ async def handle_document_upload(msg: Message, state: FSMContext, pool: asyncpg.
         await state.set_state(AdminFlow.tests_menu)
         await msg.answer("Меню тестів:", reply_markup=kb_tests_menu())
 @router.message(StateFilter(AdminFlow.awaiting_material_upload), F.document)
-async def got_material_upload(msg: Message, state: FSMContext, pool: asyncpg.Pool):
-    await handle_document_upload(msg, state, pool, "material")
+async def got_material_upload(msg: Message, state: FSMContext, pool: asyncpg.Pool, bot: Bot):
+    await handle_document_upload(msg, state, pool, bot, "material")
 @router.message(StateFilter(AdminFlow.awaiting_test_upload), F.document)
-async def got_test_upload(msg: Message, state: FSMContext, pool: asyncpg.Pool):
-    await handle_document_upload(msg, state, pool, "test")
+async def got_test_upload(msg: Message, state: FSMContext, pool: asyncpg.Pool, bot: Bot):
+    await handle_document_upload(msg, state, pool, bot, "test")
 @router.message(StateFilter(AdminFlow.awaiting_material_upload, AdminFlow.awaiting_test_upload))
 async def incorrect_upload(msg: Message):
     await msg.answer("Очікується файл. Будь ласка, надішліть документ.")
 # --- Обробка callback-запитів (для видалення файлів) ---
 @router.callback_query(F.data.startswith("delete_"))
-async def confirm_delete(callback: CallbackQuery, pool: asyncpg.Pool):
+async def confirm_delete(callback: CallbackQuery, state: FSMContext, pool: asyncpg.Pool):
     file_id = int(callback.data.split("_")[1])
+    data = await state.get_data()
 
     try:
-        file = await get_file_by_id(pool, file_id)
+        file = await delete_file_by_id(pool, file_id, data.get("org_id"))
         if file:
-            await delete_file_by_id(pool, file_id)
+            if file["file_type"] == "material":
+                material_indexes.remove_material(file["org_id"], file["id"])
             await callback.message.edit_text(f" ✅   Файл  '{file['filename']}'  успішно   видалено !")
         else:
             await callback.message.edit_text(" ❌   Файл   не   знайдено .")
@@ -581,6 +3537,101 @@ async def confirm_delete(callback: CallbackQuery, pool: asyncpg.Pool):
         await callback.message.edit_text(f" ❌   Помилка   при   видаленні : {e}")
 
     await callback.answer()
+# --- Проходження тестів ---
+@router.callback_query(F.data.startswith("start_test_"))
+async def start_test_from_button(callback: CallbackQuery, state: FSMContext, pool: asyncpg.Pool):
+    """Кнопка під розсилкою. Доступ перевіряється за членством чату в організації тесту (recipients), а не за
+    даними FSM: /start їх очищає, а після FSM_SESSION_TTL вони зникають"""
+    await callback.answer()
+    test_id = callback.data.rsplit("_", 1)[1]
+    if not test_id.isdigit():
+        return
+    chat_id = callback.message.chat.id
+    test = await get_test(pool, int(test_id))
+    if test and await is_recipient(pool, test["org_id"], chat_id):
+        org_id = test["org_id"]
+    else:
+        org_id = (await state.get_data()).get("org_id")
+    await start_test_session(callback.message, chat_id, callback.from_user.id, org_id, int(test_id), pool)
+@router.callback_query(F.data.startswith("ans_"))
+async def answer_question(callback: CallbackQuery, pool: asyncpg.Pool):
+    session = test_engine.sessions.get(callback.message.chat.id)
+    parts = callback.data.split("_")
+    # Дані кнопки могли застаріти або бути підробленими — перевіряємо формат і діапазони
+    if len(parts) != 3 or not parts[1].isdigit() or not parts[2].isdigit() or not session or int(parts[1]) != session.position:
+        await callback.answer("Це питання вже неактуальне.")
+        return
+    option_index = int(parts[2])
+    if session.deadline and time.monotonic() > session.deadline:
+        await callback.answer()
+        await test_engine.finish(session, timed_out=True)
+        return
+    question = await get_question(pool, session.test_id, session.order[session.position])
+    if question is None:
+        await callback.answer()
+        await callback.message.edit_reply_markup(reply_markup=None)
+        await abandon_deleted_test(callback.message, session)
+        return
+    if option_index >= len(question["letters"]):
+        await callback.answer("Це питання вже неактуальне.")
+        return
+    letter = question["letters"][option_index]
+    is_correct = letter == question["correct_option"]
+    results_writer.add_answer(session, session.order[session.position], letter, is_correct)
+    session.record(option_index, is_correct)
+    await callback.answer()
+    if session.finished:
+        await callback.message.edit_reply_markup(reply_markup=None)
+        await test_engine.finish(session)
+    else:
+        await show_current_question(callback.message, session, pool, edit=True)
+@router.callback_query(F.data == "export_results", StateFilter(AdminFlow.tests_menu))
+async def export_results(callback: CallbackQuery, state: FSMContext, pool: asyncpg.Pool):
+    data = await state.get_data()
+    await callback.answer("Формую файл...")
+    content = await export_results_csv(pool, data.get("org_id"))
+    await callback.message.answer_document(BufferedInputFile(content, filename="results.csv"))
+@router.callback_query(F.data.startswith("bcstatus_"))
+async def refresh_broadcast_status(callback: CallbackQuery, state: FSMContext, pool: asyncpg.Pool):
+    broadcast = await get_broadcast_status(pool, int(callback.data.split("_")[1]))
+    data = await state.get_data()
+    if not broadcast or broadcast["org_id"] != data.get("org_id"):
+        await callback.answer("Розсилку не знайдено.")
+        return
+    try:
+        await callback.message.edit_text(
+            format_broadcast_status(broadcast),
+            reply_markup=kb_broadcast_status(broadcast["id"]) if broadcast["state"] != "done" else None,
+        )
+    except TelegramBadRequest:
+        pass  # статус не змінився з минулого оновлення
+    await callback.answer()
+@router.callback_query(F.data.startswith("delpage_"))
+async def delete_listing_page(callback: CallbackQuery, state: FSMContext, pool: asyncpg.Pool):
+    if callback.data == "delpage_noop":
+        await callback.answer()
+        return
+    _, file_type, page = callback.data.split("_")
+    data = await state.get_data()
+    files = await get_files_by_type(pool, data.get("org_id"), file_type)
+    if not files:
+        await callback.message.edit_text(" 📭  Файли відсутні.")
+    else:
+        await callback.message.edit_reply_markup(reply_markup=kb_file_listing(files, file_type, int(page)))
+    await callback.answer()
+@router.callback_query(F.data.startswith("delask_"))
+async def ask_delete_file(callback: CallbackQuery, state: FSMContext, pool: asyncpg.Pool):
+    file_id = int(callback.data.split("_")[1])
+    data = await state.get_data()
+    file = await get_file_by_id(pool, file_id)
+    if not file or file["org_id"] != data.get("org_id"):
+        await callback.message.edit_text(" ❌   Файл   не   знайдено .")
+    else:
+        await callback.message.edit_text(
+            f"{format_file_caption(file)}\n\nВидалити цей файл?",
+            reply_markup=kb_delete_confirmation(file["id"])
+        )
+    await callback.answer()
 @router.callback_query(F.data == "cancel_delete")
 async def cancel_delete(callback: CallbackQuery):
     await callback.message.edit_text(" ❌   Видалення   скасовано .")
@@ -590,48 +3641,526 @@ async def cancel_delete(callback: CallbackQuery):
 # -----------------------------------------------------------------------------
 async def health_check(request):
     return web.Response(text="Bot is running!")
-async def start_http_server():
+async def metrics_handler(request):
+    return web.Response(text=await metrics.render(), content_type="text/plain", charset="utf-8")
+def register_metrics_collectors(pool: asyncpg.Pool, webhook_processor: "WebhookUpdateProcessor | None"):
+    async def collect_pool():
+        return [
+            ("db_pool_connections", {"kind": "total"}, pool.get_size()),
+            ("db_pool_connections", {"kind": "idle"}, pool.get_idle_size()),
+            ("db_pool_connections", {"kind": "max"}, pool.get_max_size()),
+        ]
+
+    async def collect_queues():
+        async with pool.acquire() as con:
+            row = await con.fetchrow("""
+                SELECT
+                    (SELECT count(*) FROM generation_jobs WHERE state = 'queued') AS generation,
+                    (SELECT count(*) FROM broadcast_deliveries WHERE state = 'pending') AS broadcast
+            """)
+        samples = [
+            ("queue_depth", {"queue": "generation"}, row["generation"]),
+            ("queue_depth", {"queue": "broadcast"}, row["broadcast"]),
+            ("queue_depth", {"queue": "result_answers"}, len(results_writer.answers)),
+            ("queue_depth", {"queue": "result_totals"}, len(results_writer.results)),
+            ("queue_depth", {"queue": "openai"}, len(openai_scheduler.waiting)),
+            ("test_sessions_active", {}, len(test_engine.sessions)),
+        ]
+        if webhook_processor:
+            samples.append(("queue_depth", {"queue": "webhook"}, webhook_processor.queue.qsize()))
+        return samples
+
+    metrics.collector(collect_pool)
+    metrics.collector(collect_queues)
+class WebhookUpdateProcessor:
+    """Обмежений пул обробки апдейтів з вебхука: черга фіксованого розміру і WEBHOOK_CONCURRENCY обробників"""
+    def __init__(self, dp: Dispatcher, bot: Bot, concurrency: int, queue_size: int):
+        self.dp = dp
+        self.bot = bot
+        self.concurrency = concurrency
+        self.queue: asyncio.Queue[Update] = asyncio.Queue(maxsize=queue_size)
+        self._tasks: list[asyncio.Task] = []
+        self.stopping = False
+
+    def submit(self, update: Update) -> bool:
+        """Ставить апдейт у чергу. False — черга повна або бот зупиняється, Telegram має повторити доставку пізніше"""
+        if self.stopping:
+            return False
+        try:
+            self.queue.put_nowait(update)
+            return True
+        except asyncio.QueueFull:
+            return False
+
+    def start(self):
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.concurrency)]
+
+    async def stop(self):
+        # На прийняті апдейти Telegram уже отримав 200 і повторно їх не надішле — дообробляємо чергу
+        self.stopping = True
+        try:
+            await asyncio.wait_for(self.queue.join(), WEBHOOK_DRAIN_TIMEOUT)
+        except asyncio.TimeoutError:
+            print(f"Не встигли обробити {self.queue.qsize()} апдейтів до зупинки")
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+
+    async def _worker(self):
+        while True:
+            update = await self.queue.get()
+            try:
+                await self.dp.feed_update(self.bot, update)
+            except Exception as e:
+                print(f"Помилка обробки апдейту {update.update_id}: {e}")
+            finally:
+                self.queue.task_done()
+def webhook_secret_valid(request: web.Request) -> bool:
+    return bool(WEBHOOK_SECRET) and hmac.compare_digest(request.headers.get("X-Telegram-Bot-Api-Secret-Token", ""), WEBHOOK_SECRET)
+async def handle_webhook(request: web.Request):
+    """Приймає апдейт від Telegram і одразу відповідає, а обробка йде у фоновому пулі"""
+    if not webhook_secret_valid(request):
+        return web.Response(status=401)
+    return await accept_update(request)
+async def accept_update(request: web.Request):
+    """Ставить апдейт у чергу обробки; так само приймаються апдейти, переслані супервізором обробнику"""
+    processor: WebhookUpdateProcessor = request.app["webhook_processor"]
+    try:
+        update = Update.model_validate(await request.json(), context={"bot": processor.bot})
+    except Exception:
+        return web.Response(status=400)
+    if not processor.submit(update):
+        return web.Response(status=503)
+    return web.Response()
+async def start_http_server(webhook_processor: WebhookUpdateProcessor | None = None, socket_path: str | None = None):
     app = web.Application()
     app.router.add_get('/', health_check)
     app.router.add_get('/health', health_check)
+    app.router.add_get('/metrics', metrics_handler)
+    if webhook_processor:
+        app["webhook_processor"] = webhook_processor
+        if socket_path:
+            # Обробник багатопроцесного режиму: апдейти надсилає супервізор, який уже перевірив секрет вебхука
+            app.router.add_post('/update', accept_update)
+        else:
+            app.router.add_post(WEBHOOK_PATH, handle_webhook)
 
     runner = web.AppRunner(app)
     await runner.setup()
+    if socket_path:
+        await web.UnixSite(runner, socket_path).start()
+        return
     site = web.TCPSite(runner, '0.0.0.0', PORT)
     await site.start()
     print(f"HTTP сервер запущено на порту {PORT}")
 # -----------------------------------------------------------------------------
-# Головна функція запуску бота
+# Багатопроцесний режим: супервізор і процеси-обробники
 # -----------------------------------------------------------------------------
-async def main():
-    if not BOT_TOKEN:
-        print("Помилка: не знайдено токен бота. Задайте змінну середовища TELEGRAM_BOT_TOKEN.")
-        return
-    if not DATABASE_URL:
-        print("Помилка: не знайдено адресу бази даних. Задайте змінну середовища DATABASE_URL.")
+def chat_shard(chat_id: int, shards: int) -> int:
+    """Номер обробника чату. Та сама формула (abs(chat_id) % shards) відбирає завдання черг у SQL"""
+    return abs(chat_id) % shards
+def update_chat_id(data: dict) -> int:
+    """chat_id апдейту без розбору моделі: чат події, а для подій без чату (inline-запити тощо) — користувач"""
+    for key, event in data.items():
+        if key == "update_id" or not isinstance(event, dict):
+            continue
+        for holder in (event, event.get("message")):
+            if isinstance(holder, dict) and isinstance(holder.get("chat"), dict):
+                return holder["chat"]["id"]
+        user = event.get("from") or event.get("user")
+        if isinstance(user, dict):
+            return user["id"]
+    return 0
+def merge_metrics(texts: list[tuple[str | None, str]]) -> str:
+    """Об'єднує вивід /metrics кількох процесів: до значень обробника додається мітка worker, а рядки кожної
+    метрики йдуть однією групою, як вимагає текстовий формат Prometheus"""
+    families: dict[str, tuple[list[str], list[str]]] = {}
+    for worker, text in texts:
+        headers, samples = [], []
+        for line in text.splitlines():
+            if line.startswith("# "):
+                headers, samples = families.setdefault(line.split()[2], ([], []))
+                if line not in headers:
+                    headers.append(line)
+            elif line:
+                if worker is not None:
+                    name, brace, rest = line.partition("{")
+                    if brace:
+                        line = f'{name}{{worker="{worker}",{rest}'
+                    else:
+                        name, _, value = line.partition(" ")
+                        line = f'{name}{{worker="{worker}"}} {value}'
+                samples.append(line)
+    return "\n".join(line for headers, samples in families.values() for line in headers + samples) + "\n"
+async def wait_for_shutdown():
+    """Чекає на SIGTERM або SIGINT, щоб після нього спрацювали finally: буфери скидаються в БД, пул закривається"""
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(sig, stop.set)
+    try:
+        await stop.wait()
+    finally:
+        for sig in (signal.SIGTERM, signal.SIGINT):
+            loop.remove_signal_handler(sig)
+def run_worker_process(shard: int, shards: int, socket_path: str):
+    """Точка входу процесу-обробника (запускається через spawn, тож модуль імпортується заново)"""
+    async def serve():
+        # SIGTERM від супервізора скасовує головну задачу, щоб спрацювали finally і буфери скинулися в БД
+        task = asyncio.current_task()
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGTERM, signal.SIGINT):
+            loop.add_signal_handler(sig, task.cancel)
+        await run_bot(shard, shards, socket_path)
+    try:
+        asyncio.run(serve())
+    except asyncio.CancelledError:
+        pass
+class WorkerProcess:
+    """Процес-обробник з боку супервізора: запуск, пересилання апдейтів по черзі через Unix-сокет,
+    перевірка здоров'я і перезапуск"""
+    def __init__(self, shard: int, shards: int):
+        self.shard = shard
+        self.shards = shards
+        self.socket_path = os.path.join(WORKER_SOCKET_DIR, f"corpcybertest-{os.getpid()}-{shard}.sock")
+        self.queue: asyncio.Queue[dict] = asyncio.Queue(maxsize=WORKER_QUEUE_SIZE)
+        # Апдейти з polling, що не вмістилися в чергу: polling не чекає на один повільний обробник
+        self.overflow: deque[dict] = deque()
+        self.overflow_drained = asyncio.Event()
+        self.process: multiprocessing.Process | None = None
+        self.session: ClientSession | None = None
+        self.ready = False
+        self.failures = 0
+        self.started_at = 0.0
+        self._forwarder: asyncio.Task | None = None
+
+    def start(self):
+        self.session = ClientSession(connector=UnixConnector(path=self.socket_path))
+        self._spawn()
+        self._forwarder = asyncio.create_task(self._forward())
+
+    def _spawn(self):
+        if os.path.exists(self.socket_path):
+            os.unlink(self.socket_path)
+        # spawn, а не fork: дочірній процес не успадковує цикл подій і з'єднання супервізора.
+        # Не daemon, бо обробник сам створює процеси для витягування тексту
+        self.process = multiprocessing.get_context("spawn").Process(
+            target=run_worker_process, args=(self.shard, self.shards, self.socket_path), name=f"worker-{self.shard}",
+        )
+        self.process.start()
+        self.ready = False
+        self.failures = 0
+        self.started_at = time.monotonic()
+
+    async def _terminate(self):
+        if self.process and self.process.is_alive():
+            self.process.terminate()
+            await asyncio.to_thread(self.process.join, 10)
+            if self.process.is_alive():
+                self.process.kill()
+                await asyncio.to_thread(self.process.join)
+
+    async def restart(self):
+        await self._terminate()
+        metrics.inc("worker_restarts_total", worker=self.shard)
+        self._spawn()
+
+    async def stop(self):
+        if self._forwarder:
+            # Прийняті апдейти Telegram повторно не надішле — спершу передаємо обробнику чергу
+            try:
+                await asyncio.wait_for(self.queue.join(), WEBHOOK_DRAIN_TIMEOUT)
+            except asyncio.TimeoutError:
+                print(f"Обробнику {self.shard} не встигли передати {self.queue.qsize() + len(self.overflow)} апдейтів")
+            self._forwarder.cancel()
+            await asyncio.gather(self._forwarder, return_exceptions=True)
+        await self._terminate()
+        await self.session.close()
+        if os.path.exists(self.socket_path):
+            os.unlink(self.socket_path)
+
+    async def _request(self, method: str, path: str, **kwargs):
+        async with self.session.request(
+            method, f"http://worker{path}", timeout=ClientTimeout(total=WORKER_HEALTH_TIMEOUT), **kwargs
+        ) as response:
+            return response.status, await response.text()
+
+    def enqueue(self, data: dict) -> bool:
+        """Ставить апдейт з polling у чергу без очікування; False — запас переповнений, polling має зачекати"""
+        if self.overflow or self.queue.full():
+            self.overflow.append(data)
+            self.overflow_drained.clear()
+            return len(self.overflow) < WORKER_OVERFLOW_SIZE
+        self.queue.put_nowait(data)
+        return True
+
+    async def _forward(self):
+        """Пересилає апдейти строго по черзі: поки обробник перезапускається або переповнений, наступні чекають"""
+        while True:
+            data = await self.queue.get()
+            while self.overflow and not self.queue.full():
+                self.queue.put_nowait(self.overflow.popleft())
+            if len(self.overflow) < WORKER_OVERFLOW_SIZE // 2:
+                self.overflow_drained.set()
+            delay = 0.05
+            while True:
+                try:
+                    status, _ = await self._request("POST", "/update", json=data)
+                    if status != 503:
+                        break
+                except (ClientError, asyncio.TimeoutError):
+                    pass
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, 2)
+            self.queue.task_done()
+
+    async def check(self) -> bool:
+        """False — обробник треба перезапустити: процес завершився, не запустився вчасно або не відповідає"""
+        if not self.process.is_alive():
+            return False
+        try:
+            status, _ = await self._request("GET", "/health")
+            healthy = status == 200
+        except (ClientError, asyncio.TimeoutError):
+            healthy = False
+        if healthy:
+            self.ready = True
+            self.failures = 0
+            return True
+        if not self.ready:
+            return time.monotonic() - self.started_at < WORKER_START_TIMEOUT
+        self.failures += 1
+        return self.failures < WORKER_HEALTH_FAILURES
+
+    async def fetch_metrics(self) -> str:
+        try:
+            status, text = await self._request("GET", "/metrics")
+            return text if status == 200 else ""
+        except (ClientError, asyncio.TimeoutError):
+            return ""
+class Supervisor:
+    """Приймає апдейти (вебхук або polling) і розподіляє їх між процесами-обробниками за chat_id.
+    Апдейти одного чату завжди потрапляють до одного обробника — зберігається їх порядок і кеш стану FSM."""
+    def __init__(self, bot: Bot, shards: int):
+        self.bot = bot
+        self.workers = [WorkerProcess(shard, shards) for shard in range(shards)]
+        self._health_task: asyncio.Task | None = None
+        self.stopping = False
+
+    def worker_for(self, data: dict) -> WorkerProcess:
+        return self.workers[chat_shard(update_chat_id(data), len(self.workers))]
+
+    def start(self):
+        for worker in self.workers:
+            worker.start()
+        self._health_task = asyncio.create_task(self._watch())
+        metrics.collector(self._collect)
+
+    async def stop(self):
+        self.stopping = True  # нові апдейти з вебхука отримують 503, Telegram повторить їх після перезапуску
+        if self._health_task:
+            self._health_task.cancel()
+            await asyncio.gather(self._health_task, return_exceptions=True)
+        await asyncio.gather(*(worker.stop() for worker in self.workers))
+
+    async def _watch(self):
+        while True:
+            await asyncio.sleep(WORKER_HEALTH_INTERVAL)
+            for worker, healthy in zip(self.workers, await asyncio.gather(*(w.check() for w in self.workers))):
+                if not healthy:
+                    print(f"Обробник {worker.shard} не відповідає, перезапускаємо")
+                    await worker.restart()
+
+    async def _collect(self):
+        samples = [("worker_up", {"worker": w.shard}, int(w.ready and w.process.is_alive())) for w in self.workers]
+        samples += [("queue_depth", {"queue": f"worker_{w.shard}"}, w.queue.qsize() + len(w.overflow)) for w in self.workers]
+        return samples
+
+    async def handle_webhook(self, request: web.Request):
+        if not webhook_secret_valid(request):
+            return web.Response(status=401)
+        try:
+            data = await request.json()
+        except Exception:
+            return web.Response(status=400)
+        if self.stopping:
+            return web.Response(status=503)
+        try:
+            self.worker_for(data).queue.put_nowait(data)
+        except asyncio.QueueFull:
+            return web.Response(status=503)
+        return web.Response()
+
+    async def handle_metrics(self, request: web.Request):
+        texts = await asyncio.gather(*(worker.fetch_metrics() for worker in self.workers))
+        merged = merge_metrics([(None, await metrics.render())] + [(w.shard, t) for w, t in zip(self.workers, texts)])
+        return web.Response(text=merged, content_type="text/plain", charset="utf-8")
+
+    async def start_http_server(self):
+        app = web.Application()
+        app.router.add_get('/', health_check)
+        app.router.add_get('/health', health_check)
+        app.router.add_get('/metrics', self.handle_metrics)
+        if WEBHOOK_URL:
+            app.router.add_post(WEBHOOK_PATH, self.handle_webhook)
+        runner = web.AppRunner(app)
+        await runner.setup()
+        await web.TCPSite(runner, '0.0.0.0', PORT).start()
+        print(f"HTTP сервер супервізора запущено на порту {PORT}, обробників: {len(self.workers)}")
+
+    async def poll(self):
+        """Polling без Dispatcher: апдейти лише розкладаються по чергах обробників. Переповнена черга одного
+        обробника не зупиняє інших — зайве відкладається в його запас; polling чекає, лише коли переповнений і запас"""
+        offset = None
+        allowed_updates = router.resolve_used_update_types()
+        while True:
+            try:
+                updates = await self.bot.get_updates(offset=offset, timeout=30, allowed_updates=allowed_updates, request_timeout=40)
+            except (TelegramAPIError, ClientError, asyncio.TimeoutError) as e:
+                print(f"Помилка отримання апдейтів: {e}")
+                await asyncio.sleep(1)
+                continue
+            for update in updates:
+                data = update.model_dump(mode="json", by_alias=True, exclude_none=True)
+                worker = self.worker_for(data)
+                offset = update.update_id + 1
+                if not worker.enqueue(data):
+                    print(f"Обробник {worker.shard} не встигає, polling призупинено")
+                    await worker.overflow_drained.wait()
+async def run_supervisor(shards: int):
+    # Міграції застосовує супервізор один раз, до запуску обробників
+    pool = await connect_database()
+    if pool is None:
         return
+    await pool.close()
+
+    bot = Bot(token=BOT_TOKEN)
+    supervisor = Supervisor(bot, shards)
+    supervisor.start()
+    await supervisor.start_http_server()
+    print("Бот запускається в багатопроцесному режимі...")
+    try:
+        if WEBHOOK_URL:
+            await bot.set_webhook(
+                url=WEBHOOK_URL.rstrip("/") + WEBHOOK_PATH,
+                secret_token=WEBHOOK_SECRET,
+                allowed_updates=router.resolve_used_update_types(),
+            )
+            print(f"Режим вебхука: {WEBHOOK_URL.rstrip('/')}{WEBHOOK_PATH}")
+            await wait_for_shutdown()
+        else:
+            await bot.delete_webhook()
+            await supervisor.poll()
+    finally:
+        await supervisor.stop()
+        await bot.session.close()
+# -----------------------------------------------------------------------------
+# Головна функція запуску бота
+# -----------------------------------------------------------------------------
+def create_dispatcher(storage: PostgresStorage, pool: asyncpg.Pool) -> Dispatcher:
+    """Диспетчер з усіма middleware і роутером бота (використовується також у bench.py)"""
+    # Ізоляція подій: апдейти одного чату обробляються по черзі навіть при паралельному вебхуку
+    dp = Dispatcher(storage=storage, events_isolation=SimpleEventIsolation(), pool=pool)
+    dp.update.outer_middleware(FSMFlushMiddleware(storage))
+    dp.update.outer_middleware(MetricsMiddleware())
+    router.message.middleware(HandlerNameMiddleware())
+    router.callback_query.middleware(HandlerNameMiddleware())
+    dp.include_router(router)
+    return dp
+async def connect_database(migrate: bool = True) -> asyncpg.Pool | None:
+    boot_timer.mark("імпорт")
     try:
-        pool = await asyncpg.create_pool(DATABASE_URL)
+        pool = await create_db_pool()
     except Exception as e:
         print(f"Не вдалося підключитися до бази даних: {e}")
-        return
+        return None
+    boot_timer.mark("пул БД")
+    if not migrate:
+        return pool
 
-    # <<< ЗМІНИ ТУТ >>>: Викликаємо створення таблиць після успішного підключення
-    # Це гарантує, що таблиці будуть створені/перевірені при кожному запуску
+    # Застосовуємо міграції схеми після успішного підключення
     try:
-        await setup_database(pool)
-        print("✅ Перевірка та створення таблиць завершено.")
+        if await setup_database(pool):
+            print("✅ Схему бази даних оновлено.")
+        boot_timer.mark("міграції")
     except Exception as e:
-        print(f"❌ Помилка при створенні таблиць: {e}")
+        print(f"❌ Помилка при міграції бази даних: {e}")
+        await pool.close()
+        return None
+    return pool
+async def run_bot(shard: int = 0, shards: int = 1, socket_path: str | None = None):
+    """Бот в одному процесі. З socket_path — процес-обробник, що отримує апдейти своїх чатів від супервізора"""
+    pool = await connect_database(migrate=socket_path is None)
+    if pool is None:
         return
-    # <<< КІНЕЦЬ ЗМІН >>>
+    if shards > 1:
+        # Загальні ліміти Telegram і OpenAI діляться між обробниками порівну. Чати однієї організації можуть
+        # потрапити до різних обробників, тому ділиться й ліміт організації; кожному обробнику лишається
+        # хоча б один одночасний запит до OpenAI
+        telegram_limiter.global_bucket = TokenBucket(TELEGRAM_GLOBAL_RATE / shards, TELEGRAM_GLOBAL_RATE / shards)
+        openai_scheduler.tpm_bucket = TokenBucket(OPENAI_TPM / shards / 60, OPENAI_TPM / shards)
+        openai_scheduler.org_tpm = OPENAI_ORG_TPM / shards
+        openai_scheduler.concurrency = max(1, GENERATION_CONCURRENCY // shards)
 
     bot = Bot(token=BOT_TOKEN)
-    dp = Dispatcher(storage=MemoryStorage(), pool=pool)
-    dp.include_router(router)
-    await start_http_server()
-    print("Бот запускається...")
-    await dp.start_polling(bot)
-    await pool.close()
+    bot.session.middleware(TelegramMetricsMiddleware())
+    storage = PostgresStorage(pool)
+    storage.start()
+    dp = create_dispatcher(storage, pool)
+    await generation_queue.start(bot, pool, storage, shard, shards)
+    await broadcast_queue.start(bot, pool, shard, shards)
+    test_engine.start(bot, pool)
+    results_writer.start(pool)
+    openai_scheduler.start(pool)
+    webhook_processor = None
+    if WEBHOOK_URL or socket_path:
+        webhook_processor = WebhookUpdateProcessor(dp, bot, WEBHOOK_CONCURRENCY, WEBHOOK_QUEUE_SIZE)
+        webhook_processor.start()
+    register_metrics_collectors(pool, webhook_processor)
+    boot_timer.mark("сервіси")
+    await start_http_server(webhook_processor, socket_path)
+    boot_timer.mark("HTTP")
+    boot_timer.report()
+    print(f"Обробник {shard} запущено" if socket_path else "Бот запускається...")
+    try:
+        if socket_path:
+            await asyncio.Event().wait()
+        elif webhook_processor:
+            await bot.set_webhook(
+                url=WEBHOOK_URL.rstrip("/") + WEBHOOK_PATH,
+                secret_token=WEBHOOK_SECRET,
+                allowed_updates=dp.resolve_used_update_types(),
+            )
+            print(f"Режим вебхука: {WEBHOOK_URL.rstrip('/')}{WEBHOOK_PATH}")
+            await wait_for_shutdown()
+        else:
+            # Резервний режим: polling (вебхук потрібно зняти, інакше getUpdates не працюватиме)
+            await bot.delete_webhook()
+            await dp.start_polling(bot)
+    finally:
+        if webhook_processor:
+            await webhook_processor.stop()
+        await generation_queue.stop()
+        await broadcast_queue.stop()
+        await test_engine.stop()
+        await results_writer.close()
+        await storage.close()
+        await bot.session.close()
+        await pool.close()
+async def main():
+    if not BOT_TOKEN:
+        print("Помилка: не знайдено токен бота. Задайте змінну середовища TELEGRAM_BOT_TOKEN.")
+        return
+    if not DATABASE_URL:
+        print("Помилка: не знайдено адресу бази даних. Задайте змінну середовища DATABASE_URL.")
+        return
+    if WEBHOOK_URL and not WEBHOOK_SECRET:
+        # Без секрету будь-хто може надіслати на публічну адресу апдейт від імені адміністратора
+        print("Помилка: для режиму вебхука задайте змінну середовища WEBHOOK_SECRET (символи A-Z, a-z, 0-9, _ і -).")
+        return
+    if WORKER_PROCESSES > 1:
+        await run_supervisor(WORKER_PROCESSES)
+    else:
+        await run_bot()
 if __name__ == "__main__":
     asyncio.run(main())